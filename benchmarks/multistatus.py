@@ -0,0 +1,79 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+"""Compares serializing PROPFIND multistatus bodies with lxml, as DavView does with
+xml_fast_multistatus = False, against djangodav.multistatus.MultistatusWriter.
+
+    python benchmarks/multistatus.py [rows]
+"""
+import json
+import os
+import sys
+from timeit import repeat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+
+from djangodav.multistatus import MultistatusWriter
+from djangodav.utils import D, build_property_tag_list
+
+NAMES = ['getcontentlength', 'creationdate', 'getlastmodified', 'resourcetype', 'displayname', 'getetag']
+
+
+def get_rows(count):
+    return [('/collection/file%d.txt' % i, {
+        'getcontentlength': i * 1024,
+        'creationdate': '2014-12-24T06:00:00Z',
+        'getlastmodified': 'Wed, 24 Dec 2014 06:00:00 +0000',
+        'resourcetype': i % 10 == 0,
+        'displayname': 'file%d.txt' % i,
+        'getetag': '%040x' % i,
+    }) for i in range(count)]
+
+
+def serialize_lxml(rows):
+    return etree.tostring(D.multistatus(*[
+        D.response(D.href(href), D.propstat(D.prop(*build_property_tag_list(props, NAMES)), D.status('HTTP/1.1 200 OK')))
+        for href, props in rows
+    ]), xml_declaration=True, encoding='utf-8')
+
+
+def serialize_writer(rows, writer=MultistatusWriter()):
+    return writer.header + b''.join(writer.response(href, props, NAMES) for href, props in rows) + writer.footer
+
+
+def run(rows=1000, number=10, repeat_count=5):
+    rows = get_rows(rows)
+    assert serialize_lxml(rows) == serialize_writer(rows)
+    results = {}
+    for name, func in (('lxml', serialize_lxml), ('writer', serialize_writer)):
+        timings = repeat(lambda: func(rows), number=number, repeat=repeat_count)
+        results[name] = min(timings) / number
+    return {
+        'benchmark': 'multistatus',
+        'rows': len(rows),
+        'seconds': results,
+        'speedup': results['lxml'] / results['writer'],
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:2]]), indent=2))
@@ -0,0 +1,108 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+"""Compares Depth 1 PROPFIND of a collection on a simulated slow file system, where every stat
+costs latency seconds like a network round trip on NFS or SMB, with DavView.propfind_workers
+threads gathering the properties against the default serial mode.
+
+    python benchmarks/propfind_parallel.py [children] [latency]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import django
+from django.conf import settings
+
+from runtests import DEFAULT_SETTINGS
+
+PROPFIND_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                 b'<D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>')
+
+
+def get_resource_class(root, latency):
+    from django.utils.functional import cached_property
+    from djangodav.base.resources import MetaEtagMixIn
+    from djangodav.fs.resources import BaseFSDavResource, DummyFSDAVResource
+
+    def stat(self):
+        time.sleep(latency)
+        return BaseFSDavResource.stat.func(self)
+    return type('SlowFSDavResource', (MetaEtagMixIn, DummyFSDAVResource), {
+        'root': root, 'stat': cached_property(stat),
+    })
+
+
+def run(children=200, latency=0.002, workers=(0, 4, 16), repeat_count=3):
+    from django.test import RequestFactory
+    from djangodav.acls import FullAcl
+    from djangodav.locks import DummyLock
+    from djangodav.views import DavView
+    from djangodav.views.views import get_executor
+
+    root = tempfile.mkdtemp(prefix='djangodav-bench-')
+    try:
+        os.mkdir(os.path.join(root, 'dir'))
+        for i in range(children):
+            with open(os.path.join(root, 'dir', 'file%d.txt' % i), 'wb') as f:
+                f.write(b'x' * i)
+        resource_class = get_resource_class(root, latency)
+        factory = RequestFactory()
+        results, bodies = {}, set()
+        for count in workers:
+            view_class = type('BenchDavView', (DavView,), {'propfind_workers': count})
+            view = view_class.as_view(resource_class=resource_class, lock_class=DummyLock, acl_class=FullAcl)
+            timings = []
+            for i in range(repeat_count):
+                request = factory.generic('PROPFIND', '/dav/dir/', PROPFIND_BODY, content_type='text/xml', HTTP_DEPTH='1')
+                start = default_timer()
+                response = view(request, path='/dir/')
+                timings.append(default_timer() - start)
+                bodies.add(response.content)
+            results[str(count)] = min(timings)
+            if count:
+                get_executor(view_class, 'propfind', count).shutdown()
+        assert len(bodies) == 1, 'Responses differ between worker counts'
+    finally:
+        shutil.rmtree(root)
+    serial = results['0']
+    return {
+        'benchmark': 'propfind_parallel',
+        'children': children,
+        'latency': latency,
+        'seconds': results,
+        'speedup': dict((count, serial / seconds) for count, seconds in results.items() if count != '0'),
+    }
+
+
+if __name__ == '__main__':
+    bench_settings = dict(DEFAULT_SETTINGS)
+    bench_settings['ALLOWED_HOSTS'] = ['testserver']
+    settings.configure(**bench_settings)
+    django.setup()
+    args = sys.argv[1:3]
+    print(json.dumps(run(*[int(args[0])] + [float(arg) for arg in args[1:]]) if args else run(), indent=2))
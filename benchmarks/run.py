@@ -0,0 +1,351 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+"""Benchmark suite for the DavView hot paths on the FS and DB backends.
+
+Builds synthetic trees (wide, deep, many small files, a few huge files) in a temporary directory
+and in an in-memory SQLite database. It runs PROPFIND depth 0/1/infinity, GET, PUT, COPY, MOVE and
+DELETE through DavView and prints JSON with throughput, latency percentiles, query count, file
+system call counts and peak memory for every operation.
+
+    python benchmarks/run.py [--backend fs db db-path] [--tree wide deep small huge] [--scale 1]
+                             [--iterations 5] [--output results.json]
+
+File system calls are the os functions and open the FS backend uses, counted by wrapping them
+during one extra instrumented run. Peak memory is traced with tracemalloc during the same run.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from base64 import b64encode
+from contextlib import contextmanager
+from hashlib import md5
+from timeit import default_timer
+
+try:
+    import builtins
+except ImportError:  # Python 2
+    import __builtin__ as builtins
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import django
+from django.conf import settings
+
+from runtests import DEFAULT_SETTINGS
+
+FS_CALLS = ['stat', 'lstat', 'scandir', 'listdir', 'open', 'rename', 'replace', 'remove', 'rmdir', 'mkdir']
+
+PROPFIND_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                 b'<D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>')
+
+
+def wide_tree(scale):
+    yield 'wide', None
+    for i in range(1000 * scale):
+        yield 'wide/file%d.txt' % i, 1024
+
+
+def deep_tree(scale):
+    path = 'deep'
+    yield path, None
+    for level in range(20 * scale):
+        yield path + '/a.txt', 1024
+        yield path + '/b.txt', 1024
+        path += '/level%d' % level
+        yield path, None
+
+
+def small_tree(scale):
+    yield 'small', None
+    for i in range(10):
+        yield 'small/dir%d' % i, None
+        for j in range(10):
+            yield 'small/dir%d/dir%d' % (i, j), None
+            for k in range(10 * scale):
+                yield 'small/dir%d/dir%d/file%d.txt' % (i, j, k), 512
+
+
+def huge_tree(scale, size=16 * 1024 * 1024):
+    yield 'huge', None
+    for i in range(2):
+        yield 'huge/file%d.bin' % i, size * scale
+
+
+TREES = {'wide': wide_tree, 'deep': deep_tree, 'small': small_tree, 'huge': huge_tree}
+
+
+class FSBackend(object):
+    name = 'fs'
+
+    def __init__(self):
+        from djangodav.base.resources import MetaEtagMixIn
+        from djangodav.fs.resources import DummyFSDAVResource
+        self.root = tempfile.mkdtemp(prefix='djangodav-bench-')
+        self.resource_class = type('BenchFSDavResource', (MetaEtagMixIn, DummyFSDAVResource), {'root': self.root})
+
+    def create_tree(self, spec):
+        for path, size in spec:
+            full_path = os.path.join(self.root, *path.split('/'))
+            if size is None:
+                os.mkdir(full_path)
+                continue
+            with open(full_path, 'wb') as f:
+                for offset in range(0, size, 1024 * 1024):
+                    f.write(b'x' * min(1024 * 1024, size - offset))
+
+    def close(self):
+        shutil.rmtree(self.root)
+
+
+class DBBackend(object):
+    name = 'db'
+    huge_size = 1024 * 1024  # Content is kept base64 encoded in a text column
+
+    def __init__(self):
+        from samples.db.resources import MyDBDavResource
+        self.resource_class = MyDBDavResource
+
+    def create_tree(self, spec):
+        collection_model = self.resource_class.collection_model
+        object_model = self.resource_class.object_model
+        with_path = 'path' in [f.name for f in collection_model._meta.fields]
+        collections = {}
+        for path, size in spec:
+            parent_path, _, name = path.rpartition('/')
+            kwargs = dict(name=name, parent=collections.get(parent_path))
+            if with_path:
+                kwargs['path'] = path
+            if size is None:
+                collections[path] = collection_model.objects.create(**kwargs)
+                continue
+            content = b'x' * size
+            object_model.objects.create(
+                size=size, content=b64encode(content).decode('ascii'), md5=md5(content).hexdigest(), **kwargs
+            )
+
+    def close(self):
+        self.resource_class.collection_model.objects.all().delete()
+
+
+class PathDBBackend(DBBackend):
+    name = 'db-path'
+
+    def __init__(self):
+        from samples.db.resources import MyPathDBDavResource
+        self.resource_class = MyPathDBDavResource
+
+
+BACKENDS = {'fs': FSBackend, 'db': DBBackend, 'db-path': PathDBBackend}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+@contextmanager
+def count_fs_calls(counts):
+    from djangodav.fs import resources as fs_resources
+    originals = []
+
+    def patch(owner, attr, key):
+        func = getattr(owner, attr, None)
+        if func is None:
+            return
+
+        def counting(*args, **kwargs):
+            counts[key] = counts.get(key, 0) + 1
+            return func(*args, **kwargs)
+        originals.append((owner, attr, func))
+        setattr(owner, attr, counting)
+
+    for name in FS_CALLS:
+        patch(os, name, 'os.' + name)
+    patch(fs_resources, 'scandir', 'os.scandir')
+    patch(fs_resources, 'replace', 'os.replace')
+    patch(builtins, 'open', 'open')
+    try:
+        yield counts
+    finally:
+        for owner, attr, func in reversed(originals):
+            setattr(owner, attr, func)
+
+
+class Bench(object):
+    def __init__(self, backend, iterations):
+        from django.db import connection
+        from django.test import RequestFactory
+        from djangodav.acls import FullAcl
+        from djangodav.locks import DummyLock
+        from djangodav.views import DavView
+        self.backend = backend
+        self.iterations = iterations
+        self.connection = connection
+        self.factory = RequestFactory()
+        self.view = DavView.as_view(resource_class=backend.resource_class, lock_class=DummyLock, acl_class=FullAcl)
+
+    def request(self, method, path, data=b'', content_type='application/octet-stream', **meta):
+        request = self.factory.generic(method, '/dav' + path, data, content_type=content_type, **meta)
+        response = self.view(request, path=path)
+        if response.status_code >= 400:
+            raise AssertionError('%s %s answered %d' % (method, path, response.status_code))
+        if response.streaming:
+            for chunk in response.streaming_content:
+                pass
+        response.close()
+        return response
+
+    def measure(self, operation, setup=None, teardown=None):
+        """Time iterations calls of operation(i, *setup(i)), then one instrumented call."""
+        latencies = []
+        for i in range(self.iterations):
+            args = setup(i) if setup else ()
+            start = default_timer()
+            operation(i, *args)
+            latencies.append(default_timer() - start)
+            if teardown:
+                teardown(i)
+        i = self.iterations
+        args = setup(i) if setup else ()
+        fs_calls, queries = {}, []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+        if tracemalloc is not None:
+            tracemalloc.start()
+        with self.connection.execute_wrapper(count_query), count_fs_calls(fs_calls):
+            operation(i, *args)
+        peak_memory = None
+        if tracemalloc is not None:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if teardown:
+            teardown(i)
+        return {
+            'iterations': self.iterations,
+            'throughput_per_second': len(latencies) / sum(latencies),
+            'latency_ms': dict(
+                (name, percentile(latencies, fraction) * 1000)
+                for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+            ),
+            'queries': len(queries),
+            'fs_calls': fs_calls,
+            'fs_calls_total': sum(fs_calls.values()),
+            'peak_memory_bytes': peak_memory,
+        }
+
+    def run_tree(self, tree, spec):
+        root = '/%s/' % tree
+        first_object = '/' + next(path for path, size in spec if size is not None)
+        destination = lambda name, i: 'http://testserver/dav/%s-%s%d/' % (tree, name, i)
+        resource = self.backend.resource_class
+        results = {}
+
+        for depth in ('0', '1', 'infinity'):
+            results['propfind_depth_%s' % depth] = self.measure(lambda i: self.request(
+                'PROPFIND', root, PROPFIND_BODY, content_type='text/xml', HTTP_DEPTH=depth
+            ))
+        results['get'] = self.measure(lambda i: self.request('GET', first_object))
+        results['put'] = self.measure(lambda i: self.request('PUT', '%sput%d.txt' % (root, i), b'x' * 4096))
+        results['copy'] = self.measure(
+            lambda i: self.request('COPY', root, HTTP_DESTINATION=destination('copy', i), HTTP_DEPTH='infinity'),
+            teardown=lambda i: resource('/%s-copy%d/' % (tree, i)).delete()
+        )
+        results['move'] = self.measure(
+            lambda i: self.request('MOVE', root, HTTP_DESTINATION=destination('move', i)),
+            teardown=lambda i: resource('/%s-move%d/' % (tree, i)).move(resource(root))
+        )
+
+        def setup_delete(i):
+            resource(root).copy(resource('/%s-delete%d/' % (tree, i)))
+            return ()
+        results['delete'] = self.measure(
+            lambda i: self.request('DELETE', '/%s-delete%d/' % (tree, i)), setup=setup_delete
+        )
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark DavView hot paths.')
+    parser.add_argument('--backend', nargs='+', choices=sorted(BACKENDS), default=['fs', 'db'])
+    parser.add_argument('--tree', nargs='+', choices=sorted(TREES), default=sorted(TREES))
+    parser.add_argument('--scale', type=int, default=1, help='Multiplies the size of the trees.')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+    options = parser.parse_args(argv)
+
+    bench_settings = dict(DEFAULT_SETTINGS)
+    bench_settings['DATABASES'] = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+    bench_settings['ALLOWED_HOSTS'] = ['testserver']
+    settings.configure(**bench_settings)
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    import multistatus
+    import propfind_parallel
+    report = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'scale': options.scale,
+        'iterations': options.iterations,
+        'results': [],
+        'multistatus': multistatus.run(),
+        'propfind_parallel': propfind_parallel.run(),
+    }
+    for backend_name in options.backend:
+        for tree in options.tree:
+            backend = BACKENDS[backend_name]()
+            try:
+                if tree == 'huge' and hasattr(backend, 'huge_size'):
+                    spec = list(huge_tree(options.scale, backend.huge_size))
+                else:
+                    spec = list(TREES[tree](options.scale))
+                backend.create_tree(spec)
+                operations = Bench(backend, options.iterations).run_tree(tree, spec)
+            finally:
+                backend.close()
+            for operation, metrics in sorted(operations.items()):
+                metrics.update(backend=backend_name, tree=tree, operation=operation)
+                report['results'].append(metrics)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,8 @@
 
 
 class BaseLock(object):
+    stateful = True  # False for backends keeping no locks, whose tokens can't be checked
+
     def __init__(self, resource):
         self.resource = resource
 
@@ -28,14 +30,31 @@ class BaseLock(object):
         """Gets all active locks for the requested resource. Returns a list of locks."""
         raise NotImplementedError()
 
+    @classmethod
+    def get_many(cls, resources):
+        """Gets active locks for several resources at once. Returns a list of lock lists in the order
+        of resources. Override to fetch them with a single lookup."""
+        return [cls(resource).get() or [] for resource in resources]
+
+    def get_subtree(self):
+        """Gets active locks for the requested resource and its descendants, checked before the whole
+        tree is changed. Returns a list of locks, the ones of get() unless overridden."""
+        return self.get()
+
     def acquire(self, lockscope, locktype, depth, timeout, owner):
         """Creates a new lock for the given resource."""
         raise NotImplementedError()
 
+    def refresh(self, token, timeout):
+        """Restarts the timeout of the lock referenced by the given lock id. Returns the lock or None
+        if there is no such active lock for the resource."""
+        raise NotImplementedError()
+
     def release(self, token):
         """Releases the lock referenced by the given lock id."""
         raise NotImplementedError()
 
     def del_locks(self):
-        """Releases all locks for the given resource."""
+        """Releases all locks for the given resource and its descendants, called once for a whole
+        deleted or overwritten tree."""
         raise NotImplementedError()
@@ -0,0 +1,55 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class BasePropertyStore(object):
+    """Keeps dead properties, set by clients with PROPPATCH, of a resource. Properties are
+    identified by their Clark notation tag, like '{urn:schemas-microsoft-com:}Win32FileAttributes',
+    and stored as the serialized XML element."""
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def get(self, names=None):
+        """Returns a dict of stored properties of the resource, limited to the given names."""
+        raise NotImplementedError()
+
+    @classmethod
+    def get_many(cls, resources, names=None):
+        """Returns get dicts for several resources at once, in order. Override to fetch them with
+        a single lookup."""
+        return [cls(resource).get(names) for resource in resources]
+
+    def update(self, set_props, remove_names):
+        """Stores the properties of the set_props dict and removes the ones listed in remove_names."""
+        raise NotImplementedError()
+
+    def delete(self):
+        """Removes the properties of the resource and all its descendants."""
+        raise NotImplementedError()
+
+    def copy(self, destination):
+        """Copies the properties of the resource and its descendants to the destination tree."""
+        raise NotImplementedError()
+
+    def move(self, destination):
+        """Moves the properties of the resource and its descendants to the destination tree."""
+        raise NotImplementedError()
@@ -19,6 +19,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
 from hashlib import md5
+from io import BytesIO
 from mimetypes import guess_type
 
 from django.utils.encoding import force_bytes
@@ -34,12 +35,39 @@ class BaseDavResource(object):
         '{DAV:}getlastmodified', '{DAV:}resourcetype', '{DAV:}displayname'
     ]
 
+    # getetag is computed without reading the content, so conditional GET may use it
+    cheap_etag = False
+
     def __init__(self, path):
         self.path = []
         path = path.strip("/")
         if path:
             self.path = path.split("/")
 
+    def get_properties(self, names):
+        """Return a dict of the values of the given live properties, unknown ones are left out.
+        resourcetype gives is_collection. Override to compute several properties in one pass."""
+        props = {}
+        for name in names:
+            if name == 'resourcetype':
+                props[name] = self.is_collection
+                continue
+            if name.startswith('_'):
+                continue
+            try:
+                value = getattr(self, name)
+            except AttributeError:
+                continue
+            if not callable(value):
+                props[name] = value
+        return props
+
+    @classmethod
+    def get_properties_bulk(cls, resources, names):
+        """Return the get_properties dicts of several resources, in order. Override to fetch them
+        for a whole batch with one query or stat pass."""
+        return [resource.get_properties(names) for resource in resources]
+
     def get_path(self):
         return ("/" if self.path else "") + "/".join(self.path) + ("/" * (self.is_collection))
 
@@ -106,7 +134,7 @@ class BaseDavResource(object):
         if self.is_collection:
             if not destination.exists or not destination.is_collection:
                 destination.create_collection()
-            self.copy_collection(destination, depth)
+            return self.copy_collection(destination, depth)
         else:
             if destination.is_object:
                 destination.delete()
@@ -116,7 +144,8 @@ class BaseDavResource(object):
         """Called to copy a resource to a new location. Overwrite is assumed, the DAV server
         will refuse to copy to an existing resource otherwise. This method needs to gracefully
         handle a pre-existing destination of any type. It also needs to respect the depth
-        parameter. depth == -1 is infinity."""
+        parameter. depth == -1 is infinity. Backends which carry on when a member fails return a
+        list of (destination resource, status code) pairs, reported in a multistatus response."""
         # If depth is less than 0, then it started out as -1.
         # We need to keep recursing until we hit 0, or forever
         # in case of infinity.
@@ -153,11 +182,38 @@ class BaseDavResource(object):
         raise NotImplemented()
 
     def write(self, content):
+        """Store the content read from the request. Backends reading it through an UploadStream
+        return it, so the size actually written is reported by instrumentation."""
         raise NotImplementedError()
 
     def read(self):
         raise NotImplementedError()
 
+    def open_read(self):
+        """Return a binary file-like object to read the resource content from. The default
+        implementation wraps read(), backends able to stream should override it."""
+        return BytesIO(force_bytes(self.read()))
+
+    def iter_read(self, chunk_size=64 * 1024):
+        """Return an iterator over the resource content in chunks of chunk_size bytes."""
+        f = self.open_read()
+        try:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+        finally:
+            f.close()
+
+    def open_range(self, start, end):
+        """Return a binary file-like object reading the bytes between start and end offsets, both
+        inclusive. The default implementation wraps read_range(), backends able to stream a range
+        should override it."""
+        return BytesIO(force_bytes(self.read_range(start, end)))
+
+    def read_range(self, start, end):
+        """Return the bytes between start and end offsets, both inclusive. The default
+        implementation slices the whole content, backends able to seek should override it."""
+        return self.read()[start:end + 1]
+
     @property
     def is_collection(self):
         raise NotImplementedError()
@@ -183,8 +239,20 @@ class BaseDavResource(object):
     def create_collection(self):
         raise NotImplementedError()
 
+    def rehash(self, force=False):
+        """Recompute a persisted content digest, for resources changed outside WebDAV. Returns True
+        when a digest was stored."""
+        return False
+
+    def invalidate(self):
+        """Called by the view once the resource was created or changed, to drop any state the
+        resource keeps cached about itself."""
+        pass
+
 
 class MetaEtagMixIn(object):
+    cheap_etag = True
+
     @property
     def getetag(self):
         """Calculate an etag for this resource. The default implementation uses an md5 sub of the
@@ -50,6 +50,15 @@ class TestBaseDavResource(TestCase):
     def test_displayname(self):
         self.assertEqual(self.resource.displayname, 'name')
 
+    def test_get_properties(self):
+        resource = MockObject('/path/to/name')
+        self.assertEqual(resource.get_properties(['displayname', 'resourcetype', 'getcontentlength', 'unknown', 'delete']), {
+            'displayname': 'name', 'resourcetype': False, 'getcontentlength': 42
+        })
+        self.assertEqual(BaseDavResource.get_properties_bulk([resource, MockCollection('/path/')], ['resourcetype']), [
+            {'resourcetype': False}, {'resourcetype': True}
+        ])
+
     def test_move_collection(self):
         child = MockObject('/path/to/src/child', move=Mock())
         src = MockCollection('/path/to/src/', get_children=Mock(return_value=[child]), delete=Mock())
@@ -0,0 +1,127 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+from time import time
+
+from django.utils.encoding import force_bytes
+
+
+class BasePathCache(object):
+    """Maps resource paths to (model attribute, pk, modified) tuples of resolved model instances,
+    so resources can be fetched by primary key instead of joining the whole collections chain.
+    Counts hits and misses of the lookups done through it."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        """Drops all cached values."""
+        raise NotImplementedError()
+
+
+class LRUPathCache(BasePathCache):
+    """Process local cache keeping up to max_size recently used paths, for timeout seconds if
+    given. Other processes don't clear it, give it a timeout when running several of them."""
+
+    def __init__(self, max_size=10000, timeout=None):
+        super(LRUPathCache, self).__init__()
+        self.max_size = max_size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires = self.data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time():
+                return None
+            self.data[key] = value, expires
+            return value
+
+    def set(self, key, value):
+        expires = time() + self.timeout if self.timeout is not None else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value, expires
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class DjangoPathCache(BasePathCache):
+    """Cache shared between processes through Django's cache framework. Keys are versioned with
+    a generation counter kept in the cache as well, so clear() drops every path at once."""
+
+    def __init__(self, alias='default', prefix='djangodav', timeout=300):
+        super(DjangoPathCache, self).__init__()
+        self.alias = alias
+        self.prefix = prefix
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get_generation(self):
+        return self.cache.get_or_set('%s:generation' % self.prefix, 0, None)
+
+    def make_key(self, key):
+        return '%s:%s:%s' % (self.prefix, self.get_generation(), md5(force_bytes(key)).hexdigest())
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self.make_key(key), value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        key = '%s:generation' % self.prefix
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
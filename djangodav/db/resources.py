@@ -18,14 +18,19 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+from copy import copy
+from hashlib import md5, sha1
 from operator import and_
 from functools import reduce
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import CharField, Q, Value
+from django.db.models.functions import Concat, Length, Substr
+from django.utils.encoding import force_bytes
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 from djangodav.base.resources import BaseDavResource
-from djangodav.utils import url_join
+from djangodav.utils import prefix_lookup, url_join
 
 
 class BaseDBDavResource(BaseDavResource):
@@ -37,6 +42,7 @@ class BaseDBDavResource(BaseDavResource):
     modified_attribute = 'modified'
     name_attribute = 'name'
     size_attribute = 'size'
+    etag_attribute = None  # object field keeping the content digest served as ETag
 
     collection_select_related = tuple()
     object_select_related = tuple()
@@ -44,6 +50,11 @@ class BaseDBDavResource(BaseDavResource):
     collection_prefetch_related = tuple()
     object_prefetch_related = tuple()
 
+    descendants_batch_size = 500
+
+    path_cache = None  # djangodav.db.cache.BasePathCache instance shared between requests
+    missing_path_cache = None  # the same for paths confirmed missing, should have a short timeout
+
     def __init__(self, path, **kwargs):
         if 'obj' in kwargs:  # Accepting ready object to reduce db requests
             self.__dict__['obj'] = kwargs.pop('obj')
@@ -57,6 +68,26 @@ class BaseDBDavResource(BaseDavResource):
     def getcontentlength(self):
         return getattr(self.obj, self.size_attribute)
 
+    @property
+    def getetag(self):
+        if not self.is_object:
+            raise AttributeError('Collections have no entity tag')  # Left out of PROPFIND
+        if self.etag_attribute is None:
+            return super(BaseDBDavResource, self).getetag
+        return getattr(self.obj, self.etag_attribute)
+
+    def rehash(self, force=False):
+        if self.etag_attribute is None or not self.is_object:
+            return False
+        if getattr(self.obj, self.etag_attribute) and not force:
+            return False
+        hashsum = md5()
+        for chunk in self.iter_read():
+            hashsum.update(chunk)
+        setattr(self.obj, self.etag_attribute, hashsum.hexdigest())
+        self.object_model.objects.filter(pk=self.obj.pk).update(**{self.etag_attribute: hashsum.hexdigest()})
+        return True
+
     def get_created(self):
         if self.is_root:
             return now()
@@ -85,11 +116,8 @@ class BaseDBDavResource(BaseDavResource):
     def get_model_kwargs(self, **kwargs):
         return kwargs
 
-    def get_children(self):
-        """Return an iterator of all direct children of this resource."""
-        if not self.exists or isinstance(self.obj, self.object_model):
-            return
-
+    def get_children_querysets(self, **kwargs):
+        """Return querysets of collections and objects filtered by given lookup kwargs."""
         models = [
             [self.collection_model, self.collection_select_related, self.collection_prefetch_related],
             [self.object_model, self.object_select_related, self.object_prefetch_related]
@@ -100,13 +128,50 @@ class BaseDBDavResource(BaseDavResource):
                 qs = qs.select_related(*select_related)
             if prefetch_related:
                 qs = qs.prefetch_related(*prefetch_related)
-            kwargs = self.get_model_lookup_kwargs(**{self.collection_attribute: self.obj})
-            for child in qs.filter(**kwargs):
+            yield qs.filter(**self.get_model_lookup_kwargs(**kwargs))
+
+    def get_children(self):
+        """Return an iterator of all direct children of this resource."""
+        if not self.exists or isinstance(self.obj, self.object_model):
+            return
+
+        for qs in self.get_children_querysets(**{self.collection_attribute: self.obj}):
+            for child in qs:
                 yield self.clone(
-                    url_join(*(self.path + [child.name])),
+                    url_join(*(self.path + [getattr(child, self.name_attribute)])),
                     obj=child    # Sending ready object to reduce db requests
                 )
 
+    def get_descendants(self, depth=1, include_self=True):
+        """Return an iterator of all descendants of this resource. Descendants are loaded level by
+        level with parent__in lookups, so the whole tree costs O(depth) queries instead of
+        two queries per collection."""
+        if include_self:
+            yield self
+        if depth == 0:
+            return
+        level = list(self.get_children())
+        while level:
+            depth -= 1
+            collections = {}
+            for resource in level:
+                yield resource
+                if resource.is_collection:
+                    collections[resource.obj.pk] = resource
+            if depth == 0:
+                return
+            level = []
+            parent_ids = list(collections)
+            for i in range(0, len(parent_ids), self.descendants_batch_size):
+                lookup = {'%s__in' % self.collection_attribute: parent_ids[i:i + self.descendants_batch_size]}
+                for qs in self.get_children_querysets(**lookup):
+                    for child in qs:
+                        parent = collections[child.serializable_value(self.collection_attribute)]
+                        level.append(parent.clone(
+                            url_join(*(parent.path + [getattr(child, self.name_attribute)])),
+                            obj=child
+                        ))
+
     def read(self):
         raise NotImplementedError
 
@@ -114,9 +179,113 @@ class BaseDBDavResource(BaseDavResource):
         raise NotImplementedError
 
     def delete(self):
+        """Delete the resource. The collections of a subtree are deleted by batches of primary keys,
+        their objects go with the cascade as one DELETE per batch, instead of collecting the tree one
+        collection at a time. PathLookupDBDavMixIn finds the subtree collections with one query."""
         if not self.obj:
             return
-        self.obj.delete()
+        self.invalidate_path_cache()
+        if not self.is_collection:
+            self.obj.delete()
+            return
+        collection_ids = self.get_subtree_collection_ids()
+        collection_ids.reverse()
+        with transaction.atomic():
+            # Deepest first, so deleting a batch doesn't cascade to collections of the next ones
+            for i in range(0, len(collection_ids), self.descendants_batch_size):
+                batch = collection_ids[i:i + self.descendants_batch_size]
+                self.collection_model.objects.filter(pk__in=batch).delete()
+
+    def get_subtree_collection_ids(self):
+        """Return the primary keys of the collection and all collections below it, deepest last,
+        loaded level by level."""
+        ids = level = [self.obj.pk]
+        while level:
+            parents, level = level, []
+            for i in range(0, len(parents), self.descendants_batch_size):
+                lookup = {'%s__in' % self.collection_attribute: parents[i:i + self.descendants_batch_size]}
+                level += self.collection_model.objects.filter(
+                    **self.get_model_lookup_kwargs(**lookup)
+                ).values_list('pk', flat=True)
+            ids = ids + level
+        return ids
+
+    def get_path_cache_key(self):
+        # Resources scoped by lookup kwargs, per owner for example, don't share cached paths
+        scope = ",".join("%s=%s" % (name, getattr(value, 'pk', value))
+                         for name, value in sorted(self.get_model_lookup_kwargs().items()))
+        return "%s:%s:%s" % (self.collection_model._meta.label_lower, scope, "/".join(self.path))
+
+    def get_cached_obj(self):
+        """Return the model instance of the path cached in path_cache fetched by its primary key,
+        or None if it isn't cached or the cached entry is stale."""
+        if self.path_cache is None:
+            return None
+        key = self.get_path_cache_key()
+        cached = self.path_cache.get(key)
+        obj = None
+        if cached is not None:
+            model_attr, pk, modified = cached
+            qs = getattr(self, "%s_model" % model_attr).objects
+            select_related = getattr(self, "%s_select_related" % model_attr)
+            if select_related:
+                qs = qs.select_related(*select_related)
+            prefetch_related = getattr(self, "%s_prefetch_related" % model_attr)
+            if prefetch_related:
+                qs = qs.prefetch_related(*prefetch_related)
+            obj = qs.filter(pk=pk, **self.get_model_lookup_kwargs()).first()
+            if obj is not None and not self.is_cached_obj_valid(obj, modified):
+                obj = None  # Changed outside of the dav resources or by another process
+            if obj is None:
+                self.path_cache.delete(key)
+        if obj is None:
+            self.path_cache.misses += 1
+        else:
+            self.path_cache.hits += 1
+        return obj
+
+    def is_cached_obj_valid(self, obj, modified):
+        """Return True if the row fetched for a cached path still is the one of the path. Moves of
+        its ancestors can't be seen here, caches not shared between processes need a timeout."""
+        return getattr(obj, self.modified_attribute) == modified and getattr(obj, self.name_attribute) == self.path[-1]
+
+    def set_cached_obj(self, obj):
+        if self.path_cache is None or obj is None:
+            return
+        model_attr = 'collection' if isinstance(obj, self.collection_model) else 'object'
+        self.path_cache.set(self.get_path_cache_key(), (model_attr, obj.pk, getattr(obj, self.modified_attribute)))
+
+    def is_cached_missing(self):
+        """Return True if the path was recently confirmed missing."""
+        if self.missing_path_cache is None:
+            return False
+        if self.missing_path_cache.get(self.get_path_cache_key()) is None:
+            self.missing_path_cache.misses += 1
+            return False
+        self.missing_path_cache.hits += 1
+        return True
+
+    def set_cached_missing(self):
+        if self.missing_path_cache is None:
+            return
+        self.missing_path_cache.set(self.get_path_cache_key(), True)
+
+    def invalidate_path_cache(self, descendants=None):
+        """Drop the cached path of this resource. Changing a collection changes the paths of all
+        its descendants, so the whole cache is dropped then."""
+        caches = [cache for cache in (self.path_cache, self.missing_path_cache) if cache is not None]
+        if not caches:
+            return
+        if descendants is None:
+            descendants = self.is_collection
+        for cache in caches:
+            if descendants:
+                cache.clear()
+            else:
+                cache.delete(self.get_path_cache_key())
+
+    def invalidate(self):
+        self.invalidate_path_cache()
 
 
 class NameLookupDBDavMixIn(object):
@@ -137,12 +306,17 @@ class NameLookupDBDavMixIn(object):
         parent = self.clone("/".join(self.path[:-1])).obj
         kwargs = self.get_model_kwargs(**{self.collection_attribute: parent, 'name': name})
         self.collection_model.objects.create(**kwargs)
+        self.invalidate_path_cache(descendants=False)
 
     @cached_property
     def obj(self):
         if not self.path:
             return None
 
+        obj = self.get_cached_obj()
+        if obj is not None or self.is_cached_missing():
+            return obj
+
         if self.possible_collection:  # Reducing queries
             attempts = [self.get_collection, self.get_object]
         else:
@@ -150,9 +324,12 @@ class NameLookupDBDavMixIn(object):
 
         for get_object in attempts:
             try:
-                return get_object()
+                obj = get_object()
             except ObjectDoesNotExist:
                 continue
+            self.set_cached_obj(obj)
+            return obj
+        self.set_cached_missing()
 
     def get_model_by_path(self, model_attr, path):
         if not path:
@@ -189,6 +366,7 @@ class NameLookupDBDavMixIn(object):
         setattr(self.obj, self.created_attribute, now())
         setattr(self.obj, self.modified_attribute, now())
         self.obj.save(force_insert=True)
+        destination.invalidate_path_cache(descendants=False)
 
     def move_object(self, destination):
         name = destination.path[-1]
@@ -197,3 +375,187 @@ class NameLookupDBDavMixIn(object):
         setattr(self.obj, self.collection_attribute, collection)
         setattr(self.obj, self.modified_attribute, now())
         self.obj.save(update_fields=[self.name_attribute, self.collection_attribute, self.modified_attribute])
+        self.invalidate_path_cache(descendants=False)
+        destination.invalidate_path_cache(descendants=False)
+
+    def move(self, destination):
+        """A collection moved to a free location keeps its row and the rows of its descendants, only
+        its own parent and name are updated. Merging into an existing collection moves each child."""
+        if not self.is_collection or self.is_root or destination.exists:
+            return super(NameLookupDBDavMixIn, self).move(destination)
+        with transaction.atomic():
+            self.move_object(destination)
+            self.move_descendants(destination)
+        self.invalidate_path_cache(descendants=True)
+
+    def move_descendants(self, destination):
+        """Called once the collection row moved, for backends keeping data derived from the path."""
+
+    def copy(self, destination, depth=-1):
+        """A collection copied to a free location is copied level by level, with one query per model
+        loading the children of up to descendants_batch_size collections and one bulk_create
+        inserting their copies, in a single transaction."""
+        if not self.is_collection or self.is_root or destination.exists:
+            return super(NameLookupDBDavMixIn, self).copy(destination, depth)
+        with transaction.atomic():
+            self.copy_tree(destination, depth)
+        destination.invalidate_path_cache(descendants=True)
+
+    def copy_tree(self, destination, depth=-1):
+        parent = self.clone(destination.get_parent_path())
+        top = self.copy_row(copy(self.obj), parent, destination.path[-1])
+        top.save(force_insert=True)
+        level = {self.obj.pk: self.clone(url_join(*destination.path), obj=top)}
+        while level and depth != 0:
+            depth -= 1
+            next_level = {}
+            source_ids = list(level)
+            for i in range(0, len(source_ids), self.descendants_batch_size):
+                batch = source_ids[i:i + self.descendants_batch_size]
+                next_level.update(self.copy_children(self.collection_model, batch, level))
+                self.copy_children(self.object_model, batch, level)
+            level = next_level
+
+    def copy_children(self, model, source_ids, targets):
+        """Copy the children of the source_ids collections to the targets resources of the same
+        keys. Returns the copied collections mapping source keys to the new resources."""
+        lookup = self.get_model_lookup_kwargs(**{'%s__in' % self.collection_attribute: source_ids})
+        rows = list(model.objects.filter(**lookup))
+        if not rows:
+            return {}
+        copies = []
+        for row in rows:
+            source_pk, name = row.pk, getattr(row, self.name_attribute)
+            target = targets[row.serializable_value(self.collection_attribute)]
+            copies.append((source_pk, target, name, self.copy_row(row, target, name)))
+        created = model.objects.bulk_create([row for source_pk, target, name, row in copies], self.descendants_batch_size)
+        if model is not self.collection_model:
+            return {}
+        if any(row.pk is None for row in created):
+            # Databases which don't return primary keys from bulk inserts, find the rows by parent and name
+            lookup = self.get_model_lookup_kwargs(**{
+                '%s__in' % self.collection_attribute: list(set(target.obj.pk for source_pk, target, name, row in copies))
+            })
+            inserted = dict(
+                ((row.serializable_value(self.collection_attribute), getattr(row, self.name_attribute)), row)
+                for row in model.objects.filter(**lookup)
+            )
+            created = [inserted[(target.obj.pk, name)] for source_pk, target, name, row in copies]
+        return dict(
+            (source_pk, target.clone(url_join(*(target.path + [name])), obj=row))
+            for (source_pk, target, name, _), row in zip(copies, created)
+        )
+
+    def copy_row(self, row, parent, name):
+        """Prepare row to be inserted as a new child called name of the parent resource."""
+        row.pk = None
+        setattr(row, self.name_attribute, name)
+        setattr(row, self.collection_attribute, parent.obj)
+        setattr(row, self.created_attribute, now())
+        setattr(row, self.modified_attribute, now())
+        return row
+
+
+class PathLookupDBDavMixIn(NameLookupDBDavMixIn):
+    """Object lookup by an indexed column holding the full path of each collection and object.
+    Any path is resolved with one equality lookup whatever its depth. Set path_hash to store the
+    sha1 of the path instead, for databases limiting indexed column length."""
+
+    path_attribute = 'path'
+    path_hash = False
+
+    def get_path_value(self, path=None):
+        value = "/".join(self.path if path is None else path)
+        if self.path_hash:
+            return sha1(force_bytes(value)).hexdigest()
+        return value
+
+    def get_model_by_path(self, model_attr, path):
+        if not path:
+            return None
+
+        qs = getattr(self, "%s_model" % model_attr).objects.filter(**self.get_model_lookup_kwargs())
+
+        select_related = getattr(self, "%s_select_related" % model_attr)
+        if select_related:
+            qs = qs.select_related(*select_related)
+
+        prefetch_related = getattr(self, "%s_prefetch_related" % model_attr)
+        if prefetch_related:
+            qs = qs.prefetch_related(*prefetch_related)
+
+        try:
+            return qs.filter(**{self.path_attribute: self.get_path_value(path)})[0]
+        except IndexError:
+            raise qs.model.DoesNotExist()
+
+    def create_collection(self):
+        name = self.path[-1]
+        parent = self.clone("/".join(self.path[:-1])).obj
+        kwargs = self.get_model_kwargs(**{
+            self.collection_attribute: parent,
+            'name': name,
+            self.path_attribute: self.get_path_value()
+        })
+        self.collection_model.objects.create(**kwargs)
+        self.invalidate_path_cache(descendants=False)
+
+    def is_cached_obj_valid(self, obj, modified):
+        # The stored path changes with any move of the row or of its ancestors
+        return super(PathLookupDBDavMixIn, self).is_cached_obj_valid(obj, modified) and \
+            getattr(obj, self.path_attribute) == self.get_path_value()
+
+    def copy_object(self, destination):
+        setattr(self.obj, self.path_attribute, self.get_path_value(destination.path))
+        super(PathLookupDBDavMixIn, self).copy_object(destination)
+
+    def get_subtree_collection_ids(self):
+        if self.path_hash:
+            return super(PathLookupDBDavMixIn, self).get_subtree_collection_ids()
+        annotations, q = prefix_lookup(self.path_attribute, "/".join(self.path) + "/")
+        # A collection path is shorter than the ones of its descendants
+        return [self.obj.pk] + list(self.collection_model.objects.annotate(**annotations).filter(
+            q, **self.get_model_lookup_kwargs()
+        ).order_by(Length(self.path_attribute)).values_list('pk', flat=True))
+
+    def copy_row(self, row, parent, name):
+        setattr(row, self.path_attribute, self.get_path_value(parent.path + [name]))
+        return super(PathLookupDBDavMixIn, self).copy_row(row, parent, name)
+
+    def move_descendants(self, destination):
+        """Rewrite the path column of the descendants, with one UPDATE per model replacing the path
+        prefix, or from the tree loaded level by level when paths are hashed."""
+        if self.path_hash:
+            moved = self.clone(url_join(*destination.path), obj=self.obj)
+            rows = {self.collection_model: [], self.object_model: []}
+            for resource in moved.get_descendants(depth=-1, include_self=False):
+                setattr(resource.obj, self.path_attribute, self.get_path_value(resource.path))
+                rows[resource.obj.__class__].append(resource.obj)
+            for model, objs in rows.items():
+                if hasattr(model.objects, 'bulk_update'):
+                    model.objects.bulk_update(objs, [self.path_attribute], self.descendants_batch_size)
+                    continue
+                for obj in objs:  # Django < 2.2
+                    model.objects.filter(pk=obj.pk).update(**{self.path_attribute: getattr(obj, self.path_attribute)})
+            return
+        source, target = "/".join(self.path) + "/", "/".join(destination.path) + "/"
+        annotations, q = prefix_lookup(self.path_attribute, source)
+        for model in (self.collection_model, self.object_model):
+            model.objects.annotate(**annotations).filter(q, **self.get_model_lookup_kwargs()).update(**{
+                self.path_attribute: Concat(
+                    Value(target), Substr(self.path_attribute, len(source) + 1), output_field=CharField()
+                )
+            })
+
+    def move_object(self, destination):
+        name = destination.path[-1]
+        collection = self.clone(destination.get_parent_path()).obj
+        setattr(self.obj, self.name_attribute, name)
+        setattr(self.obj, self.collection_attribute, collection)
+        setattr(self.obj, self.path_attribute, self.get_path_value(destination.path))
+        setattr(self.obj, self.modified_attribute, now())
+        self.obj.save(update_fields=[
+            self.name_attribute, self.collection_attribute, self.path_attribute, self.modified_attribute
+        ])
+        self.invalidate_path_cache(descendants=False)
+        destination.invalidate_path_cache(descendants=False)
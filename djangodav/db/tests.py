@@ -0,0 +1,329 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import timedelta
+from io import BytesIO
+from django import VERSION as django_version
+from django.test import TestCase
+from django.utils.timezone import now
+from djangodav.db.cache import LRUPathCache, DjangoPathCache
+from samples.db.models import CollectionModel, ObjectModel, PathCollectionModel, PathObjectModel
+from samples.db.resources import MyDBDavResource, MyPathDBDavResource
+
+# Django < 2.2 collector nulls self referencing foreign keys before deleting the rows
+DELETE_EXTRA_QUERIES = 1 if django_version < (2, 2) else 0
+
+
+class TestDBDavResource(TestCase):
+    def setUp(self):
+        a = CollectionModel.objects.create(name='a')
+        b = CollectionModel.objects.create(name='b', parent=a)
+        c = CollectionModel.objects.create(name='c', parent=b)
+        ObjectModel.objects.create(name='top.txt')
+        ObjectModel.objects.create(name='a.txt', parent=a)
+        ObjectModel.objects.create(name='b.txt', parent=b)
+        ObjectModel.objects.create(name='c.txt', parent=c)
+        CollectionModel.objects.create(name='d', parent=a)
+
+    def test_get_descendants_infinity(self):
+        resource = MyDBDavResource('/')
+        with self.assertNumQueries(8):
+            paths = sorted(r.get_path() for r in resource.get_descendants(depth=-1))
+        self.assertEqual(paths, [
+            '/',
+            '/a/', '/a/a.txt', '/a/b/', '/a/b/b.txt', '/a/b/c/', '/a/b/c/c.txt', '/a/d/',
+            '/top.txt',
+        ])
+
+    def test_get_descendants_depth_1(self):
+        resource = MyDBDavResource('/a/')
+        with self.assertNumQueries(3):
+            paths = sorted(r.get_path() for r in resource.get_descendants(depth=1))
+        self.assertEqual(paths, ['/a/', '/a/a.txt', '/a/b/', '/a/d/'])
+
+    def test_write(self):
+        MyDBDavResource('/a/new.txt').write(BytesIO(b'0123456789'))
+        resource = MyDBDavResource('/a/new.txt')
+        self.assertEqual(resource.getcontentlength, 10)
+        self.assertEqual(resource.getetag, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertEqual(resource.read(), b'0123456789')
+
+    def test_rehash(self):
+        self.assertTrue(MyDBDavResource('/a/a.txt').rehash())
+        self.assertEqual(ObjectModel.objects.get(name='a.txt').md5, 'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertFalse(MyDBDavResource('/a/a.txt').rehash())
+        self.assertFalse(MyDBDavResource('/a/b/').rehash())
+
+    def test_copy_collection(self):
+        with self.assertNumQueries(19):
+            MyDBDavResource('/a/').copy(MyDBDavResource('/e/'))
+        paths = sorted(r.get_path() for r in MyDBDavResource('/e/').get_descendants(depth=-1))
+        self.assertEqual(paths, ['/e/', '/e/a.txt', '/e/b/', '/e/b/b.txt', '/e/b/c/', '/e/b/c/c.txt', '/e/d/'])
+        self.assertEqual(ObjectModel.objects.filter(name='c.txt').count(), 2)
+        self.assertTrue(MyDBDavResource('/a/b/c/c.txt').exists)
+
+    def test_copy_collection_depth(self):
+        MyDBDavResource('/a/').copy(MyDBDavResource('/e/'), depth=1)
+        paths = sorted(r.get_path() for r in MyDBDavResource('/e/').get_descendants(depth=-1))
+        self.assertEqual(paths, ['/e/', '/e/a.txt', '/e/b/', '/e/d/'])
+
+    def test_move_collection(self):
+        c = MyDBDavResource('/a/b/c/c.txt').obj
+        with self.assertNumQueries(6):
+            MyDBDavResource('/a/b/').move(MyDBDavResource('/e/'))
+        self.assertFalse(MyDBDavResource('/a/b/').exists)
+        self.assertEqual(MyDBDavResource('/e/c/c.txt').obj.pk, c.pk)
+
+    def test_delete_collection(self):
+        resource = MyDBDavResource('/a/')
+        resource.obj
+        with self.assertNumQueries(9 + DELETE_EXTRA_QUERIES):
+            resource.delete()
+        self.assertEqual(list(CollectionModel.objects.values_list('name', flat=True)), [])
+        self.assertEqual(list(ObjectModel.objects.values_list('name', flat=True)), ['top.txt'])
+
+    def test_get_descendants_batched(self):
+        resource = MyDBDavResource('/')
+        resource.descendants_batch_size = 1
+        with self.assertNumQueries(10):
+            paths = sorted(r.get_path() for r in resource.get_descendants(depth=-1))
+        self.assertEqual(len(paths), 9)
+
+
+class TestPathLookupDBDavResource(TestCase):
+    def setUp(self):
+        a = PathCollectionModel.objects.create(name='a', path='a')
+        b = PathCollectionModel.objects.create(name='b', parent=a, path='a/b')
+        self.c = PathCollectionModel.objects.create(name='c', parent=b, path='a/b/c')
+        self.obj = PathObjectModel.objects.create(name='c.txt', parent=self.c, path='a/b/c/c.txt')
+
+    def test_lookup(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(MyPathDBDavResource('/a/b/c/c.txt').obj, self.obj)
+        with self.assertNumQueries(1):
+            self.assertEqual(MyPathDBDavResource('/a/b/c/').obj, self.c)
+
+    def test_lookup_hash(self):
+        resource = MyPathDBDavResource('/a/b/c/c.txt')
+        resource.path_hash = True
+        self.assertEqual(resource.get_path_value(), 'a61a43f6b114a07bd686983e404b829e82c54b68')
+
+    def test_create_collection(self):
+        MyPathDBDavResource('/a/b/c/d/').create_collection()
+        self.assertEqual(MyPathDBDavResource('/a/b/c/d/').obj.parent, self.c)
+
+    def test_move_collection(self):
+        MyPathDBDavResource('/a/b/').move(MyPathDBDavResource('/a/e/'))
+        self.assertFalse(MyPathDBDavResource('/a/b/c/c.txt').exists)
+        moved = MyPathDBDavResource('/a/e/c/c.txt')
+        self.assertEqual(moved.obj.pk, self.obj.pk)
+        self.assertEqual(moved.obj.parent.path, 'a/e/c')
+
+    def test_move_collection_paths(self):
+        MyPathDBDavResource('/a/b/').move(MyPathDBDavResource('/e/'))
+        self.assertEqual(sorted(PathCollectionModel.objects.values_list('path', flat=True)), ['a', 'e', 'e/c'])
+        self.assertEqual(PathObjectModel.objects.get(pk=self.obj.pk).path, 'e/c/c.txt')
+
+    def test_move_collection_case(self):
+        A = PathCollectionModel.objects.create(name='A', path='A')
+        PathCollectionModel.objects.create(name='sub', parent=A, path='A/sub')
+        PathObjectModel.objects.create(name='f', parent=A, path='A/f')
+        MyPathDBDavResource('/a/').move(MyPathDBDavResource('/e/'))
+        self.assertEqual(sorted(PathCollectionModel.objects.values_list('path', flat=True)), [
+            'A', 'A/sub', 'e', 'e/b', 'e/b/c'
+        ])
+        self.assertEqual(sorted(PathObjectModel.objects.values_list('path', flat=True)), ['A/f', 'e/b/c/c.txt'])
+
+    def test_move_collection_hash(self):
+        MyPathDBDavResource.path_hash = True
+        try:
+            for model in (PathCollectionModel, PathObjectModel):
+                for row in model.objects.all():
+                    model.objects.filter(pk=row.pk).update(path=MyPathDBDavResource('/').get_path_value(row.path.split('/')))
+            MyPathDBDavResource('/a/').move(MyPathDBDavResource('/e/'))
+            self.assertEqual(MyPathDBDavResource('/e/b/c/c.txt').obj.pk, self.obj.pk)
+            self.assertFalse(MyPathDBDavResource('/a/b/c/c.txt').exists)
+        finally:
+            MyPathDBDavResource.path_hash = False
+
+    def test_delete_collection(self):
+        resource = MyPathDBDavResource('/a/b/')
+        resource.obj
+        with self.assertNumQueries(7 + DELETE_EXTRA_QUERIES):
+            resource.delete()
+        self.assertEqual(list(PathCollectionModel.objects.values_list('path', flat=True)), ['a'])
+        self.assertFalse(PathObjectModel.objects.exists())
+
+    def test_delete_collection_case(self):
+        A = PathCollectionModel.objects.create(name='A', path='A')
+        PathCollectionModel.objects.create(name='sub', parent=A, path='A/sub')
+        PathObjectModel.objects.create(name='f', parent=A, path='A/f')
+        MyPathDBDavResource('/a/').delete()
+        self.assertEqual(sorted(PathCollectionModel.objects.values_list('path', flat=True)), ['A', 'A/sub'])
+        self.assertEqual(list(PathObjectModel.objects.values_list('path', flat=True)), ['A/f'])
+
+    def test_copy_collection(self):
+        MyPathDBDavResource('/a/b/').copy(MyPathDBDavResource('/e/'))
+        self.assertEqual(sorted(PathCollectionModel.objects.values_list('path', flat=True)), [
+            'a', 'a/b', 'a/b/c', 'e', 'e/c'
+        ])
+        self.assertEqual(MyPathDBDavResource('/e/c/c.txt').obj.parent.path, 'e/c')
+
+    def test_copy_object(self):
+        MyPathDBDavResource('/a/b/c/c.txt').copy(MyPathDBDavResource('/a/copy.txt'))
+        self.assertEqual(MyPathDBDavResource('/a/copy.txt').obj.parent.path, 'a')
+        self.assertTrue(MyPathDBDavResource('/a/b/c/c.txt').exists)
+
+
+class TestPathCache(TestCase):
+    class CachedDBDavResource(MyDBDavResource):
+        path_cache = None
+
+    def setUp(self):
+        self.CachedDBDavResource.path_cache = LRUPathCache(max_size=2)
+        a = CollectionModel.objects.create(name='a')
+        b = CollectionModel.objects.create(name='b', parent=a)
+        self.obj = ObjectModel.objects.create(name='b.txt', parent=b)
+
+    def test_lru(self):
+        cache = LRUPathCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_lookup(self):
+        cache = self.CachedDBDavResource.path_cache
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_stale(self):
+        cache = self.CachedDBDavResource.path_cache
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        ObjectModel.objects.filter(pk=self.obj.pk).update(modified=now())
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_move_collection(self):
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.CachedDBDavResource('/a/b/').move(self.CachedDBDavResource('/c/'))
+        self.assertFalse(self.CachedDBDavResource('/a/b/b.txt').exists)
+        self.assertEqual(self.CachedDBDavResource('/c/b.txt').obj.pk, self.obj.pk)
+
+    def test_delete(self):
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.CachedDBDavResource('/a/b/b.txt').delete()
+        self.assertFalse(self.CachedDBDavResource('/a/b/b.txt').exists)
+
+
+    def test_renamed(self):
+        self.assertEqual(self.CachedDBDavResource('/a/b/b.txt').obj, self.obj)
+        ObjectModel.objects.filter(pk=self.obj.pk).update(name='c.txt')
+        self.assertFalse(self.CachedDBDavResource('/a/b/b.txt').exists)
+
+
+class TestPathLookupPathCache(TestCase):
+    class CachedPathDBDavResource(MyPathDBDavResource):
+        path_cache = None
+
+    class OtherCachedPathDBDavResource(MyPathDBDavResource):
+        path_cache = None  # Another process
+
+    def setUp(self):
+        self.CachedPathDBDavResource.path_cache = LRUPathCache()
+        self.OtherCachedPathDBDavResource.path_cache = LRUPathCache()
+        a = PathCollectionModel.objects.create(name='a', path='a')
+        b = PathCollectionModel.objects.create(name='b', parent=a, path='a/b')
+        self.obj = PathObjectModel.objects.create(name='b.txt', parent=b, path='a/b/b.txt')
+
+    def test_ancestor_moved(self):
+        self.assertEqual(self.CachedPathDBDavResource('/a/b/b.txt').obj, self.obj)
+        self.assertTrue(self.CachedPathDBDavResource('/a/b/').exists)
+        self.OtherCachedPathDBDavResource('/a/b/').move(self.OtherCachedPathDBDavResource('/a/c/'))
+        self.assertFalse(self.CachedPathDBDavResource('/a/b/b.txt').exists)
+        self.assertFalse(self.CachedPathDBDavResource('/a/b/').exists)
+        self.assertEqual(self.CachedPathDBDavResource('/a/c/b.txt').obj.pk, self.obj.pk)
+
+
+class TestDjangoPathCache(TestCase):
+    def test_clear(self):
+        cache = DjangoPathCache(prefix='test')
+        cache.set('a', ('object', 1, None))
+        self.assertEqual(cache.get('a'), ('object', 1, None))
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+
+
+class TestMissingPathCache(TestCase):
+    class CachedDBDavResource(MyDBDavResource):
+        missing_path_cache = None
+
+    def setUp(self):
+        self.CachedDBDavResource.missing_path_cache = LRUPathCache(timeout=5)
+        CollectionModel.objects.create(name='a')
+
+    def test_missing(self):
+        cache = self.CachedDBDavResource.missing_path_cache
+        self.assertFalse(self.CachedDBDavResource('/a/desktop.ini').exists)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.CachedDBDavResource('/a/desktop.ini').exists)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_scopes(self):
+        class ScopedDBDavResource(self.CachedDBDavResource):
+            path_cache = LRUPathCache()
+            scope = None
+
+            def get_model_lookup_kwargs(self, **kwargs):
+                kwargs['created'] = self.scope
+                return super(ScopedDBDavResource, self).get_model_lookup_kwargs(**kwargs)
+
+        first = type('FirstScope', (ScopedDBDavResource,), {'scope': now() - timedelta(days=1)})
+        second = type('SecondScope', (ScopedDBDavResource,), {'scope': now()})
+        obj = ObjectModel.objects.create(name='x.txt', created=second.scope)
+        self.assertFalse(first('/x.txt').exists)
+        self.assertEqual(second('/x.txt').obj, obj)
+        self.assertFalse(first('/x.txt').exists)
+
+    def test_expired(self):
+        self.assertFalse(self.CachedDBDavResource('/a/desktop.ini').exists)
+        self.CachedDBDavResource.missing_path_cache.timeout = -1
+        self.CachedDBDavResource('/a/Thumbs.db').exists
+        with self.assertNumQueries(2):
+            self.assertFalse(self.CachedDBDavResource('/a/Thumbs.db').exists)
+
+    def test_create_collection(self):
+        self.assertFalse(self.CachedDBDavResource('/a/b/').exists)
+        self.CachedDBDavResource('/a/b/').create_collection()
+        self.assertTrue(self.CachedDBDavResource('/a/b/').exists)
+
+    def test_invalidate(self):
+        resource = self.CachedDBDavResource('/a/b.txt')
+        self.assertFalse(resource.exists)
+        ObjectModel.objects.create(name='b.txt', parent=CollectionModel.objects.get(name='a'))
+        self.assertFalse(self.CachedDBDavResource('/a/b.txt').exists)
+        resource.invalidate()
+        self.assertTrue(self.CachedDBDavResource('/a/b.txt').exists)
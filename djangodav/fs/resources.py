@@ -18,24 +18,117 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import errno
 import hashlib
 import mimetypes
+import sys
 from sys import getfilesystemencoding
 import os
 import datetime
 import shutil
+import threading
+import time
 import urllib
+from stat import S_IMODE, S_ISDIR, S_ISREG
+from uuid import uuid4
 
 from django.http import HttpResponse
+from django.utils.encoding import force_bytes
+from django.utils.functional import cached_property
 from django.utils.http import http_date
 
 from djangodav.base.resources import BaseDavResource
 from djangodav.responses import ResponseException
-from djangodav.utils import safe_join, url_join
+from djangodav.utils import safe_join, url_join, UploadStream, RangeFile
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 fs_encoding = getfilesystemencoding()
 
+replace = getattr(os, 'replace', os.rename)  # Python < 3.3 has atomic rename on POSIX only
+
+FICLONE = 0x40049409  # Linux ioctl sharing the extents of a file (reflink) on btrfs, xfs and others
+
+FAST_COPY_UNSUPPORTED = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+    errno.EBADF,
+)
+
+COPY_ERROR_STATUSES = {
+    errno.EACCES: 403,
+    errno.EPERM: 403,
+    errno.EROFS: 403,
+    errno.ENOSPC: 507,
+    getattr(errno, 'EDQUOT', errno.ENOSPC): 507,
+}
+
+
+def copy_file(src, dst, chunk_size=1024 * 1024):
+    """Copy the content and permission bits of the src file to dst. Returns the name of the method
+    which completed the copy, see copy_file_content."""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            method = copy_file_content(fsrc, fdst, chunk_size)
+    shutil.copymode(src, dst)
+    return method
+
+
+def copy_file_content(fsrc, fdst, chunk_size=1024 * 1024):
+    """Copy without moving the bytes through userspace where possible: a reflink clone, then
+    copy_file_range, which lets network and copy on write file systems copy server side, then
+    sendfile and finally plain reads and writes. Each method continues where the previous one
+    stopped when the file systems don't support it."""
+    in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(out_fd, FICLONE, in_fd)
+            return 'reflink'
+        except (IOError, OSError):
+            pass
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                copied = os.copy_file_range(in_fd, out_fd, chunk_size, offset, offset)
+                if not copied:
+                    return 'copy_file_range'
+                offset += copied
+        except OSError as e:
+            if e.errno not in FAST_COPY_UNSUPPORTED:
+                raise
+    if hasattr(os, 'sendfile'):
+        os.lseek(out_fd, offset, os.SEEK_SET)
+        try:
+            while True:
+                copied = os.sendfile(out_fd, in_fd, offset, chunk_size)
+                if not copied:
+                    return 'sendfile'
+                offset += copied
+        except OSError as e:
+            if e.errno not in FAST_COPY_UNSUPPORTED:
+                raise
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    shutil.copyfileobj(fsrc, fdst, chunk_size)
+    return 'read'
+
 
 class BaseFSDavResource(BaseDavResource):
     """Implements an interface to the file system. This can be subclassed to provide
@@ -43,6 +136,16 @@ class BaseFSDavResource(BaseDavResource):
     python's os library to do most of the work."""
 
     root = None
+    sort_children = False
+    copy_workers = 4  # Threads copying the files of a collection, 0 copies them one by one
+    copy_queue_size = 64
+    trash_root = None  # Directory on the same file system deleted collections are moved to before removal
+    temp_prefix = None  # Name prefix of temporary files, left out of the children
+
+    def __init__(self, path, **kwargs):
+        # Accepting os.scandir entry to reduce stat calls
+        self.entry = kwargs.pop('entry', None)
+        super(BaseFSDavResource, self).__init__(path)
 
     def get_abs_path(self):
         """Return the absolute path of the resource. Used internally to interface with
@@ -50,45 +153,78 @@ class BaseFSDavResource(BaseDavResource):
         be used."""
         return os.path.join(self.root, *self.path)
 
+    @cached_property
+    def stat(self):
+        """Return the os.stat result of the resource or None if it doesn't exist. The result is
+        cached for the lifetime of the resource instance, call invalidate_stat after changes."""
+        try:
+            if self.entry is not None:
+                return self.entry.stat()
+            return os.stat(self.get_abs_path())
+        except OSError:
+            return None
+
+    def invalidate_stat(self):
+        self.entry = None
+        self.__dict__.pop('stat', None)
+
+    def invalidate(self):
+        self.invalidate_stat()
+
     @property
     def getcontentlength(self):
         """Return the size of the resource in bytes."""
-        return os.path.getsize(self.get_abs_path())
+        return self.stat.st_size
 
     def get_created(self):
         """Return the create time as datetime object."""
-        return datetime.datetime.fromtimestamp(os.stat(self.get_abs_path()).st_ctime)
+        return datetime.datetime.fromtimestamp(self.stat.st_ctime)
 
     def get_modified(self):
         """Return the modified time as datetime object."""
-        return datetime.datetime.fromtimestamp(os.stat(self.get_abs_path()).st_mtime)
+        return datetime.datetime.fromtimestamp(self.stat.st_mtime)
 
     @property
     def is_collection(self):
         """Return True if this resource is a directory (collection in WebDAV parlance)."""
-        return os.path.isdir(self.get_abs_path())
+        if self.entry is not None and 'stat' not in self.__dict__:
+            return self.entry.is_dir()
+        return self.stat is not None and S_ISDIR(self.stat.st_mode)
 
     @property
     def is_object(self):
         """Return True if this resource is a file (resource in WebDAV parlance)."""
-        return os.path.isfile(self.get_abs_path())
+        if self.entry is not None and 'stat' not in self.__dict__:
+            return self.entry.is_file()
+        return self.stat is not None and S_ISREG(self.stat.st_mode)
 
     @property
     def exists(self):
         """Return True if this resource exists."""
-        return os.path.exists(self.get_abs_path())
+        return self.stat is not None
 
     def get_children(self):
-        """Return an iterator of all direct children of this resource."""
-        if os.path.isdir(self.get_abs_path()):
-            for child in os.listdir(self.get_abs_path()):
-                try:
-                    is_unicode = isinstance(child, unicode)
-                except NameError:  # Python 3 fix
-                    is_unicode = isinstance(child, str)
-                if not is_unicode:
-                    child = child.decode(fs_encoding)
-                yield self.clone(url_join(*(self.path + [child])))
+        """Return an iterator of all direct children of this resource. Children are seeded with
+        their directory entries, so listing them doesn't require extra stat calls where the
+        platform provides file types along with names. Set sort_children to list them by name."""
+        if not self.is_collection:
+            return
+        if scandir is None:
+            entries = [(name, None) for name in os.listdir(self.get_abs_path())]
+        else:
+            entries = [(entry.name, entry) for entry in scandir(self.get_abs_path())]
+        if self.sort_children:
+            entries.sort(key=lambda e: e[0])
+        for child, entry in entries:
+            try:
+                is_unicode = isinstance(child, unicode)
+            except NameError:  # Python 3 fix
+                is_unicode = isinstance(child, str)
+            if not is_unicode:
+                child = child.decode(fs_encoding)
+            if self.temp_prefix and child.startswith(self.temp_prefix):
+                continue
+            yield self.clone(url_join(*(self.path + [child])), entry=entry)
 
     def write(self, content):
         raise NotImplementedError
@@ -97,23 +233,113 @@ class BaseFSDavResource(BaseDavResource):
         raise NotImplementedError
 
     def delete(self):
-        """Delete the resource, recursive is implied."""
+        """Delete the resource, recursive is implied. Collections are removed by shutil.rmtree, which
+        walks with directory file descriptor relative scandir and unlink calls where the platform
+        supports them. With trash_root set they are renamed into it and removed in the background."""
         if self.is_collection:
-            for child in self.get_children():
-                child.delete()
-            os.rmdir(self.get_abs_path())
+            if self.trash_root is None or not self.move_to_trash():
+                shutil.rmtree(self.get_abs_path())
         elif self.is_object:
             os.remove(self.get_abs_path())
+        self.invalidate_stat()
+
+    def move_to_trash(self):
+        """Rename the collection into trash_root and start removing it in a thread. Returns False if
+        it can't be renamed there, when trash_root is on another file system for example."""
+        trash_path = os.path.join(self.trash_root, uuid4().hex)
+        try:
+            os.rename(self.get_abs_path(), trash_path)
+        except OSError:
+            return False
+        thread = threading.Thread(target=shutil.rmtree, args=(trash_path, True), name='djangodav-trash')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    @classmethod
+    def empty_trash(cls):
+        """Remove what background deletions left in trash_root, when the process stopped before they
+        completed for example."""
+        for name in os.listdir(cls.trash_root):
+            shutil.rmtree(os.path.join(cls.trash_root, name), True)
 
     def create_collection(self):
         """Create a directory in the location of this resource."""
         os.mkdir(self.get_abs_path())
+        self.invalidate_stat()
+
+    def copy_collection(self, destination, depth=-1):
+        """Copy the tree level by level, creating directories as they are listed and handing files
+        to a pool of copy_workers threads, at most copy_queue_size of them queued at once. A member
+        which fails doesn't stop the copy, returns the (destination resource, status code) pairs of
+        the failed members, the descendants of a directory which couldn't be created are skipped."""
+        if ThreadPoolExecutor is None or not self.copy_workers:
+            executor = None
+        else:
+            executor = ThreadPoolExecutor(self.copy_workers)
+        errors, pending = [], set()
+        try:
+            levels = [(self, destination, depth)]
+            while levels:
+                source, target, depth = levels.pop()
+                if depth == 0:
+                    continue
+                for child in source.get_children():
+                    child_target = self.clone(safe_join(target.get_path(), child.displayname))
+                    if not child.is_collection:
+                        if executor is None:
+                            errors.append(self.copy_member(child, child_target))
+                            continue
+                        pending.add(executor.submit(self.copy_member, child, child_target))
+                        if len(pending) >= self.copy_queue_size:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            errors.extend(future.result() for future in done)
+                        continue
+                    try:
+                        if child_target.is_object:
+                            child_target.delete()
+                        if not child_target.is_collection:
+                            child_target.create_collection()
+                    except (IOError, OSError) as e:
+                        errors.append((child_target, self.get_copy_error_status(e)))
+                        continue
+                    levels.append((child, child_target, depth - 1))
+        finally:
+            if executor is not None:
+                errors.extend(future.result() for future in wait(pending).done)
+                executor.shutdown()
+        return sorted([error for error in errors if error], key=lambda error: error[0].get_path())
+
+    def copy_member(self, source, destination):
+        """Copy a file of a collection, returns None or the (destination, status code) failure."""
+        try:
+            if destination.is_object:
+                destination.delete()
+            source.copy_object(destination)
+        except (IOError, OSError) as e:
+            return destination, self.get_copy_error_status(e)
+
+    def get_copy_error_status(self, error):
+        return COPY_ERROR_STATUSES.get(error.errno, 500)
 
     def copy_object(self, destination, depth=0):
-        shutil.copy(self.get_abs_path(), destination.get_abs_path())
+        copy_file(self.get_abs_path(), destination.get_abs_path())
+        destination.invalidate_stat()
 
     def move_object(self, destination):
         os.rename(self.get_abs_path(), destination.get_abs_path())
+        self.invalidate_stat()
+        destination.invalidate_stat()
+
+    def move_collection(self, destination):
+        """Rename the directory over the empty one created by move, so it keeps its inode and
+        attributes. Children are moved one by one when that fails, across file systems for example."""
+        try:
+            replace(self.get_abs_path(), destination.get_abs_path())
+        except OSError:
+            return super(BaseFSDavResource, self).move_collection(destination)
+        self.invalidate_stat()
+        destination.invalidate_stat()
 
 
 class DummyReadFSDavResource(BaseFSDavResource):
@@ -121,11 +347,200 @@ class DummyReadFSDavResource(BaseFSDavResource):
         with open(self.get_abs_path(), 'rb') as f:
             return f.read()
 
+    def open_read(self):
+        return open(self.get_abs_path(), 'rb')
+
+    def read_range(self, start, end):
+        with open(self.get_abs_path(), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def open_range(self, start, end):
+        f = open(self.get_abs_path(), 'rb')
+        f.seek(start)
+        return RangeFile(f, end - start + 1)
+
 
 class DummyWriteFSDavResource(BaseFSDavResource):
+    write_chunk_size = 64 * 1024
+    temp_prefix = '.davupload-'
+
     def write(self, request):
-        with open(self.get_abs_path(), 'wb') as dst:
-            shutil.copyfileobj(request, dst)
+        """Spool the content to a temporary file next to the resource and atomically replace the
+        resource with it once complete, so readers never see a partially written file. Returns the
+        UploadStream holding size and md5 of the written content."""
+        upload = UploadStream(request, self.write_chunk_size)
+        path = self.get_abs_path()
+        try:
+            mode = S_IMODE(os.stat(path).st_mode)  # Kept by the replacing file
+        except OSError:
+            mode = None
+        temp_path = os.path.join(os.path.dirname(path), self.temp_prefix + uuid4().hex)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for chunk in upload:
+                    dst.write(chunk)
+            if mode is not None:
+                os.chmod(temp_path, mode)
+            replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.invalidate_stat()
+        return upload
+
+    @classmethod
+    def remove_stale_uploads(cls, max_age=24 * 3600):
+        """Remove temporary files older than max_age seconds, left behind by processes killed while
+        writing."""
+        limit = time.time() - max_age
+        for dirpath, dirnames, filenames in os.walk(cls.root):
+            for name in filenames:
+                if not name.startswith(cls.temp_prefix):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.lstat(path).st_mtime < limit:
+                        os.remove(path)
+                except OSError:  # Completed or removed meanwhile
+                    pass
+
+
+class StoredEtagFSMixIn(object):
+    """Serves strong ETags from the md5 of the content computed while it is written. The digest is
+    stored along with the inode, mtime and size it was computed for, in the etag_xattr user
+    extended attribute or, when etag_sidecar_root is set, in a sidecar file below that directory.
+    Files changed outside WebDAV get a metadata based ETag until `manage.py davrehash` hashes them."""
+    cheap_etag = True
+    etag_xattr = 'user.djangodav.etag'
+    etag_sidecar_root = None
+    rehash_chunk_size = 64 * 1024
+
+    def invalidate_stat(self):
+        super(StoredEtagFSMixIn, self).invalidate_stat()
+        self.__dict__.pop('stored_etag', None)
+
+    def get_etag_key(self):
+        stat = self.stat
+        mtime = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1000000000)
+        return '%d:%d:%d' % (stat.st_ino, mtime, stat.st_size)
+
+    def get_etag_sidecar_path(self):
+        return os.path.join(self.etag_sidecar_root, hashlib.md5(force_bytes("/".join(self.path))).hexdigest())
+
+    def load_etag_record(self):
+        try:
+            if self.etag_sidecar_root is not None:
+                with open(self.get_etag_sidecar_path(), 'rb') as f:
+                    return f.read().decode('ascii')
+            if hasattr(os, 'getxattr'):
+                return os.getxattr(self.get_abs_path(), self.etag_xattr).decode('ascii')
+        except (IOError, OSError, UnicodeDecodeError):
+            pass
+        return None
+
+    def store_etag(self, digest):
+        """Persist the content digest for the current state of the file."""
+        self.invalidate_stat()
+        record = ('%s %s' % (self.get_etag_key(), digest)).encode('ascii')
+        if self.etag_sidecar_root is not None:
+            path = self.get_etag_sidecar_path()
+            temp_path = path + '.' + uuid4().hex
+            with open(temp_path, 'wb') as f:
+                f.write(record)
+            replace(temp_path, path)
+        elif hasattr(os, 'setxattr'):
+            try:
+                os.setxattr(self.get_abs_path(), self.etag_xattr, record)
+            except OSError:  # File system without user xattr support
+                return
+        self.__dict__['stored_etag'] = digest
+
+    def delete_etag(self):
+        if self.etag_sidecar_root is not None:
+            try:
+                os.remove(self.get_etag_sidecar_path())
+            except OSError:
+                pass
+
+    @cached_property
+    def stored_etag(self):
+        """The persisted digest if it is still valid for the file, None otherwise."""
+        if not self.is_object:
+            return None
+        record = self.load_etag_record()
+        if not record or ' ' not in record:
+            return None
+        key, digest = record.split(' ', 1)
+        if key != self.get_etag_key():
+            return None
+        return digest
+
+    @property
+    def getetag(self):
+        if self.stored_etag:
+            return self.stored_etag
+        return hashlib.md5(force_bytes(self.get_etag_key())).hexdigest()
+
+    def write(self, request):
+        upload = super(StoredEtagFSMixIn, self).write(request)
+        self.store_etag(upload.md5)
+        return upload
+
+    def rehash(self, force=False):
+        """Hash the content of a file without a valid stored digest. Returns True if a digest was
+        stored, False if it was valid already or the file changed while being hashed."""
+        if not self.is_object or (self.stored_etag and not force):
+            return False
+        key = self.get_etag_key()
+        hashsum = hashlib.md5()
+        with open(self.get_abs_path(), 'rb') as f:
+            for chunk in iter(lambda: f.read(self.rehash_chunk_size), b''):
+                hashsum.update(chunk)
+        self.invalidate_stat()
+        if not self.exists or self.get_etag_key() != key:
+            return False
+        self.store_etag(hashsum.hexdigest())
+        return True
+
+    def delete(self):
+        if self.etag_sidecar_root is not None and self.is_collection:
+            # Sidecars are named after the path of the file, they have to be found before the files go
+            for root, dirs, files in os.walk(self.get_abs_path()):
+                for name in files:
+                    path = os.path.relpath(os.path.join(root, name), self.root).replace(os.sep, '/')
+                    self.clone(path).delete_etag()
+        super(StoredEtagFSMixIn, self).delete()
+        self.delete_etag()
+
+    def copy_object(self, destination, depth=0):
+        digest = self.stored_etag
+        super(StoredEtagFSMixIn, self).copy_object(destination, depth)
+        if digest:
+            destination.store_etag(digest)
+
+    def move_object(self, destination):
+        digest = self.stored_etag
+        super(StoredEtagFSMixIn, self).move_object(destination)
+        self.delete_etag()
+        if digest:
+            destination.store_etag(digest)
+
+    def move_collection(self, destination):
+        super(StoredEtagFSMixIn, self).move_collection(destination)
+        if self.etag_sidecar_root is None:
+            return
+        # Sidecars are named after the paths of the files, a renamed directory leaves them behind
+        for root, dirs, files in os.walk(destination.get_abs_path()):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), destination.get_abs_path()).split(os.sep)
+                source = self.clone(url_join(*(self.path + path)))
+                target = destination.clone(url_join(*(destination.path + path)))
+                try:
+                    os.rename(source.get_etag_sidecar_path(), target.get_etag_sidecar_path())
+                except OSError:  # Not hashed or moved along with its file
+                    pass
 
 
 class DummyFSDAVResource(DummyReadFSDavResource, DummyWriteFSDavResource, BaseFSDavResource):
@@ -18,9 +18,22 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import os
+import shutil
+import tempfile
+from stat import S_IFDIR, S_IFREG
+from django.core.management import call_command
 from django.test import TestCase
-from djangodav.fs.resources import BaseFSDavResource
-from mock import patch
+from io import BytesIO
+try:
+    from StringIO import StringIO  # call_command writes native strings on Python 2
+except ImportError:
+    from io import StringIO
+from djangodav.fs.resources import BaseFSDavResource, DummyReadFSDavResource, DummyWriteFSDavResource, \
+    DummyFSDAVResource, StoredEtagFSMixIn, copy_file
+from djangodav.utils import UploadStream
+from mock import patch, Mock
 
 
 class TestFSDavResource(TestCase):
@@ -31,38 +44,343 @@ class TestFSDavResource(TestCase):
     def setUp(self):
         self.resource = self.FSDavResource("/path/to/name")
 
-    @patch('djangodav.fs.resources.os.path.isdir')
-    def test_is_collection(self, isdir):
-        isdir.return_value = True
+    @patch('djangodav.fs.resources.os.stat')
+    def test_is_collection(self, stat):
+        stat.return_value = os.stat_result((S_IFDIR, 0, 0, 0, 0, 0, 0, 0, 0, 0))
         self.assertTrue(self.resource.is_collection)
-        isdir.assert_called_with('/some/folder/path/to/name')
+        self.assertFalse(self.resource.is_object)
+        stat.assert_called_once_with('/some/folder/path/to/name')
 
-    @patch('djangodav.fs.resources.os.path.isfile')
-    def test_isfile(self, isfile):
-        isfile.return_value = True
+    @patch('djangodav.fs.resources.os.stat')
+    def test_is_object(self, stat):
+        stat.return_value = os.stat_result((S_IFREG, 0, 0, 0, 0, 0, 0, 0, 0, 0))
         self.assertTrue(self.resource.is_object)
-        isfile.assert_called_with('/some/folder/path/to/name')
+        self.assertFalse(self.resource.is_collection)
+        stat.assert_called_once_with('/some/folder/path/to/name')
 
-    @patch('djangodav.fs.resources.os.path.exists')
-    def test_isfile(self, exists):
-        exists.return_value = True
+    @patch('djangodav.fs.resources.os.stat')
+    def test_exists(self, stat):
+        stat.return_value = os.stat_result((S_IFREG, 0, 0, 0, 0, 0, 0, 0, 0, 0))
         self.assertTrue(self.resource.exists)
-        exists.assert_called_with('/some/folder/path/to/name')
+        stat.assert_called_once_with('/some/folder/path/to/name')
 
-    @patch('djangodav.fs.resources.os.path.getsize')
-    def test_get_size(self, getsize):
-        getsize.return_value = 42
+    @patch('djangodav.fs.resources.os.stat')
+    def test_missing(self, stat):
+        stat.side_effect = OSError()
+        self.assertFalse(self.resource.exists)
+        self.assertFalse(self.resource.is_collection)
+        self.assertFalse(self.resource.is_object)
+        stat.assert_called_once_with('/some/folder/path/to/name')
+
+    @patch('djangodav.fs.resources.os.stat')
+    def test_get_size(self, stat):
+        stat.return_value = os.stat_result((S_IFREG, 0, 0, 0, 0, 0, 42, 0, 0, 0))
         self.assertEquals(self.resource.getcontentlength, 42)
-        getsize.assert_called_with('/some/folder/path/to/name')
+        stat.assert_called_once_with('/some/folder/path/to/name')
+
+    @patch('djangodav.fs.resources.os.stat')
+    def test_invalidate_stat(self, stat):
+        stat.return_value = os.stat_result((S_IFREG, 0, 0, 0, 0, 0, 42, 0, 0, 0))
+        self.assertTrue(self.resource.exists)
+        self.resource.invalidate_stat()
+        self.assertTrue(self.resource.exists)
+        self.assertEqual(stat.call_count, 2)
 
     def test_get_abs_path(self):
         self.assertEquals(self.resource.get_abs_path(), '/some/folder/path/to/name')
 
-    @patch('djangodav.fs.resources.os.path.isdir')
-    @patch('djangodav.fs.resources.os.listdir')
-    def test_get_children(self, listdir, isdir):
-        listdir.return_value=['child1', 'child2']
+    @patch('djangodav.fs.resources.os.stat')
+    @patch('djangodav.fs.resources.scandir')
+    def test_get_children(self, scandir, stat):
+        stat.return_value = os.stat_result((S_IFDIR, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        child1 = Mock(is_dir=Mock(return_value=True))
+        child1.name = 'child1'
+        child2 = Mock(is_dir=Mock(return_value=False))
+        child2.name = 'child2'
+        scandir.return_value = [child2, child1]
         children = list(self.resource.get_children())
-        self.assertEqual(children[0].path, ['path', 'to', 'name', 'child1'])
-        self.assertEqual(children[1].path, ['path', 'to', 'name', 'child2'])
-        listdir.assert_called_with('/some/folder/path/to/name')
+        self.assertEqual(children[0].path, ['path', 'to', 'name', 'child2'])
+        self.assertEqual(children[1].path, ['path', 'to', 'name', 'child1'])
+        self.assertFalse(children[0].is_collection)
+        self.assertTrue(children[1].is_collection)
+        scandir.assert_called_with('/some/folder/path/to/name')
+        stat.assert_called_once_with('/some/folder/path/to/name')
+
+    @patch('djangodav.fs.resources.os.stat')
+    @patch('djangodav.fs.resources.scandir')
+    def test_get_children_sorted(self, scandir, stat):
+        stat.return_value = os.stat_result((S_IFDIR, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        child1, child2 = Mock(), Mock()
+        child1.name, child2.name = 'child1', 'child2'
+        scandir.return_value = [child2, child1]
+        self.resource.sort_children = True
+        children = list(self.resource.get_children())
+        self.assertEqual([c.displayname for c in children], ['child1', 'child2'])
+
+
+class TestDummyReadFSDavResource(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'file.txt'), 'wb') as f:
+            f.write(b'0123456789')
+
+        class FSDavResource(DummyReadFSDavResource):
+            root = self.root
+
+        self.resource = FSDavResource('/file.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_range(self):
+        self.assertEqual(self.resource.read_range(2, 4), b'234')
+        self.assertEqual(self.resource.read_range(8, 9), b'89')
+
+    def test_open_range(self):
+        f = self.resource.open_range(2, 4)
+        self.assertEqual(f.read(2), b'23')
+        self.assertEqual(f.read(), b'4')
+        self.assertEqual(f.read(), b'')
+        f.close()
+
+    def test_iter_read(self):
+        self.assertEqual(list(self.resource.iter_read(4)), [b'0123', b'4567', b'89'])
+
+
+class TestDummyWriteFSDavResource(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+        class FSDavResource(DummyWriteFSDavResource):
+            root = self.root
+            write_chunk_size = 4
+
+        self.resource = FSDavResource('/file.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_write(self):
+        self.assertFalse(self.resource.exists)
+        upload = self.resource.write(BytesIO(b'0123456789'))
+        self.assertEqual(upload.size, 10)
+        self.assertEqual(upload.md5, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertTrue(self.resource.exists)
+        self.assertEqual(os.listdir(self.root), ['file.txt'])
+        with open(os.path.join(self.root, 'file.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+
+    def test_write_failure(self):
+        with open(os.path.join(self.root, 'file.txt'), 'wb') as f:
+            f.write(b'old')
+        self.assertRaises(IOError, self.resource.write, Mock(read=Mock(side_effect=[b'new', IOError()])))
+        self.assertEqual(os.listdir(self.root), ['file.txt'])
+        with open(os.path.join(self.root, 'file.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+
+    def test_write_keeps_mode(self):
+        with open(os.path.join(self.root, 'file.txt'), 'wb') as f:
+            f.write(b'old')
+        os.chmod(os.path.join(self.root, 'file.txt'), 0o640)
+        self.resource.write(BytesIO(b'new'))
+        self.assertEqual(os.stat(os.path.join(self.root, 'file.txt')).st_mode & 0o777, 0o640)
+
+    def test_temp_files_hidden(self):
+        self.resource.write(BytesIO(b'new'))
+        open(os.path.join(self.root, '.davupload-0123'), 'wb').close()
+        children = list(self.resource.clone('/').get_children())
+        self.assertEqual([child.get_path() for child in children], ['/file.txt'])
+
+    def test_remove_stale_uploads(self):
+        os.mkdir(os.path.join(self.root, 'dir'))
+        stale = os.path.join(self.root, 'dir', '.davupload-0123')
+        open(stale, 'wb').close()
+        os.utime(stale, (0, 0))
+        open(os.path.join(self.root, '.davupload-4567'), 'wb').close()
+        self.resource.remove_stale_uploads()
+        self.assertEqual(os.listdir(os.path.join(self.root, 'dir')), [])
+        self.assertEqual(sorted(os.listdir(self.root)), ['.davupload-4567', 'dir'])
+
+
+class TestStoredEtagFSMixIn(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sidecar_root = tempfile.mkdtemp()
+
+        class FSDavResource(StoredEtagFSMixIn, DummyFSDAVResource):
+            root = self.root
+            etag_sidecar_root = self.sidecar_root
+
+        self.resource_class = FSDavResource
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.sidecar_root)
+
+    def test_write(self):
+        self.resource_class('/file.txt').write(BytesIO(b'0123456789'))
+        self.assertEqual(self.resource_class('/file.txt').getetag, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertEqual(len(os.listdir(self.sidecar_root)), 1)
+
+    def test_changed_outside(self):
+        resource = self.resource_class('/file.txt')
+        resource.write(BytesIO(b'0123456789'))
+        with open(os.path.join(self.root, 'file.txt'), 'ab') as f:
+            f.write(b'A')
+        resource = self.resource_class('/file.txt')
+        self.assertIsNone(resource.stored_etag)
+        self.assertNotEqual(resource.getetag, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertTrue(resource.rehash())
+        self.assertEqual(self.resource_class('/file.txt').getetag, 'c8e7279cd035b23bb9c0f1f954dff5b3')
+        self.assertFalse(self.resource_class('/file.txt').rehash())
+
+    def test_copy_move_delete(self):
+        self.resource_class('/file.txt').write(BytesIO(b'0123456789'))
+        self.resource_class('/file.txt').copy_object(self.resource_class('/copy.txt'))
+        self.assertEqual(self.resource_class('/copy.txt').stored_etag, '781e5e245d69b566979b86e28d23f2c7')
+        self.resource_class('/copy.txt').move_object(self.resource_class('/moved.txt'))
+        self.assertEqual(self.resource_class('/moved.txt').stored_etag, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertEqual(len(os.listdir(self.sidecar_root)), 2)
+        self.resource_class('/moved.txt').delete()
+        self.assertEqual(len(os.listdir(self.sidecar_root)), 1)
+
+    def test_delete_collection(self):
+        os.mkdir(os.path.join(self.root, 'dir'))
+        self.resource_class('/dir/file.txt').write(BytesIO(b'0123456789'))
+        self.resource_class('/dir/').delete()
+        self.assertEqual(os.listdir(self.sidecar_root), [])
+
+    def test_move_collection(self):
+        os.makedirs(os.path.join(self.root, 'dir', 'sub'))
+        self.resource_class('/dir/sub/file.txt').write(BytesIO(b'0123456789'))
+        self.resource_class('/dir/').move(self.resource_class('/moved/'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'dir')))
+        self.assertEqual(self.resource_class('/moved/sub/file.txt').stored_etag, '781e5e245d69b566979b86e28d23f2c7')
+        self.assertEqual(len(os.listdir(self.sidecar_root)), 1)
+
+    def test_xattr(self):
+        self.resource_class.etag_sidecar_root = None
+        resource = self.resource_class('/file.txt')
+        resource.write(BytesIO(b'0123456789'))
+        if resource.load_etag_record() is None:
+            self.skipTest('No user xattr support')
+        self.assertEqual(self.resource_class('/file.txt').stored_etag, '781e5e245d69b566979b86e28d23f2c7')
+
+    def test_rehash_command(self):
+        os.mkdir(os.path.join(self.root, 'dir'))
+        for name in ('a.txt', 'dir/b.txt'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(b'0123456789')
+        with patch('djangodav.management.commands.davrehash.import_string', Mock(return_value=self.resource_class)):
+            out = StringIO()
+            call_command('davrehash', 'samples.Resource', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Rehashed 2 of 2 objects.')
+        self.assertEqual(self.resource_class('/dir/b.txt').stored_etag, '781e5e245d69b566979b86e28d23f2c7')
+
+
+class TestCopy(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ('a', 'a/b', 'a/b/c', 'a/d'):
+            os.mkdir(os.path.join(self.root, name))
+        for name in ('a/1.txt', 'a/b/2.txt', 'a/b/c/3.txt', 'a/d/4.txt'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(name.encode('ascii') * 1000)
+
+        class FSDavResource(DummyFSDAVResource):
+            root = self.root
+
+        self.resource_class = FSDavResource
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return f.read()
+
+    def test_copy_file(self):
+        src, dst = os.path.join(self.root, 'a/1.txt'), os.path.join(self.root, 'copy.txt')
+        os.chmod(src, 0o640)
+        copy_file(src, dst, chunk_size=100)
+        self.assertEqual(self.read('copy.txt'), b'a/1.txt' * 1000)
+        self.assertEqual(os.stat(dst).st_mode & 0o777, 0o640)
+
+    @patch('djangodav.fs.resources.fcntl', None)
+    def test_copy_file_fallback(self):
+        src, dst = os.path.join(self.root, 'a/1.txt'), os.path.join(self.root, 'copy.txt')
+        unsupported = Mock(side_effect=OSError(errno.EXDEV, 'Cross-device link'))
+        with patch('os.copy_file_range', unsupported, create=True):
+            self.assertEqual(copy_file(src, dst, chunk_size=100), 'sendfile' if hasattr(os, 'sendfile') else 'read')
+            self.assertEqual(self.read('copy.txt'), b'a/1.txt' * 1000)
+            with patch('os.sendfile', unsupported, create=True):
+                self.assertEqual(copy_file(src, dst, chunk_size=100), 'read')
+        self.assertEqual(self.read('copy.txt'), b'a/1.txt' * 1000)
+
+    def test_copy_collection(self):
+        for workers in (0, 2):
+            self.resource_class.copy_workers = workers
+            self.resource_class.copy_queue_size = 1
+            shutil.rmtree(os.path.join(self.root, 'copy'), ignore_errors=True)
+            errors = self.resource_class('/a/').copy(self.resource_class('/copy/'))
+            self.assertEqual(errors, [])
+            for name in ('1.txt', 'b/2.txt', 'b/c/3.txt', 'd/4.txt'):
+                self.assertEqual(self.read('copy/' + name), self.read('a/' + name))
+
+    def test_copy_collection_depth(self):
+        self.resource_class('/a/').copy(self.resource_class('/copy/'), depth=1)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'copy'))), ['1.txt', 'b', 'd'])
+        self.assertEqual(os.listdir(os.path.join(self.root, 'copy/b')), [])
+
+    def test_delete_collection(self):
+        with patch('djangodav.fs.resources.os.stat', Mock(wraps=os.stat)) as stat:
+            self.resource_class('/a/').delete()
+        self.assertEqual(stat.call_count, 1)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_delete_collection_trash(self):
+        self.resource_class.trash_root = os.path.join(self.root, 'trash')
+        os.mkdir(self.resource_class.trash_root)
+        with patch('djangodav.fs.resources.threading.Thread') as thread:
+            resource = self.resource_class('/a/')
+            resource.delete()
+        self.assertFalse(resource.exists)
+        trash_path = os.path.join(self.resource_class.trash_root, os.listdir(self.resource_class.trash_root)[0])
+        thread.assert_called_once_with(target=shutil.rmtree, args=(trash_path, True), name='djangodav-trash')
+        self.assertTrue(thread.return_value.start.called)
+        self.resource_class.empty_trash()
+        self.assertEqual(os.listdir(self.resource_class.trash_root), [])
+
+    def test_copy_collection_errors(self):
+        copy_object = DummyFSDAVResource.copy_object
+
+        def failing_copy_object(resource, destination, depth=0):
+            if resource.displayname == '2.txt':
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            copy_object(resource, destination)
+
+        create_collection = DummyFSDAVResource.create_collection
+
+        def failing_create_collection(resource):
+            if resource.displayname == 'd':
+                raise OSError(errno.EACCES, 'Permission denied')
+            create_collection(resource)
+
+        with patch.object(self.resource_class, 'copy_object', failing_copy_object), \
+                patch.object(self.resource_class, 'create_collection', failing_create_collection):
+            errors = self.resource_class('/a/').copy(self.resource_class('/copy/'))
+        self.assertEqual([(resource.get_path(), status) for resource, status in errors], [
+            ('/copy/b/2.txt', 507), ('/copy/d', 403)
+        ])
+        self.assertEqual(self.read('copy/b/c/3.txt'), self.read('a/b/c/3.txt'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'copy/d')))
+
+
+class TestUploadStream(TestCase):
+    def test_chunks(self):
+        data = BytesIO(b'0123456789')
+        stream = Mock(read=Mock(side_effect=lambda size: data.read(min(size, 3))))  # short reads
+        upload = UploadStream(stream, chunk_size=4)
+        self.assertEqual(list(upload), [b'0123', b'4567', b'89'])
+        self.assertEqual(upload.size, 10)
+        self.assertEqual(upload.md5, '781e5e245d69b566979b86e28d23f2c7')
@@ -0,0 +1,217 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import socket
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class NullMetrics(object):
+    """Metrics of a view without instrumentation, every call is a no-op."""
+    enabled = False
+    queries = bytes_read = bytes_written = 0
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class RequestMetrics(object):
+    """Collects the time spent in each phase of a request, the number of database queries and
+    the bytes read from and written to the storage. Phases nest, the time of an inner phase is
+    not counted for the outer one."""
+    enabled = True
+
+    def __init__(self):
+        self.phases = {}
+        self.queries = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        self.total = None
+        self.stack = []
+        self.connections = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        now = default_timer()
+        if self.stack:
+            self.add(self.stack[-1][0], now - self.stack[-1][1])
+        self.stack.append([name, now])
+        try:
+            yield self
+        finally:
+            name, started = self.stack.pop()
+            now = default_timer()
+            self.add(name, now - started)
+            if self.stack:
+                self.stack[-1][1] = now
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def start(self):
+        self.started = default_timer()
+        # Queries are counted with Django >= 2.0 only, older ones have no execute_wrappers
+        self.connections = [c for c in connections.all() if hasattr(c, 'execute_wrappers')]
+        for connection in self.connections:
+            connection.execute_wrappers.append(self.count_query)
+
+    def finish(self):
+        """Stop counting queries and timing the request, further calls do nothing."""
+        for connection in self.connections:
+            if self.count_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self.count_query)
+        self.connections = []
+        if self.total is None and self.started is not None:
+            self.total = default_timer() - self.started
+
+    def elapsed(self):
+        return self.total if self.total is not None else default_timer() - self.started
+
+    def iter_stream(self, chunks, name, callback):
+        """Wrap the chunks of a streaming response, timing their production as the name phase and
+        calling callback once they are exhausted or the response is closed."""
+        chunks = iter(chunks)
+        try:
+            while True:
+                with self.phase(name):
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        break
+                yield chunk
+        finally:
+            callback()
+
+    def server_timing(self):
+        """Value of the Server-Timing header, durations are in milliseconds."""
+        metrics = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in sorted(self.phases.items())]
+        metrics.append('total;dur=%.3f' % (self.elapsed() * 1000))
+        metrics.append('db;desc="%d queries"' % self.queries)
+        metrics.append('io;desc="%d read, %d written"' % (self.bytes_read, self.bytes_written))
+        return ', '.join(metrics)
+
+
+class BaseMetricsSink(object):
+    """Receives the metrics of every instrumented request, set them in DavView.metrics_sinks."""
+
+    def emit(self, view, request, response, metrics):
+        raise NotImplementedError()
+
+
+class MemoryMetricsSink(BaseMetricsSink):
+    """Keeps (method, status code, metrics) of the requests, mostly useful for tests."""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, view, request, response, metrics):
+        self.records.append((request.method, response.status_code, metrics))
+
+
+class StatsdMetricsSink(BaseMetricsSink):
+    """Sends the metrics to a statsd server over UDP as timers and counters named
+    <prefix>.<method>.<metric>. Send errors are ignored, metrics never fail a request."""
+
+    def __init__(self, host='localhost', port=8125, prefix='djangodav'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, request, metrics):
+        prefix = '%s.%s' % (self.prefix, request.method.lower())
+        lines = ['%s.%s:%.3f|ms' % (prefix, name, seconds * 1000) for name, seconds in sorted(metrics.phases.items())]
+        lines.append('%s.total:%.3f|ms' % (prefix, metrics.elapsed() * 1000))
+        lines.append('%s.queries:%d|c' % (prefix, metrics.queries))
+        lines.append('%s.bytes_read:%d|c' % (prefix, metrics.bytes_read))
+        lines.append('%s.bytes_written:%d|c' % (prefix, metrics.bytes_written))
+        return '\n'.join(lines).encode('ascii')
+
+    def emit(self, view, request, response, metrics):
+        try:
+            self.socket.sendto(self.format(request, metrics), self.address)
+        except (socket.error, OSError):
+            pass
+
+
+class PrometheusMetricsSink(BaseMetricsSink):
+    """Records the metrics in prometheus_client histograms and counters labelled by method,
+    expose them with the usual prometheus_client exporters."""
+
+    def __init__(self, namespace='djangodav', registry=None):
+        if prometheus_client is None:
+            raise ImproperlyConfigured('PrometheusMetricsSink requires the prometheus_client package')
+        kwargs = {'namespace': namespace}
+        if registry is not None:
+            kwargs['registry'] = registry
+        self.phase_seconds = prometheus_client.Histogram(
+            'phase_seconds', 'Time spent in each phase of a request', ['method', 'phase'], **kwargs
+        )
+        self.request_seconds = prometheus_client.Histogram(
+            'request_seconds', 'Time spent on a request', ['method', 'status'], **kwargs
+        )
+        self.queries = prometheus_client.Histogram(
+            'queries', 'Database queries of a request', ['method'],
+            buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')), **kwargs
+        )
+        self.storage_bytes = prometheus_client.Counter(
+            'storage_bytes', 'Bytes read from and written to the storage', ['method', 'direction'], **kwargs
+        )
+
+    def emit(self, view, request, response, metrics):
+        method = request.method
+        for name, seconds in metrics.phases.items():
+            self.phase_seconds.labels(method, name).observe(seconds)
+        self.request_seconds.labels(method, str(response.status_code)).observe(metrics.elapsed())
+        self.queries.labels(method).observe(metrics.queries)
+        self.storage_bytes.labels(method, 'read').inc(metrics.bytes_read)
+        self.storage_bytes.labels(method, 'written').inc(metrics.bytes_written)
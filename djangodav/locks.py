@@ -18,22 +18,391 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+from datetime import timedelta
+from threading import Lock
+from time import time
 from uuid import uuid4
 
+from django.db import transaction
+from django.db.models import Q
 from django.utils.encoding import force_text
+from django.utils.timezone import now
 
 from djangodav.base.locks import BaseLock
+from djangodav.utils import lazy_model, parse_lock_token, prefix_lookup
 
 
 class DummyLock(BaseLock):
+    stateful = False
+
     def get(self, *args, **kwargs):
         pass
 
     def acquire(self, *args, **kwargs):
         return force_text(uuid4())
 
+    def refresh(self, token, timeout):
+        return None
+
     def release(self, token):
         return True
 
     def del_locks(self):
         pass
+
+
+class ModelLock(BaseLock):
+    """Locks kept in the database by DavLock model, so they are shared between all processes.
+    Conflicts are checked with one indexed query covering the resource, its ancestors and, for
+    depth infinity locks, its descendants. Acquisitions of all processes are serialized by the
+    write lock of the guard_model row."""
+    model = lazy_model('djangodav.models.DavLock')
+    guard_model = lazy_model('djangodav.models.DavLockGuard')
+
+    def get_lock_path(self):
+        return "/".join(self.resource.path)
+
+    def get_ancestor_paths(self):
+        path = self.resource.path
+        return ["/".join(path[:i]) for i in range(len(path))]
+
+    def get_queryset(self):
+        return self.model.objects.filter(expires__gt=now())
+
+    def get_covering_q(self):
+        """Locks applying to the resource: its own ones and depth infinity locks of ancestors."""
+        return Q(path=self.get_lock_path()) | Q(path__in=self.get_ancestor_paths(), depth=-1)
+
+    def get_descendants_lookup(self):
+        """Return the annotations and the Q object selecting locks of the descendants."""
+        path = self.get_lock_path()
+        if not path:
+            return {}, ~Q(path='')
+        return prefix_lookup('path', path + '/')
+
+    def get(self):
+        return list(self.get_queryset().filter(self.get_covering_q()))
+
+    def get_subtree(self):
+        annotations, q = self.get_descendants_lookup()
+        return list(self.get_queryset().annotate(**annotations).filter(self.get_covering_q() | q))
+
+    @classmethod
+    def get_many(cls, resources):
+        locks = [cls(resource) for resource in resources]
+        if not locks:
+            return []
+        q = Q()
+        for lock in locks:
+            q |= lock.get_covering_q()
+        found = list(locks[0].get_queryset().filter(q))
+        result = []
+        for lock in locks:
+            path, ancestors = lock.get_lock_path(), set(lock.get_ancestor_paths())
+            result.append([l for l in found if l.path == path or (l.depth == -1 and l.path in ancestors)])
+        return result
+
+    def lock_guard(self):
+        """Take the write lock of the guard row until the end of the transaction. An UPDATE rather
+        than SELECT FOR UPDATE, which SQLite ignores."""
+        guard = self.guard_model.objects.filter(pk=1)
+        if not guard.update(acquired=now()):
+            self.guard_model.objects.get_or_create(pk=1)
+            guard.update(acquired=now())
+
+    def acquire(self, lockscope, locktype, depth, timeout, owner):
+        annotations, q = {}, self.get_covering_q()
+        if depth != 0:
+            annotations, descendants_q = self.get_descendants_lookup()
+            q |= descendants_q
+        conflicts = self.get_queryset().annotate(**annotations).filter(q)
+        if lockscope != 'exclusive':
+            conflicts = conflicts.filter(scope='exclusive')
+        with transaction.atomic():
+            # Concurrent acquisitions would both find no conflict and both insert their lock
+            self.lock_guard()
+            if conflicts.exists():
+                return None
+            token = force_text(uuid4())
+            self.model.objects.create(
+                token=token,
+                path=self.get_lock_path(),
+                scope=lockscope,
+                type=locktype,
+                depth=depth,
+                owner=owner,
+                timeout=timeout,
+                expires=now() + timedelta(seconds=timeout)
+            )
+        return token
+
+    def refresh(self, token, timeout):
+        lock = self.get_queryset().filter(self.get_covering_q(), token=parse_lock_token(token)).first()
+        if lock is None:
+            return None
+        lock.timeout = timeout
+        lock.expires = now() + timedelta(seconds=timeout)
+        lock.save(update_fields=['timeout', 'expires'])
+        return lock
+
+    def release(self, token):
+        deleted, _ = self.model.objects.filter(self.get_covering_q(), token=parse_lock_token(token)).delete()
+        return bool(deleted)
+
+    def del_locks(self):
+        annotations, q = self.get_descendants_lookup()
+        self.model.objects.annotate(**annotations).filter(Q(path=self.get_lock_path()) | q).delete()
+
+    @classmethod
+    def delete_expired(cls):
+        """Bulk deletes all expired locks. Returns the number of deleted locks."""
+        deleted, _ = cls.model.objects.filter(expires__lte=now()).delete()
+        return deleted
+
+
+class ActiveLock(object):
+    def __init__(self, token, path, scope, type, depth, owner, timeout, expires):
+        self.token = token
+        self.path = path
+        self.scope = scope
+        self.type = type
+        self.depth = depth
+        self.owner = owner
+        self.timeout = timeout
+        self.expires = expires
+
+    def to_dict(self):
+        return dict(self.__dict__, path=list(self.path))
+
+
+class LockTableNode(object):
+    __slots__ = ('children', 'locks', 'count', 'exclusive')
+
+    def __init__(self):
+        self.children = {}
+        self.locks = {}
+        self.count = 0  # Locks in the subtree, including own ones
+        self.exclusive = 0  # Exclusive locks in the subtree, including own ones
+
+
+class LockTable(object):
+    """Process local lock storage. Locks are kept in a trie keyed on resource path segments
+    whose nodes count the locks of their subtrees, so ancestor and descendant conflicts are
+    checked in O(depth). Expired locks are evicted through a timer wheel of slots seconds
+    (resolution seconds per slot). Reads don't take the table lock. When snapshot_path is
+    given, locks are saved there after every change and loaded back on start."""
+
+    def __init__(self, snapshot_path=None, slots=512, resolution=1):
+        self.root = LockTableNode()
+        self.tokens = {}
+        self.lock = Lock()
+        self.slots = slots
+        self.resolution = resolution
+        self.wheel = [set() for i in range(slots)]
+        self.tick = int(time() // resolution)
+        self.snapshot_path = snapshot_path
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load()
+
+    def get_slot(self, expires):
+        return int(expires // self.resolution) % self.slots
+
+    def get(self, path):
+        """Return active locks applying to the path: its own ones and depth infinity locks
+        of its ancestors."""
+        timestamp = time()
+        locks = []
+        node = self.root
+        for i in range(len(path) + 1):
+            locks += [lock for lock in list(node.locks.values())
+                      if lock.expires > timestamp and (i == len(path) or lock.depth == -1)]
+            if i == len(path):
+                break
+            node = node.children.get(path[i])
+            if node is None:
+                break
+        return locks
+
+    def get_subtree(self, path):
+        """Return active locks applying to the path and the locks of its descendants."""
+        locks = self.get(path)
+        node = self.root
+        for name in path:
+            node = node.children.get(name)
+            if node is None:
+                return locks
+        timestamp = time()
+        stack = list(node.children.values())
+        while stack:
+            node = stack.pop()
+            locks += [lock for lock in list(node.locks.values()) if lock.expires > timestamp]
+            stack += list(node.children.values())
+        return locks
+
+    def get_token(self, path, token):
+        lock = self.tokens.get(token)
+        if lock is None or lock.expires <= time():
+            return None
+        if list(path[:len(lock.path)]) != list(lock.path):
+            return None
+        if len(path) != len(lock.path) and lock.depth != -1:
+            return None
+        return lock
+
+    def has_conflicts(self, path, scope, depth):
+        exclusive = scope == 'exclusive'
+        node = self.root
+        for i in range(len(path) + 1):
+            own = list(node.locks.values())
+            if i == len(path):
+                if any(exclusive or lock.scope == 'exclusive' for lock in own):
+                    return True
+                if depth == -1:
+                    own_exclusive = len([lock for lock in own if lock.scope == 'exclusive'])
+                    if exclusive and node.count > len(own):
+                        return True
+                    if node.exclusive > own_exclusive:
+                        return True
+                return False
+            if any(lock.depth == -1 and (exclusive or lock.scope == 'exclusive') for lock in own):
+                return True
+            node = node.children.get(path[i])
+            if node is None:
+                return False
+
+    def acquire(self, path, scope, type, depth, timeout, owner):
+        with self.lock:
+            self.evict()
+            if self.has_conflicts(path, scope, depth):
+                return None
+            lock = ActiveLock(force_text(uuid4()), tuple(path), scope, type, depth, owner, timeout, time() + timeout)
+            self.add(lock)
+            self.save()
+        return lock.token
+
+    def refresh(self, path, token, timeout):
+        with self.lock:
+            lock = self.get_token(path, token)
+            if lock is None:
+                return None
+            lock.timeout = timeout
+            lock.expires = time() + timeout
+            self.wheel[self.get_slot(lock.expires)].add(lock.token)
+            self.save()
+        return lock
+
+    def release(self, path, token):
+        with self.lock:
+            lock = self.get_token(path, token)
+            if lock is None:
+                return False
+            self.remove(lock)
+            self.save()
+        return True
+
+    def delete(self, path):
+        """Remove all locks of the path and its descendants."""
+        with self.lock:
+            node = self.root
+            for name in path:
+                node = node.children.get(name)
+                if node is None:
+                    return
+            stack, locks = [node], []
+            while stack:
+                node = stack.pop()
+                locks += list(node.locks.values())
+                stack += list(node.children.values())
+            for lock in locks:
+                self.remove(lock)
+            self.save()
+
+    def add(self, lock):
+        node = self.root
+        nodes = [node]
+        for name in lock.path:
+            node = node.children.setdefault(name, LockTableNode())
+            nodes.append(node)
+        for node in nodes:
+            node.count += 1
+            node.exclusive += lock.scope == 'exclusive'
+        node.locks[lock.token] = lock
+        self.tokens[lock.token] = lock
+        self.wheel[self.get_slot(lock.expires)].add(lock.token)
+
+    def remove(self, lock):
+        node = self.root
+        nodes = [(None, None, node)]
+        for name in lock.path:
+            parent, node = node, node.children[name]
+            nodes.append((parent, name, node))
+        node.locks.pop(lock.token)
+        for parent, name, node in reversed(nodes):
+            node.count -= 1
+            node.exclusive -= lock.scope == 'exclusive'
+            if parent is not None and not node.count:
+                del parent.children[name]
+        self.tokens.pop(lock.token)
+
+    def evict(self):
+        """Remove expired locks of the wheel slots passed since the last call."""
+        timestamp = time()
+        tick = int(timestamp // self.resolution)
+        if tick - self.tick >= self.slots:
+            slots = range(self.slots)
+        else:
+            slots = [t % self.slots for t in range(self.tick, tick + 1)]
+        for slot in slots:
+            for token in list(self.wheel[slot]):
+                lock = self.tokens.get(token)
+                if lock is not None and lock.expires <= timestamp:
+                    self.remove(lock)
+                elif lock is not None and self.get_slot(lock.expires) == slot:
+                    continue  # Expires in a later round of the wheel
+                self.wheel[slot].discard(token)  # Expired, released or refreshed since
+        self.tick = tick
+
+    def save(self):
+        if not self.snapshot_path:
+            return
+        temp_path = '%s.%s' % (self.snapshot_path, uuid4().hex)
+        with open(temp_path, 'w') as f:
+            json.dump([lock.to_dict() for lock in self.tokens.values()], f)
+        getattr(os, 'replace', os.rename)(temp_path, self.snapshot_path)
+
+    def load(self):
+        with open(self.snapshot_path) as f:
+            data = json.load(f)
+        timestamp = time()
+        for values in data:
+            values['path'] = tuple(values['path'])
+            lock = ActiveLock(**values)
+            if lock.expires > timestamp:
+                self.add(lock)
+
+
+class MemoryLock(BaseLock):
+    """Locks kept in a process local LockTable, for single process deployments where a
+    database round-trip per lock check is wasted work. Assign a LockTable with snapshot_path
+    to table to keep locks over restarts."""
+    table = LockTable()
+
+    def get(self):
+        return self.table.get(self.resource.path)
+
+    def get_subtree(self):
+        return self.table.get_subtree(self.resource.path)
+
+    def acquire(self, lockscope, locktype, depth, timeout, owner):
+        return self.table.acquire(self.resource.path, lockscope, locktype, depth, timeout, owner)
+
+    def refresh(self, token, timeout):
+        return self.table.refresh(self.resource.path, parse_lock_token(token), timeout)
+
+    def release(self, token):
+        return self.table.release(self.resource.path, parse_lock_token(token))
+
+    def del_locks(self):
+        self.table.delete(self.resource.path)
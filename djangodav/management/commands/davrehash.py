@@ -0,0 +1,42 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = 'Stores content digests served as ETags for objects written outside WebDAV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource_class', help='Dotted path of the resource class, like samples.fs.resources.MyResource.')
+        parser.add_argument('paths', nargs='*', default=['/'], help='Collections or objects to rehash recursively.')
+        parser.add_argument('--force', action='store_true', help='Rehash objects with a valid digest too.')
+
+    def handle(self, *args, **options):
+        resource_class = import_string(options['resource_class'])
+        total = rehashed = 0
+        for path in options['paths']:
+            for resource in resource_class(path).get_descendants(depth=-1):
+                if not resource.is_object:
+                    continue
+                total += 1
+                rehashed += resource.rehash(force=options['force'])
+        self.stdout.write('Rehashed %d of %d objects.' % (rehashed, total))
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DavLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('path', models.CharField(max_length=1024)),
+                ('scope', models.CharField(max_length=16)),
+                ('type', models.CharField(max_length=16)),
+                ('depth', models.SmallIntegerField(default=0)),
+                ('owner', models.TextField(blank=True, null=True)),
+                ('timeout', models.PositiveIntegerField()),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='davlock',
+            index=models.Index(fields=['path', 'expires'], name='djangodav_d_path_1f3e42_idx'),
+        ),
+    ]
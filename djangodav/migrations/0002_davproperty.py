@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangodav', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DavProperty',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024)),
+                ('name', models.CharField(max_length=255)),
+                ('value', models.TextField()),
+            ],
+            options={
+                'unique_together': {('path', 'name')},
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangodav', '0002_davproperty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DavLockGuard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('acquired', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
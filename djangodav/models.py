@@ -18,3 +18,37 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+from django.db import models
+
+
+class DavLock(models.Model):
+    """Lock stored for ModelLock. Path is the resource path without leading and trailing
+    slashes, depth is 0 or -1 for infinity."""
+    token = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=1024)
+    scope = models.CharField(max_length=16)
+    type = models.CharField(max_length=16)
+    depth = models.SmallIntegerField(default=0)
+    owner = models.TextField(blank=True, null=True)
+    timeout = models.PositiveIntegerField()
+    expires = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['path', 'expires'])]
+
+
+class DavLockGuard(models.Model):
+    """Single row updated by ModelLock.acquire, holding its write lock serializes lock acquisitions
+    of all processes."""
+    acquired = models.DateTimeField(null=True)
+
+
+class DavProperty(models.Model):
+    """Dead property stored for ModelPropertyStore. Path is the resource path without leading and
+    trailing slashes, name the Clark notation tag and value the serialized XML element."""
+    path = models.CharField(max_length=1024)
+    name = models.CharField(max_length=255)
+    value = models.TextField()
+
+    class Meta:
+        unique_together = (('path', 'name'),)
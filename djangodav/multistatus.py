@@ -0,0 +1,108 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import re
+
+from lxml import etree
+from django.utils.encoding import force_text
+
+PATTERN_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class MultistatusWriter(object):
+    """Writes PROPFIND multistatus bodies from fragments serialized once, escaping only the per
+    resource values. The output is byte for byte what lxml gives for the equivalent D.multistatus
+    tree serialized with xml_declaration and without pretty printing."""
+    status = 'HTTP/1.1 200 OK'
+    max_cached_tags = 1024
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.tags = {}
+        self.header = self.encode(u"<?xml version='1.0' encoding='%s'?>\n<D:multistatus xmlns:D=\"DAV:\">" % encoding)
+        self.footer = self.encode(u'</D:multistatus>')
+        self.response_start = self.encode(u'<D:response><D:href>')
+        self.prop_start = self.encode(u'</D:href><D:propstat><D:prop>')
+        self.response_end = self.encode(
+            u'</D:prop><D:status>%s</D:status></D:propstat></D:response>' % self.status
+        )
+        self.resourcetype = (
+            self.encode(u'<D:resourcetype/>'),
+            self.encode(u'<D:resourcetype><D:collection/></D:resourcetype>'),
+        )
+
+    def encode(self, value):
+        return value.encode(self.encoding, 'xmlcharrefreplace')
+
+    def escape(self, value):
+        value = force_text(value)
+        if PATTERN_XML_INVALID.search(value):
+            raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+        return self.encode(value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;'))
+
+    def get_tag(self, name):
+        """Return the start, end and empty element fragments of a DAV: element."""
+        try:
+            return self.tags[name]
+        except KeyError:
+            pass
+        tag = tuple(self.encode(t % name) for t in (u'<D:%s>', u'</D:%s>', u'<D:%s/>'))
+        if len(self.tags) < self.max_cached_tags:  # Names come from requests
+            self.tags[name] = tag
+        return tag
+
+    def response(self, href, props, names):
+        """Serialize a response for the props dict given by get_properties, like
+        D.response(D.href(href), D.propstat(D.prop(*build_property_tag_list(props, names)), ...))."""
+        parts = [self.response_start, self.escape(href), self.prop_start]
+        for name in names:
+            if name not in props:
+                continue
+            if name == 'resourcetype':
+                parts.append(self.resourcetype[bool(props[name])])
+                continue
+            start, end, empty = self.get_tag(name)
+            parts += [start, self.escape(props[name]), end]
+        parts.append(self.response_end)
+        return b''.join(parts)
+
+    def propname_response(self, href, names):
+        parts = [self.response_start, self.escape(href), self.prop_start]
+        parts += [self.get_tag(name)[2] for name in names]
+        parts.append(self.response_end)
+        return b''.join(parts)
+
+    def element(self, element):
+        """Serialize a D.response element built with lxml, for responses with content that has no
+        template like dead properties."""
+        # Standalone, the element declares the DAV: namespace the multistatus root declares in a tree
+        return etree.tostring(element, encoding=self.encoding).replace(b' xmlns:D="DAV:"', b'', 1)
+
+
+_writers = {}
+
+
+def get_multistatus_writer(encoding='utf-8'):
+    """Return a shared MultistatusWriter, so fragments are only built once per encoding."""
+    try:
+        return _writers[encoding]
+    except KeyError:
+        writer = _writers[encoding] = MultistatusWriter(encoding)
+        return writer
@@ -0,0 +1,157 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import os
+from hashlib import md5
+
+from django.db import transaction
+from django.db.models import CharField, Q, Value
+from django.db.models.functions import Concat, Substr
+from django.utils.encoding import force_bytes
+
+from djangodav.base.properties import BasePropertyStore
+from djangodav.utils import lazy_model, prefix_lookup
+
+
+def relocate_path(path, source, destination):
+    """Replaces the source prefix of a slash separated path with destination."""
+    rest = path[len(source):].lstrip('/')
+    return "/".join(p for p in (destination, rest) if p)
+
+
+class ModelPropertyStore(BasePropertyStore):
+    """Dead properties kept in the database by DavProperty model. Properties of a whole PROPFIND
+    batch are fetched with one query, subtrees are moved with one UPDATE."""
+    model = lazy_model('djangodav.models.DavProperty')
+    batch_size = 500
+
+    def get_path(self, resource=None):
+        return "/".join((resource or self.resource).path)
+
+    def get_subtree(self, path):
+        """Return the properties of path and its descendants, paths compared case sensitively."""
+        if not path:
+            return self.model.objects.all()
+        annotations, q = prefix_lookup('path', path + '/')
+        return self.model.objects.annotate(**annotations).filter(Q(path=path) | q)
+
+    def get(self, names=None):
+        return self.get_many([self.resource], names)[0]
+
+    @classmethod
+    def get_many(cls, resources, names=None):
+        paths = ["/".join(resource.path) for resource in resources]
+        if names is not None and not names:
+            return [{} for path in paths]
+        qs = cls.model.objects.filter(path__in=set(paths))
+        if names is not None:
+            qs = qs.filter(name__in=names)
+        props = {}
+        for path, name, value in qs.values_list('path', 'name', 'value'):
+            props.setdefault(path, {})[name] = value
+        return [dict(props.get(path, {})) for path in paths]
+
+    def update(self, set_props, remove_names):
+        path = self.get_path()
+        with transaction.atomic():
+            names = list(set_props) + list(remove_names)
+            if names:
+                self.model.objects.filter(path=path, name__in=names).delete()
+            self.model.objects.bulk_create(
+                [self.model(path=path, name=name, value=value) for name, value in set_props.items()]
+            )
+
+    def delete(self):
+        self.get_subtree(self.get_path()).delete()
+
+    def copy(self, destination):
+        source, destination = self.get_path(), self.get_path(destination)
+        props = self.get_subtree(source).values_list('path', 'name', 'value')
+        with transaction.atomic():
+            self.get_subtree(destination).delete()
+            self.model.objects.bulk_create([
+                self.model(path=relocate_path(path, source, destination), name=name, value=value)
+                for path, name, value in props.iterator()
+            ], batch_size=self.batch_size)
+
+    def move(self, destination):
+        source, destination = self.get_path(), self.get_path(destination)
+        with transaction.atomic():
+            self.get_subtree(destination).delete()
+            self.get_subtree(source).update(
+                path=Concat(Value(destination), Substr('path', len(source) + 1), output_field=CharField())
+            )
+
+
+class XattrPropertyStore(BasePropertyStore):
+    """Dead properties kept in user extended attributes of the files of FS resources, so renames
+    carry them along. Needs a file system with user xattr support."""
+    prefix = 'user.davprop.'
+
+    def get_attribute(self, name):
+        return self.prefix + md5(force_bytes(name)).hexdigest()
+
+    def get(self, names=None):
+        path = self.resource.get_abs_path()
+        try:
+            if names is None:
+                attributes = [a for a in os.listxattr(path) if a.startswith(self.prefix)]
+            else:
+                attributes = [self.get_attribute(name) for name in names]
+        except OSError:
+            return {}
+        props = {}
+        for attribute in attributes:
+            try:
+                value = os.getxattr(path, attribute).decode('utf-8')
+            except OSError:
+                continue
+            name, _, value = value.partition('\n')  # Attribute names are hashes, values lead with the name
+            props[name] = value
+        return props
+
+    def update(self, set_props, remove_names):
+        path = self.resource.get_abs_path()
+        for name, value in set_props.items():
+            os.setxattr(path, self.get_attribute(name), force_bytes(name + '\n' + value))
+        for name in remove_names:
+            try:
+                os.removexattr(path, self.get_attribute(name))
+            except OSError:
+                pass
+
+    def copy_attributes(self, source, destination):
+        for attribute in os.listxattr(source):
+            if attribute.startswith(self.prefix):
+                os.setxattr(destination, attribute, os.getxattr(source, attribute))
+
+    def delete(self):
+        pass  # Gone with the files
+
+    def copy(self, destination):
+        source, destination = self.resource.get_abs_path(), destination.get_abs_path()
+        self.copy_attributes(source, destination)
+        for root, dirs, files in os.walk(source):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                self.copy_attributes(path, os.path.join(destination, os.path.relpath(path, source)))
+
+    def move(self, destination):
+        pass  # Renamed with the directories and files by FS resources
@@ -23,7 +23,7 @@ try:
     import httplib
 except ImportError:
     from http import client as httplib
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
 
 
 # When possible, code returns an HTTPResponse sub-class. In some situations, we want to be able
@@ -41,6 +41,22 @@ class ResponseException(Exception):
         self.response = response
 
 
+class HttpResponsePartialContent(HttpResponse):
+    status_code = httplib.PARTIAL_CONTENT
+
+
+class FileResponsePartialContent(FileResponse):
+    status_code = httplib.PARTIAL_CONTENT
+
+
+class StreamingHttpResponsePartialContent(StreamingHttpResponse):
+    status_code = httplib.PARTIAL_CONTENT
+
+
+class HttpResponseRequestedRangeNotSatisfiable(HttpResponse):
+    status_code = httplib.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
 class HttpResponsePreconditionFailed(HttpResponse):
     status_code = httplib.PRECONDITION_FAILED
 
@@ -53,6 +69,10 @@ class HttpResponseMultiStatus(HttpResponse):
     status_code = httplib.MULTI_STATUS
 
 
+class StreamingHttpResponseMultiStatus(StreamingHttpResponse):
+    status_code = httplib.MULTI_STATUS
+
+
 class HttpResponseNotImplemented(HttpResponse):
     status_code = httplib.NOT_IMPLEMENTED
 
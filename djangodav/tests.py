@@ -0,0 +1,355 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+try:
+    from StringIO import StringIO  # call_command writes native strings on Python 2
+except ImportError:
+    from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.timezone import now
+
+from djangodav.base.resources import BaseDavResource
+from djangodav.locks import ModelLock, MemoryLock, LockTable
+from djangodav.multistatus import MultistatusWriter
+from djangodav.properties import ModelPropertyStore, XattrPropertyStore
+from djangodav.fs.resources import DummyFSDAVResource
+from djangodav.models import DavLock, DavLockGuard, DavProperty
+from djangodav.utils import D, build_property_tag_list
+from lxml import etree
+from mock import patch
+
+
+class TestImports(TestCase):
+    def test_without_app(self):
+        code = ('import django; from django.conf import settings; settings.configure(); django.setup(); '
+                'from djangodav.locks import DummyLock; from djangodav.properties import XattrPropertyStore')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], env=env), 0)
+
+
+class TestModelLock(TestCase):
+    def lock(self, path):
+        return ModelLock(BaseDavResource(path))
+
+    def test_acquire_exclusive(self):
+        token = self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertTrue(token)
+        self.assertIsNone(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a/c').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertEqual([l.token for l in self.lock('/a/b').get()], [token])
+
+    def test_acquire_shared(self):
+        self.assertTrue(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'you'))
+        self.assertIsNone(self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertEqual(len(self.lock('/a/b').get()), 2)
+
+    def test_depth_infinity(self):
+        self.assertTrue(self.lock('/a').acquire('exclusive', 'write', -1, 600, 'me'))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.lock('/a/b/c').get()), 1)
+        self.assertIsNone(self.lock('/a/b/c').acquire('exclusive', 'write', 0, 600, 'me'))
+
+    def test_get_many(self):
+        a = self.lock('/a').acquire('exclusive', 'write', -1, 600, 'me')
+        b = self.lock('/b/c').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/b/c/d').acquire('exclusive', 'write', 0, 600, 'me')
+        with self.assertNumQueries(1):
+            locks = ModelLock.get_many([BaseDavResource('/a/x'), BaseDavResource('/b/c'), BaseDavResource('/b')])
+        self.assertEqual([[l.token for l in ls] for ls in locks], [[a], [b], []])
+
+    def test_depth_infinity_descendant_conflict(self):
+        self.assertTrue(self.lock('/a/b/c').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertIsNone(self.lock('/a').acquire('shared', 'write', -1, 600, 'me'))
+        self.assertIsNone(self.lock('/').acquire('shared', 'write', -1, 600, 'me'))
+
+    def test_expired(self):
+        token = self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me')
+        DavLock.objects.filter(token=token).update(expires=now() - timedelta(seconds=1))
+        self.assertEqual(self.lock('/a').get(), [])
+        self.assertIsNone(self.lock('/a').refresh('<opaquelocktoken:%s>' % token, 600))
+        self.assertTrue(self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me'))
+        out = StringIO()
+        call_command('davreaplocks', stdout=out)
+        self.assertEqual(out.getvalue(), 'Deleted 1 expired locks.\n')
+        self.assertEqual(DavLock.objects.count(), 1)
+
+    def test_refresh(self):
+        token = self.lock('/a').acquire('exclusive', 'write', -1, 1, 'me')
+        lock = self.lock('/a/b').refresh('<opaquelocktoken:%s>' % token, 600)
+        self.assertEqual(lock.timeout, 600)
+        self.assertGreater(DavLock.objects.get(token=token).expires, now() + timedelta(seconds=500))
+
+    def test_release(self):
+        token = self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertFalse(self.lock('/b').release('<opaquelocktoken:%s>' % token))
+        self.assertTrue(self.lock('/a').release('<opaquelocktoken:%s>' % token))
+        self.assertEqual(self.lock('/a').get(), [])
+
+    def test_del_locks(self):
+        self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/ab').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/A/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/a').del_locks()
+        self.assertEqual(sorted(DavLock.objects.values_list('path', flat=True)), ['A/b', 'ab'])
+
+    def test_get_subtree(self):
+        a = self.lock('/a').acquire('exclusive', 'write', -1, 600, 'me')
+        self.lock('/b/c').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/B/c').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertEqual([l.token for l in self.lock('/a/x').get_subtree()], [a])
+        self.assertEqual([l.path for l in self.lock('/b').get_subtree()], ['b/c'])
+
+    def test_acquire_guard(self):
+        self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertEqual(DavLockGuard.objects.count(), 1)
+        self.assertIsNotNone(DavLockGuard.objects.get().acquired)
+
+
+class TestMemoryLock(TestCase):
+    def setUp(self):
+        self.table = LockTable()
+
+    def lock(self, path):
+        return type('TestMemoryLock', (MemoryLock,), {'table': self.table})(BaseDavResource(path))
+
+    def test_acquire_exclusive(self):
+        token = self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertTrue(token)
+        self.assertIsNone(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a/c').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertEqual([l.token for l in self.lock('/a/b').get()], [token])
+
+    def test_acquire_shared(self):
+        self.assertTrue(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a/b').acquire('shared', 'write', 0, 600, 'you'))
+        self.assertIsNone(self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertEqual(len(self.lock('/a/b').get()), 2)
+
+    def test_depth_infinity(self):
+        self.assertTrue(self.lock('/a').acquire('exclusive', 'write', -1, 600, 'me'))
+        self.assertEqual(len(self.lock('/a/b/c').get()), 1)
+        self.assertIsNone(self.lock('/a/b/c').acquire('exclusive', 'write', 0, 600, 'me'))
+
+    def test_get_subtree(self):
+        a = self.lock('/a').acquire('exclusive', 'write', -1, 600, 'me')
+        c = self.lock('/b/c').acquire('exclusive', 'write', 0, 600, 'me')
+        self.assertEqual([l.token for l in self.lock('/a/x').get_subtree()], [a])
+        self.assertEqual([l.token for l in self.lock('/b').get_subtree()], [c])
+        self.assertEqual(self.lock('/d').get_subtree(), [])
+
+    def test_depth_infinity_descendant_conflict(self):
+        self.assertTrue(self.lock('/a/b/c').acquire('exclusive', 'write', 0, 600, 'me'))
+        self.assertTrue(self.lock('/a').acquire('shared', 'write', 0, 600, 'me'))
+        self.assertIsNone(self.lock('/a').acquire('shared', 'write', -1, 600, 'me'))
+        self.assertIsNone(self.lock('/').acquire('shared', 'write', -1, 600, 'me'))
+        self.assertTrue(self.lock('/b').acquire('shared', 'write', -1, 600, 'me'))
+
+    @patch('djangodav.locks.time')
+    def test_expired(self, time):
+        time.return_value = 1000.0
+        table = LockTable(slots=8)
+        lock = type('TestMemoryLock', (MemoryLock,), {'table': table})(BaseDavResource('/a'))
+        token = lock.acquire('exclusive', 'write', 0, 20, 'me')
+        time.return_value = 1015.0
+        self.assertEqual(len(lock.get()), 1)
+        table.evict()
+        self.assertIn(token, table.tokens)
+        time.return_value = 1021.0
+        self.assertEqual(lock.get(), [])
+        table.evict()
+        self.assertEqual(table.tokens, {})
+        self.assertEqual(table.root.children, {})
+
+    def test_refresh_release(self):
+        token = self.lock('/a').acquire('exclusive', 'write', -1, 1, 'me')
+        self.assertEqual(self.lock('/a/b').refresh('<opaquelocktoken:%s>' % token, 600).timeout, 600)
+        self.assertFalse(self.lock('/b').release('<opaquelocktoken:%s>' % token))
+        self.assertTrue(self.lock('/a/b').release('<opaquelocktoken:%s>' % token))
+        self.assertEqual(self.lock('/a').get(), [])
+        self.assertEqual(self.table.root.count, 0)
+
+    def test_del_locks(self):
+        self.lock('/a').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/a/b').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/ab').acquire('exclusive', 'write', 0, 600, 'me')
+        self.lock('/a').del_locks()
+        self.assertEqual([l.path for l in self.table.tokens.values()], [('ab',)])
+        self.assertEqual(self.table.root.count, 1)
+
+    def test_snapshot(self):
+        root = tempfile.mkdtemp()
+        try:
+            snapshot_path = os.path.join(root, 'locks.json')
+            lock_class = type('TestMemoryLock', (MemoryLock,), {'table': LockTable(snapshot_path)})
+            token = lock_class(BaseDavResource('/a')).acquire('exclusive', 'write', -1, 600, 'me')
+            lock_class = type('TestMemoryLock', (MemoryLock,), {'table': LockTable(snapshot_path)})
+            lock = lock_class(BaseDavResource('/a/b'))
+            self.assertEqual([l.token for l in lock.get()], [token])
+            self.assertIsNone(lock.acquire('shared', 'write', 0, 600, 'me'))
+        finally:
+            shutil.rmtree(root)
+
+
+class TestModelPropertyStore(TestCase):
+    def store(self, path):
+        return ModelPropertyStore(BaseDavResource(path))
+
+    def setUp(self):
+        self.store('/a').update({'{urn:x}p': '<p xmlns="urn:x">a</p>'}, [])
+        self.store('/a/b').update({'{urn:x}p': '<p xmlns="urn:x">b</p>', '{urn:x}q': '<q xmlns="urn:x"/>'}, [])
+        self.store('/ab').update({'{urn:x}p': '<p xmlns="urn:x">ab</p>'}, [])
+
+    def get_paths(self):
+        return sorted(DavProperty.objects.values_list('path', 'name'))
+
+    def test_get_many(self):
+        with self.assertNumQueries(1):
+            props = ModelPropertyStore.get_many([BaseDavResource('/a/b'), BaseDavResource('/a'), BaseDavResource('/c')])
+        self.assertEqual(props, [
+            {'{urn:x}p': '<p xmlns="urn:x">b</p>', '{urn:x}q': '<q xmlns="urn:x"/>'},
+            {'{urn:x}p': '<p xmlns="urn:x">a</p>'},
+            {},
+        ])
+        self.assertEqual(self.store('/a/b').get(['{urn:x}q']), {'{urn:x}q': '<q xmlns="urn:x"/>'})
+
+    def test_update(self):
+        self.store('/a/b').update({'{urn:x}p': '<p xmlns="urn:x">new</p>'}, ['{urn:x}q'])
+        self.assertEqual(self.store('/a/b').get(), {'{urn:x}p': '<p xmlns="urn:x">new</p>'})
+
+    def test_delete(self):
+        self.store('/a').delete()
+        self.assertEqual(self.get_paths(), [('ab', '{urn:x}p')])
+
+    def test_delete_case(self):
+        self.store('/A/b').update({'{urn:x}p': '<p xmlns="urn:x">B</p>'}, [])
+        self.store('/A').delete()
+        self.assertEqual(self.get_paths(), [('a', '{urn:x}p'), ('a/b', '{urn:x}p'), ('a/b', '{urn:x}q'), ('ab', '{urn:x}p')])
+
+    def test_move_case(self):
+        self.store('/A/b').update({'{urn:x}p': '<p xmlns="urn:x">B</p>'}, [])
+        self.store('/A').move(BaseDavResource('/c'))
+        self.assertEqual(self.get_paths(), [
+            ('a', '{urn:x}p'), ('a/b', '{urn:x}p'), ('a/b', '{urn:x}q'), ('ab', '{urn:x}p'), ('c/b', '{urn:x}p'),
+        ])
+
+    def test_copy(self):
+        self.store('/a').copy(BaseDavResource('/c'))
+        self.assertEqual(self.get_paths(), [
+            ('a', '{urn:x}p'), ('a/b', '{urn:x}p'), ('a/b', '{urn:x}q'), ('ab', '{urn:x}p'),
+            ('c', '{urn:x}p'), ('c/b', '{urn:x}p'), ('c/b', '{urn:x}q'),
+        ])
+
+    def test_move(self):
+        with self.assertNumQueries(4):  # Savepoint, delete, update, release
+            self.store('/a').move(BaseDavResource('/ab'))
+        self.assertEqual(self.get_paths(), [('ab', '{urn:x}p'), ('ab/b', '{urn:x}p'), ('ab/b', '{urn:x}q')])
+        self.assertEqual(self.store('/ab').get(), {'{urn:x}p': '<p xmlns="urn:x">a</p>'})
+
+
+class TestXattrPropertyStore(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'a'))
+        with open(os.path.join(self.root, 'a', 'b.txt'), 'wb') as f:
+            f.write(b'b')
+
+        class FSDavResource(DummyFSDAVResource):
+            root = self.root
+
+        self.resource_class = FSDavResource
+        try:
+            XattrPropertyStore(FSDavResource('/a/b.txt')).update({'{urn:x}p': '<p xmlns="urn:x">b</p>'}, [])
+        except (AttributeError, OSError):
+            shutil.rmtree(self.root)
+            self.skipTest('No user xattr support')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_get_update(self):
+        store = XattrPropertyStore(self.resource_class('/a/b.txt'))
+        self.assertEqual(store.get(), {'{urn:x}p': '<p xmlns="urn:x">b</p>'})
+        store.update({'{urn:x}q': '<q xmlns="urn:x"/>'}, ['{urn:x}p'])
+        self.assertEqual(store.get(['{urn:x}p', '{urn:x}q']), {'{urn:x}q': '<q xmlns="urn:x"/>'})
+
+    def test_copy(self):
+        shutil.copytree(os.path.join(self.root, 'a'), os.path.join(self.root, 'c'), copy_function=shutil.copyfile)
+        XattrPropertyStore(self.resource_class('/a/')).copy(self.resource_class('/c/'))
+        self.assertEqual(XattrPropertyStore(self.resource_class('/c/b.txt')).get(), {'{urn:x}p': '<p xmlns="urn:x">b</p>'})
+
+    def test_move_collection(self):
+        XattrPropertyStore(self.resource_class('/a/')).update({'{urn:x}p': '<p xmlns="urn:x">a</p>'}, [])
+        self.resource_class('/a/').move(self.resource_class('/e/'))
+        XattrPropertyStore(self.resource_class('/a/')).move(self.resource_class('/e/'))
+        self.assertEqual(XattrPropertyStore(self.resource_class('/e/')).get(), {'{urn:x}p': '<p xmlns="urn:x">a</p>'})
+        self.assertEqual(XattrPropertyStore(self.resource_class('/e/b.txt')).get(), {'{urn:x}p': '<p xmlns="urn:x">b</p>'})
+
+
+class TestMultistatusWriter(TestCase):
+    def setUp(self):
+        self.writer = MultistatusWriter()
+
+    def serialize(self, *responses):
+        return etree.tostring(D.multistatus(*responses), xml_declaration=True, encoding='utf-8')
+
+    def test_response(self):
+        names = ['getcontentlength', 'resourcetype', 'displayname', 'getetag', 'missing']
+        rows = [
+            ('/a b/', {'getcontentlength': 0, 'resourcetype': True, 'displayname': u'a b', 'getetag': ''}),
+            (u'/\xe9&<>"\'\r\t', {'resourcetype': False, 'displayname': None, 'getcontentlength': 42}),
+        ]
+        self.assertEqual(
+            self.writer.header + b''.join(self.writer.response(href, props, names) for href, props in rows) + self.writer.footer,
+            self.serialize(*[D.response(
+                D.href(href), D.propstat(D.prop(*build_property_tag_list(props, names)), D.status('HTTP/1.1 200 OK'))
+            ) for href, props in rows])
+        )
+
+    def test_propname_response(self):
+        self.assertEqual(
+            self.writer.header + self.writer.propname_response('/a', ['displayname', 'resourcetype']) + self.writer.footer,
+            self.serialize(D.response(
+                D.href('/a'), D.propstat(D.prop(D.displayname(), D.resourcetype()), D.status('HTTP/1.1 200 OK'))
+            ))
+        )
+
+    def test_element(self):
+        response = lambda: D.response(D.href('/a'), D.propstat(D.prop(
+            etree.fromstring('<a xmlns="urn:x"><D:b xmlns:D="DAV:"/></a>')
+        ), D.status('HTTP/1.1 200 OK')))
+        self.assertEqual(
+            self.writer.header + self.writer.element(response()) + self.writer.footer, self.serialize(response())
+        )
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.writer.response, '/a', {'displayname': '\x01'}, ['displayname'])
@@ -21,10 +21,14 @@
 
 
 import datetime, time, calendar
+from hashlib import md5
 from wsgiref.handlers import format_date_time
 
+from django.db.models import Q
+from django.db.models.functions import Substr
 from django.utils.encoding import force_text
 from django.utils.feedgenerator import rfc2822_date
+from django.utils.module_loading import import_string
 
 try:
     from email.utils import parsedate_tz
@@ -46,26 +50,146 @@ WEBDAV_NSMAP = {'D': WEBDAV_NS}
 D = lb.ElementMaker(namespace=WEBDAV_NS, nsmap=WEBDAV_NSMAP)
 
 
+class lazy_model(object):
+    """Class attribute giving the model of a dotted path when read, so modules of classes using
+    djangodav.models import without djangodav in INSTALLED_APPS."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __get__(self, instance, owner):
+        return import_string(self.path)
+
+
+class UploadStream(object):
+    """Wraps a request body (or any binary stream) to read it in chunks of a fixed size, counting
+    the size and computing the md5 checksum of the content on the way. Iterating yields full
+    chunks only, except for the last one."""
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.hashsum = md5()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.stream.read()
+        else:
+            data = b''
+            while len(data) < size:
+                chunk = self.stream.read(size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        self.size += len(data)
+        self.hashsum.update(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    @property
+    def md5(self):
+        return self.hashsum.hexdigest()
+
+
+class RangeFile(object):
+    """Read only file-like object returning at most length bytes of a binary file from its current
+    position. It has no fileno, so servers using sendfile for wsgi.file_wrapper read it instead of
+    sending the whole file."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
 def get_property_tag_list(res, *names):
-    props = []
+    return build_property_tag_list(res.get_properties(names), names)
+
+
+def build_property_tag_list(props, names):
+    """Build property elements for the names found in a get_properties dict."""
+    tags = []
     for name in names:
-        tag = get_property_tag(res, name)
-        if tag is None:
+        if name not in props:
             continue
-        props.append(tag)
-    return props
+        if name == 'resourcetype':
+            tags.append(D(name, D.collection) if props[name] else D(name))
+        else:
+            tags.append(D(name, force_text(props[name])))
+    return tags
 
 
 def get_property_tag(res, name):
-    if name == 'resourcetype':
-        if res.is_collection:
-            return D(name, D.collection)
-        return D(name)
-    try:
-        if hasattr(res, name):
-            return D(name, force_text(getattr(res, name)))
-    except AttributeError:
-        return
+    tags = get_property_tag_list(res, name)
+    return tags[0] if tags else None
+
+
+def parse_range_header(header, size):
+    """Parses a bytes Range header value against an entity of the given size. Returns a list of
+    inclusive (start, end) tuples, an empty list if none of the ranges can be satisfied, or None if
+    the header is malformed and must be ignored."""
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        start, sep, end = spec.partition('-')
+        start, end = start.strip(), end.strip()
+        if not sep or not (start or end):
+            return None
+        try:
+            if not start:  # suffix-byte-range-spec: the last N bytes
+                length = int(end)
+                if length <= 0 or not size:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if end is not None and start > end:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    return ranges
+
+
+def coalesce_ranges(ranges):
+    """Merges overlapping or adjacent (start, end) ranges, sorting them by start. Ranges without
+    any overlap are returned in the requested order."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return ranges if len(merged) == len(ranges) else merged
+
+
+def parse_lock_token(value):
+    """Extracts the lock id from Lock-Token header or If header token notation,
+    '<opaquelocktoken:id>' giving 'id'."""
+    value = value.strip().strip('<>').strip()
+    if value.startswith('opaquelocktoken:'):
+        value = value[len('opaquelocktoken:'):]
+    return value
 
 
 def safe_join(root, *paths):
@@ -82,6 +206,16 @@ def safe_join(root, *paths):
     return root
 
 
+def prefix_lookup(field, prefix):
+    """Return the annotations and the Q object selecting rows whose field starts with prefix, case
+    sensitively. startswith keeps an index of the field usable, but SQLite runs it as a case
+    insensitive LIKE, so the leading substring is compared as well. Annotate the
+    queryset before filtering it with the Q object. Columns of case insensitive MySQL collations
+    need a binary collation, as for the path equality lookups."""
+    alias = 'dav_%s_prefix' % field
+    return {alias: Substr(field, 1, len(prefix))}, Q(**{'%s__startswith' % field: prefix, alias: prefix})
+
+
 def url_join(base, *paths):
     """Assuming base is the scheme and host (and perhaps path) we will join the remaining
     path elements to it."""
@@ -0,0 +1,152 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django import VERSION as django_version
+from django.db import close_old_connections
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+
+from djangodav.responses import ResponseException
+from djangodav.views.views import DavView, get_executor
+
+
+def call_io(func, args, kwargs):
+    # Worker threads keep their own database connections, drop the ones past CONN_MAX_AGE or broken
+    close_old_connections()
+    return func(*args, **kwargs)
+
+
+def io_handler(name):
+    """Return an async handler running the DavView handler of the given name in the I/O executor."""
+    sync_handler = getattr(DavView, name)
+
+    async def handler(self, request, path, *args, **kwargs):
+        return await self.run_io(sync_handler, self, request, path, *args, **kwargs)
+    handler.__name__ = name
+    handler.__doc__ = sync_handler.__doc__
+    return handler
+
+
+class AsyncDavView(DavView):
+    """DavView for ASGI servers. Handlers are coroutines running the blocking storage calls of
+    DavView in a bounded pool of io_workers threads, so slow file systems and clients don't hold
+    the event loop. Set io_thread_sensitive to run them with asgiref's thread sensitive
+    sync_to_async instead, for resources relying on thread local state."""
+    io_workers = 32  # The pool is shared by the requests of the view class
+    io_thread_sensitive = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(AsyncDavView, cls).as_view(**initkwargs)
+        if asyncio.iscoroutinefunction(view):  # Django >= 4.1 knows async class based views
+            return view
+
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+        async_view.__dict__.update(view.__dict__)
+        async_view.__name__, async_view.__doc__ = view.__name__, view.__doc__
+        return async_view
+
+    def get_io_executor(self):
+        return get_executor(self.__class__, 'io', self.io_workers)
+
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking function and return its result without blocking the event loop."""
+        if self.io_thread_sensitive:
+            return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_io_executor(), partial(call_io, func, args, kwargs))
+
+    @method_decorator(csrf_exempt)
+    async def dispatch(self, request, path, *args, **kwargs):
+        try:
+            await self.run_io(self.prepare_request, request, path, kwargs)
+            handler = self.get_handler(request)
+            try:
+                resp = handler(request, self.path, *args, **kwargs)
+                if asyncio.iscoroutine(resp):
+                    resp = await resp
+            except ResponseException as e:
+                resp = e.response
+            resp = await self.run_io(self.finalize_response, request, resp)
+        except BaseException:
+            self.metrics.finish()
+            raise
+        if resp.streaming and django_version >= (4, 2):
+            # Django 4.2 consumes async iterators, the chunks are read in the I/O executor
+            resp.streaming_content = self.aiter_io(resp.streaming_content)
+        elif resp.streaming:
+            resp.streaming_content = self.iter_io(resp.streaming_content)
+        return resp
+
+    async def aiter_io(self, chunks):
+        """Asynchronously iterate a blocking iterator, fetching every item in the I/O executor."""
+        chunks = iter(chunks)
+        done = object()
+        try:
+            while True:
+                chunk = await self.run_io(next, chunks, done)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                await self.run_io(close)
+
+    def iter_io(self, chunks):
+        """Iterate a blocking iterator in the I/O executor, for Django < 4.2 whose ASGI handler
+        consumes streaming bodies synchronously on the event loop. The next item is read while the
+        current one is sent, so the loop only waits for reads slower than the client."""
+        chunks = iter(chunks)
+        executor = self.get_io_executor()
+        done = object()
+        future = executor.submit(call_io, next, (chunks, done), {})
+        try:
+            while True:
+                chunk = future.result()
+                if chunk is done:
+                    break
+                future = executor.submit(call_io, next, (chunks, done), {})
+                yield chunk
+        finally:
+            if future.exception() is None:  # Waits for a read ahead of a client gone
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    executor.submit(call_io, close, (), {}).result()
+
+    options = io_handler('options')
+    get = io_handler('get')
+    put = io_handler('put')
+    mkcol = io_handler('mkcol')
+    delete = io_handler('delete')
+    propfind = io_handler('propfind')
+    proppatch = io_handler('proppatch')
+    copy = io_handler('copy')
+    move = io_handler('move')
+    lock = io_handler('lock')
+    unlock = io_handler('unlock')
+
+    async def head(self, request, path, *args, **kwargs):
+        return await self.run_io(DavView.get, self, request, path, True, *args, **kwargs)
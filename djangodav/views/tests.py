@@ -19,18 +19,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
 import sys
+import threading
+import time
+from io import BytesIO
+from unittest import skipIf
 from lxml.etree import ElementTree
+from django.db import connections
+from django.test import RequestFactory
 from django.http import HttpResponse, HttpRequest, Http404
 from djangodav.acls import FullAcl
-from djangodav.locks import DummyLock
+from djangodav.instrumentation import NULL_METRICS, MemoryMetricsSink, RequestMetrics
+from djangodav.locks import DummyLock, ModelLock
+from djangodav.models import DavLock
 from djangodav.responses import ResponseException
+from djangodav.signals import request_measured
 from lxml import etree
 
-from djangodav.base.tests.resources import MockCollection, MockObject, MissingMockCollection, MissingMockObject
+from djangodav.base.tests.resources import MockCollection, MockObject, MissingMockCollection, MissingMockObject, \
+    MockResource
 from djangodav.fs.tests import *
-from djangodav.utils import D, WEBDAV_NSMAP, rfc1123_date
+from djangodav.utils import D, WEBDAV_NSMAP, rfc1123_date, UploadStream
 from djangodav.views import DavView
-from mock import Mock
+from samples.db.models import CollectionModel, ObjectModel
+from samples.db.resources import MyDBDavResource
+from djangodav.views.views import ThreadPoolExecutor, parse_if_header
+from mock import Mock, call, patch
 
 
 class TestView(TestCase):
@@ -146,6 +159,53 @@ class TestView(TestCase):
             ), pretty_print=True, xml_declaration=True, encoding='utf-8')
         )
 
+    def test_propfind_listing_streaming(self):
+        self.top_collection.get_descendants.return_value += [self.top_collection]
+        request = Mock(META={})
+        path = '/collection/'
+        v = DavView(base_url='/base/', path=path, request=request, acl_class=FullAcl, xml_streaming=True)
+        v.__dict__['resource'] = self.top_collection
+        resp = v.propfind(request, path, None)
+        self.assertEqual(resp.status_code, 207)
+        self.assertTrue(resp.streaming)
+        tree = etree.fromstring(b''.join(resp.streaming_content))
+        self.assertEqual(tree.tag, '{DAV:}multistatus')
+        self.assertEqual(tree.xpath('D:response/D:href/text()', namespaces=WEBDAV_NSMAP), [
+            '/base/collection/sub_object', '/base/collection/sub_colection/', '/base/collection/'
+        ])
+        self.assertEqual(tree.xpath('D:response/D:propstat/D:prop/D:getcontentlength/text()', namespaces=WEBDAV_NSMAP), [
+            '42', '0', '0'
+        ])
+
+    def test_propfind_properties_bulk(self):
+        request = Mock(META={})
+        path = '/collection/'
+        v = DavView(base_url='/base/', path=path, request=request, acl_class=FullAcl, propfind_batch_size=1)
+        v.__dict__['resource'] = self.top_collection
+        with patch.object(MockResource, 'get_properties_bulk', Mock(side_effect=lambda resources, names: [
+            {'displayname': r.displayname} for r in resources
+        ])) as get_properties_bulk:
+            resp = v.propfind(request, path, None)
+        self.assertEqual(get_properties_bulk.call_count, 2)
+        get_properties_bulk.assert_called_with([self.sub_collection], self.top_collection.ALL_PROPS)
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('D:response/D:propstat/D:prop/D:displayname/text()', namespaces=WEBDAV_NSMAP), [
+            'sub_object', 'sub_colection'
+        ])
+
+    def test_propfind_multistatus_writer(self):
+        request = Mock(META={})
+        path = '/collection/'
+        self.top_collection.get_descendants.return_value += [self.top_collection]
+        xbody = lambda: etree.XPathDocumentEvaluator(ElementTree(D.propfind(D.propname())), namespaces=WEBDAV_NSMAP)
+        for body in (None, xbody):
+            contents = []
+            for fast in (True, False):
+                v = DavView(base_url='/base/', path=path, request=request, acl_class=FullAcl, xml_fast_multistatus=fast)
+                v.__dict__['resource'] = self.top_collection
+                contents.append(v.propfind(request, path, body and body()).content)
+            self.assertEqual(contents[0], contents[1])
+
     def test_propfind_exact_names(self):
         self.sub_object.get_descendants.return_value += [self.sub_object]
         request = Mock(META={})
@@ -326,10 +386,125 @@ class TestView(TestCase):
         self.assertEqual(resp['Etag'], "0" * 40)
         self.assertEqual(resp['Content-Type'], "text/plain")
         self.assertEqual(resp['Last-Modified'], "Wed, 24 Dec 2014 06:00:00 +0000")
+        self.assertEqual(resp['Content-Length'], "42")
         if sys.version_info < (3, 0, 0): #py2
-            self.assertEqual(resp.content, "C" * 42)
+            self.assertEqual(b''.join(resp.streaming_content), "C" * 42)
         else:
-            self.assertEqual(resp.content.decode('utf-8'), "C" * 42)
+            self.assertEqual(b''.join(resp.streaming_content).decode('utf-8'), "C" * 42)
+
+    def test_get_obj_range(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"0123456789" * 4 + b"AB"))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=10-19'
+        resp = v.get(request, path)
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 10-19/42')
+        self.assertEqual(resp['Content-Length'], '10')
+        self.assertEqual(resp['Content-Type'], 'text/plain')
+        self.assertEqual(b''.join(resp.streaming_content), b"0123456789")
+
+    def test_get_obj_read_range(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read_range=Mock(return_value=b"0123456789"))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=10-19'
+        resp = v.get(request, path)
+        self.assertEqual(b''.join(resp.streaming_content), b"0123456789")
+        v.resource.read_range.assert_called_once_with(10, 19)
+
+    def test_get_obj_range_unknown_type(self):
+        path = '/obj'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"C" * 42))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=0-1'
+        resp = v.get(request, path)
+        self.assertEqual(resp['Content-Type'], 'application/octet-stream')
+
+    def test_get_obj_range_chunked(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl, read_chunk_size=16)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"0123456789" * 4 + b"AB"))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=2-'
+        resp = v.get(request, path)
+        self.assertEqual(resp['Content-Range'], 'bytes 2-41/42')
+        self.assertEqual([len(chunk) for chunk in resp.streaming_content], [16, 16, 8])
+
+    def test_get_obj_multiple_ranges(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"0123456789" * 4 + b"AB"))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=0-1, -2'
+        resp = v.get(request, path)
+        self.assertEqual(resp.status_code, 206)
+        content_type, boundary = resp['Content-Type'].split('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        content = b''.join(resp.streaming_content)
+        self.assertEqual(content, (
+            '--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/42\r\n\r\n01\r\n'
+            '--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 40-41/42\r\n\r\nAB\r\n'
+            '--{0}--\r\n'
+        ).format(boundary).encode('ascii'))
+        self.assertEqual(resp['Content-Length'], str(len(content)))
+
+    def test_get_obj_overlapping_ranges(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"0123456789" * 4 + b"AB"))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=5-14, 0-9, 10-11'
+        resp = v.get(request, path)
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 0-14/42')
+        self.assertEqual(b''.join(resp.streaming_content), b"012345678901234")
+
+    def test_get_obj_too_many_ranges(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl, max_ranges=2)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"C" * 42))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=0-0, 2-2, 4-4'
+        resp = v.get(request, path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b"C" * 42)
+
+    def test_get_empty_obj_suffix_range(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b""), getcontentlength=0)
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=-5'
+        with self.assertRaises(ResponseException) as e:
+            v.get(request, path)
+        self.assertEqual(e.exception.response.status_code, 416)
+        self.assertEqual(e.exception.response['Content-Range'], 'bytes */0')
+
+    def test_get_obj_range_not_satisfiable(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"C" * 42))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=42-'
+        with self.assertRaises(ResponseException) as e:
+            v.get(request, path)
+        self.assertEqual(e.exception.response.status_code, 416)
+        self.assertEqual(e.exception.response['Content-Range'], 'bytes */42')
+
+    def test_get_obj_if_range_mismatch(self):
+        path = '/obj.txt'
+        v = DavView(path=path, _allowed_methods=Mock(return_value=['ALL']), acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(return_value=b"C" * 42))
+        request = HttpRequest()
+        request.META['HTTP_RANGE'] = 'bytes=0-1'
+        request.META['HTTP_IF_RANGE'] = '"%s"' % ("1" * 40)
+        resp = v.get(request, path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b"C" * 42)
 
     @patch('djangodav.views.render', Mock(return_value=HttpResponse('listing')))
     def test_head_object(self):
@@ -375,8 +550,10 @@ class TestView(TestCase):
         v.__dict__['resource'] = self.missing_sub_object
         self.missing_sub_object.write = Mock()
         request = HttpRequest()
+        self.missing_sub_object.invalidate = Mock()
         resp = v.put(request, path)
         self.missing_sub_object.write.assert_called_with(request)
+        self.missing_sub_object.invalidate.assert_called_with()
         self.assertEqual(201, resp.status_code)
 
     def test_put_exists(self):
@@ -482,6 +659,43 @@ class TestView(TestCase):
         self.assertTrue(src.copy.called)
         self.assertTrue(dst.delete.called)
 
+    def test_copy_errors(self):
+        src = self.sub_collection
+        dst = self.missing_sub_collection
+        src.copy = Mock(return_value=[(self.missing_sub_object, 507)])
+        request = HttpRequest()
+        request.META['HTTP_DEPTH'] = 'infinity'
+        request.META['HTTP_DESTINATION'] = "http://testserver%s" % dst.get_escaped_path()
+        request.META['SERVER_NAME'] = 'testserver'
+        request.META['SERVER_PORT'] = '80'
+        v = DavView(base_url='http://testserver', request=request, path=src.get_path(), acl_class=FullAcl, lock_class=DummyLock)
+        v.resource_class = Mock(return_value=dst)
+        v.__dict__['resource'] = src
+        resp = v.copy(request, src.get_path(), None)
+        self.assertEqual(207, resp.status_code)
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('D:response/D:href/text()', namespaces=WEBDAV_NSMAP), [
+            'http://testserver/collection/missing_sub_object'
+        ])
+        self.assertEqual(tree.xpath('D:response/D:status/text()', namespaces=WEBDAV_NSMAP), [
+            'HTTP/1.1 507 Insufficient Storage'
+        ])
+
+    def test_move_into_itself(self):
+        src = self.top_collection
+        src.move = Mock(return_value=None)
+        for dst in [self.missing_sub_collection, self.top_collection]:
+            request = HttpRequest()
+            request.META['HTTP_DESTINATION'] = "http://testserver%s" % dst.get_escaped_path()
+            request.META['SERVER_NAME'] = 'testserver'
+            request.META['SERVER_PORT'] = '80'
+            v = DavView(base_url='http://testserver', request=request, path=src.get_path(), acl_class=FullAcl, lock_class=DummyLock)
+            v.resource_class = Mock(return_value=dst)
+            v.__dict__['resource'] = src
+            resp = v.move(request, src.get_path(), None)
+            self.assertEqual(403, resp.status_code)
+        self.assertFalse(src.move.called)
+
     def test_move_new(self):
         src = self.sub_object
         src.move = Mock(return_value=None)
@@ -515,3 +729,376 @@ class TestView(TestCase):
         self.assertEqual(204, resp.status_code)
         self.assertTrue(src.move.called)
         self.assertTrue(dst.delete.called)
+
+    def test_lock(self):
+        request = HttpRequest()
+        request.META['HTTP_TIMEOUT'] = 'Infinite, Second-4100000000'
+        path = '/collection/sub_object'
+        v = DavView(path=path, request=request, acl_class=FullAcl, lock_class=DummyLock)
+        v.__dict__['resource'] = self.sub_object
+        xbody = etree.XPathDocumentEvaluator(ElementTree(
+            D.lockinfo(D.lockscope(D.exclusive()), D.locktype(D.write()), D.owner('me'))
+        ), namespaces=WEBDAV_NSMAP)
+        resp = v.lock(request, path, xbody)
+        self.assertEqual(resp.status_code, 200)
+        token = resp['Lock-Token'][len('<opaquelocktoken:'):-1]
+        self.assertEqual(resp.content, etree.tostring(D.prop(D.lockdiscovery(D.activelock(
+            D.locktype(D.write()),
+            D.lockscope(D.exclusive()),
+            D.depth('infinity'),
+            D.timeout('Second-86400'),
+            D.locktoken(D.href('opaquelocktoken:%s' % token)),
+            D.owner('me'),
+        ))), xml_declaration=True, encoding='utf-8'))
+
+    def test_lock_refresh(self):
+        request = HttpRequest()
+        request.META['HTTP_TIMEOUT'] = 'Second-60'
+        request.META['HTTP_IF'] = '(<opaquelocktoken:token>)'
+        path = '/collection/sub_object'
+        lock = Mock(type='write', scope='shared', depth=0, timeout=60, token='token', owner=None)
+        lock_class = Mock(return_value=Mock(refresh=Mock(return_value=lock)))
+        v = DavView(path=path, request=request, acl_class=FullAcl, lock_class=lock_class)
+        v.__dict__['resource'] = self.sub_object
+        resp = v.lock(request, path, None)
+        self.assertEqual(resp.status_code, 200)
+        lock_class.return_value.refresh.assert_called_with('opaquelocktoken:token', 60)
+        self.assertEqual(resp['Lock-Token'], '<opaquelocktoken:token>')
+
+    def test_lock_refresh_missing(self):
+        request = HttpRequest()
+        path = '/collection/sub_object'
+        v = DavView(path=path, request=request, acl_class=FullAcl, lock_class=DummyLock)
+        v.__dict__['resource'] = self.sub_object
+        self.assertEqual(v.lock(request, path, None).status_code, 400)
+        request.META['HTTP_IF'] = '(<opaquelocktoken:token>)'
+        self.assertEqual(v.lock(request, path, None).status_code, 412)
+
+    def test_parse_if_header(self):
+        self.assertEqual(parse_if_header('(<opaquelocktoken:a> ["etag"]) (Not <DAV:no-lock>)'), (
+            (None, ((False, False, 'opaquelocktoken:a'), (False, True, '"etag"'))),
+            (None, ((True, False, 'DAV:no-lock'),)),
+        ))
+        self.assertEqual(parse_if_header('<http://testserver/a> (<opaquelocktoken:a>) <http://testserver/b> (["b"])'), (
+            ('http://testserver/a', ((False, False, 'opaquelocktoken:a'),)),
+            ('http://testserver/b', ((False, True, '"b"'),)),
+        ))
+        for value in ('', '(', '()', '(<a> junk)', '<http://testserver/a>', 'junk (<a>)'):
+            self.assertRaises(ValueError, parse_if_header, value)
+
+    def get_conditional_put_view(self, header, tokens=()):
+        request = HttpRequest()
+        request.META['HTTP_IF'] = header
+        lock_class = Mock(get_many=Mock(return_value=[[Mock(token=token) for token in tokens]]))
+        path = '/collection/sub_object'
+        v = DavView(path=path, base_url='', request=request, acl_class=FullAcl, lock_class=lock_class)
+        v.__dict__['resource'] = self.sub_object
+        self.sub_object.write = Mock()
+        return v, request
+
+    def test_put_if_lock_token(self):
+        v, request = self.get_conditional_put_view('(<opaquelocktoken:a>)', ['a'])
+        self.assertEqual(v.put(request, v.path).status_code, 204)
+        # If header evaluation, then the lock check
+        self.assertEqual(v.lock_class.get_many.call_args_list, [call([self.sub_object]), call([self.sub_object])])
+
+    def test_put_if_lock_token_mismatch(self):
+        v, request = self.get_conditional_put_view('(<opaquelocktoken:b>) (["%s"])' % ("1" * 40), ['a'])
+        with self.assertRaises(ResponseException) as cm:
+            v.put(request, v.path)
+        self.assertEqual(cm.exception.response.status_code, 412)
+        self.assertFalse(self.sub_object.write.called)
+
+    def test_put_if_dummy_lock_token(self):
+        request = HttpRequest()
+        request.META['HTTP_TIMEOUT'] = 'Second-60'
+        path = '/collection/sub_object'
+        v = DavView(path=path, base_url='', request=request, acl_class=FullAcl, lock_class=DummyLock)
+        v.__dict__['resource'] = self.sub_object
+        xbody = etree.XPathDocumentEvaluator(ElementTree(
+            D.lockinfo(D.lockscope(D.exclusive()), D.locktype(D.write()))
+        ), namespaces=WEBDAV_NSMAP)
+        token = v.lock(request, path, xbody)['Lock-Token']
+        request.META['HTTP_IF'] = '(%s)' % token
+        self.sub_object.write = Mock()
+        self.assertEqual(v.put(request, path).status_code, 204)
+        self.assertTrue(self.sub_object.write.called)
+
+    def get_model_lock_view(self, resource, method='PUT', **meta):
+        request = HttpRequest()
+        request.method = method
+        request.META.update(meta)
+        v = DavView(path=resource.get_path(), base_url='', request=request, acl_class=FullAcl, lock_class=ModelLock)
+        v.__dict__['resource'] = resource
+        return v, request
+
+    def test_put_locked(self):
+        token = ModelLock(self.sub_object).acquire('exclusive', 'write', 0, 600, 'me')
+        v, request = self.get_model_lock_view(self.sub_object)
+        self.sub_object.write = Mock()
+        with self.assertRaises(ResponseException) as cm:
+            v.put(request, v.path)
+        self.assertEqual(cm.exception.response.status_code, 423)
+        self.assertFalse(self.sub_object.write.called)
+        request.META['HTTP_IF'] = '(<opaquelocktoken:%s>)' % token
+        self.assertEqual(v.put(request, v.path).status_code, 204)
+
+    def test_delete_locked_descendant(self):
+        ModelLock(self.sub_object).acquire('exclusive', 'write', 0, 600, 'me')
+        self.top_collection.delete = Mock()
+        v, request = self.get_model_lock_view(self.top_collection, 'DELETE')
+        with self.assertRaises(ResponseException) as cm:
+            v.delete(request, v.path)
+        self.assertEqual(cm.exception.response.status_code, 423)
+        self.assertFalse(self.top_collection.delete.called)
+        self.assertEqual(DavLock.objects.count(), 1)
+
+    def test_put_if_etag(self):
+        v, request = self.get_conditional_put_view('(Not <DAV:no-lock> ["%s"])' % ("0" * 40))
+        self.assertEqual(v.put(request, v.path).status_code, 204)
+
+    def test_put_if_tagged(self):
+        v, request = self.get_conditional_put_view(
+            '<http://testserver/other> (<opaquelocktoken:a>) </collection/sub_object> (<opaquelocktoken:a>)', ['a'])
+        other = MockObject('/other')
+        v.resource_class = Mock(return_value=other)
+        v.lock_class.get_many.return_value = [[], [Mock(token='a')]]
+        self.assertEqual(v.put(request, v.path).status_code, 204)
+        self.assertEqual(v.lock_class.get_many.call_args_list, [call([other, self.sub_object]), call([self.sub_object])])
+
+    def test_put_if_match(self):
+        v, request = self.get_conditional_put_view('')
+        request.META['HTTP_IF_MATCH'] = '"%s"' % ("1" * 40)
+        self.assertRaises(ResponseException, v.put, request, v.path)
+        request.META['HTTP_IF_MATCH'] = '"%s"' % ("0" * 40)
+        self.assertEqual(v.put(request, v.path).status_code, 204)
+
+    def get_conditional_get_view(self, **meta):
+        path = '/obj.txt'
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META.update(meta)
+        v = DavView(path=path, request=request, acl_class=FullAcl)
+        v.__dict__['resource'] = MockObject(path, read=Mock(), open_read=Mock(), cheap_etag=True)
+        return v, request
+
+    def test_get_if_none_match(self):
+        v, request = self.get_conditional_get_view(HTTP_IF_NONE_MATCH='"%s"' % ("0" * 40))
+        with self.assertRaises(ResponseException) as cm:
+            v.get(request, v.path)
+        self.assertEqual(cm.exception.response.status_code, 304)
+        self.assertEqual(cm.exception.response['ETag'], "0" * 40)
+        self.assertEqual(cm.exception.response['Last-Modified'], "Wed, 24 Dec 2014 06:00:00 +0000")
+        self.assertFalse(v.resource.read.called)
+        self.assertFalse(v.resource.open_read.called)
+
+    def test_get_if_none_match_changed(self):
+        v, request = self.get_conditional_get_view(HTTP_IF_NONE_MATCH='"%s"' % ("1" * 40))
+        self.assertEqual(v.get(request, v.path).status_code, 200)
+
+    def test_get_if_none_match_expensive_etag(self):
+        v, request = self.get_conditional_get_view(
+            HTTP_IF_NONE_MATCH='"%s"' % ("0" * 40), HTTP_IF_MODIFIED_SINCE='Tue, 23 Dec 2014 06:00:00 GMT')
+        v.resource.cheap_etag = False
+        self.assertEqual(v.get(request, v.path).status_code, 200)
+        v.resource.open_read.reset_mock()
+        request.META['HTTP_IF_MODIFIED_SINCE'] = 'Wed, 24 Dec 2014 06:00:00 GMT'
+        with self.assertRaises(ResponseException) as cm:
+            v.get(request, v.path)
+        self.assertEqual(cm.exception.response.status_code, 304)
+        self.assertNotIn('ETag', cm.exception.response)
+        self.assertFalse(v.resource.open_read.called)
+
+    def get_proppatch_view(self):
+        request = HttpRequest()
+        path = '/collection/sub_object'
+        store = Mock()
+        v = DavView(base_url='/base', path=path, request=request, acl_class=FullAcl, property_store_class=Mock(return_value=store))
+        v.__dict__['resource'] = self.sub_object
+        return v, request, store
+
+    def test_proppatch(self):
+        v, request, store = self.get_proppatch_view()
+        resp = v.proppatch(request, v.path, etree.XPathDocumentEvaluator(ElementTree(D.propertyupdate(
+            D.set(D.prop(etree.Element('{urn:x}a'), etree.Element('{urn:x}b'))),
+            D.remove(D.prop(etree.Element('{urn:x}b'), etree.Element('{urn:x}c'))),
+        )), namespaces=WEBDAV_NSMAP))
+        self.assertEqual(resp.status_code, 207)
+        store.update.assert_called_with({'{urn:x}a': '<ns0:a xmlns:ns0="urn:x"/>'}, set(['{urn:x}b', '{urn:x}c']))
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('//D:status/text()', namespaces=WEBDAV_NSMAP), ['HTTP/1.1 200 OK'])
+        self.assertEqual([el.tag for el in tree.xpath('//D:prop/*', namespaces=WEBDAV_NSMAP)], [
+            '{urn:x}a', '{urn:x}b', '{urn:x}c'
+        ])
+
+    def test_proppatch_protected(self):
+        v, request, store = self.get_proppatch_view()
+        resp = v.proppatch(request, v.path, etree.XPathDocumentEvaluator(ElementTree(D.propertyupdate(
+            D.set(D.prop(D.getetag('x'), etree.Element('{urn:x}a'))),
+        )), namespaces=WEBDAV_NSMAP))
+        self.assertFalse(store.update.called)
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('//D:status/text()', namespaces=WEBDAV_NSMAP), [
+            'HTTP/1.1 403 Forbidden', 'HTTP/1.1 424 Failed Dependency'
+        ])
+
+    @skipIf(ThreadPoolExecutor is None, "requires concurrent.futures")
+    def test_propfind_parallel(self):
+        request = Mock(META={})
+        path = '/collection/'
+        view_class = type('ParallelDavView', (DavView,), {'propfind_workers': 2})
+        v = view_class(base_url='/base/', path=path, request=request, acl_class=FullAcl)
+        v.__dict__['resource'] = self.top_collection
+        threads = set()
+
+        def get_properties_bulk(resources, names):
+            threads.add(threading.current_thread())
+            if resources[0] is self.sub_object:
+                time.sleep(0.05)  # Finishes last
+            return [{'displayname': r.displayname} for r in resources]
+        with patch.object(MockResource, 'get_properties_bulk', Mock(side_effect=get_properties_bulk)):
+            resp = v.propfind(request, path, None)
+        self.assertNotIn(threading.current_thread(), threads)
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('D:response/D:propstat/D:prop/D:displayname/text()', namespaces=WEBDAV_NSMAP), [
+            'sub_object', 'sub_colection'
+        ])
+
+    @skipIf(ThreadPoolExecutor is None, "requires concurrent.futures")
+    def test_propfind_executor(self):
+        v = DavView(propfind_workers=3)  # As set by as_view
+        self.assertEqual(v.get_propfind_executor()._max_workers, 3)
+        self.assertIs(v.get_propfind_executor(), DavView(propfind_workers=3).get_propfind_executor())
+        parent = type('ParentDavView', (DavView,), {'propfind_workers': 2})
+        child = type('ChildDavView', (parent,), {'propfind_workers': 8})
+        self.assertEqual(parent().get_propfind_executor()._max_workers, 2)
+        self.assertEqual(child().get_propfind_executor()._max_workers, 8)
+
+    def test_propfind_dead_properties(self):
+        request = Mock(META={})
+        path = '/collection/'
+        store_class = Mock(get_many=Mock(side_effect=lambda resources, names: [
+            {'{urn:x}a': '<a xmlns="urn:x">%s</a>' % r.displayname} for r in resources
+        ]))
+        v = DavView(base_url='/base/', path=path, request=request, acl_class=FullAcl, property_store_class=store_class)
+        v.__dict__['resource'] = self.top_collection
+        resp = v.propfind(request, path, etree.XPathDocumentEvaluator(ElementTree(
+            D.propfind(D.prop(D.displayname(), etree.Element('{urn:x}a')))
+        ), namespaces=WEBDAV_NSMAP))
+        store_class.get_many.assert_called_once_with([self.sub_object, self.sub_collection], ['{urn:x}a'])
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(tree.xpath('//D:prop/x:a/text()', namespaces={'D': 'DAV:', 'x': 'urn:x'}), [
+            'sub_object', 'sub_colection'
+        ])
+        self.assertEqual(len(tree.xpath('//D:prop/D:displayname', namespaces=WEBDAV_NSMAP)), 2)
+
+    def get_instrumented_view(self, **kwargs):
+        request = Mock(spec=HttpRequest, META={'PATH_INFO': '/base/collection/'}, method='PROPFIND')
+        sink = MemoryMetricsSink()
+        kwargs.setdefault('instrument', True)
+        v = DavView(request=request, acl_class=FullAcl, metrics_sinks=[sink], **kwargs)
+        v.__dict__['resource'] = self.top_collection
+        return v, request, sink
+
+    def test_dispatch_instrumented(self):
+        v, request, sink = self.get_instrumented_view(server_timing=True)
+        received = []
+        receiver = lambda sender, **kwargs: received.append(kwargs)
+        request_measured.connect(receiver)
+        try:
+            resp = v.dispatch(request, '/collection/')
+        finally:
+            request_measured.disconnect(receiver)
+        self.assertEqual(resp.status_code, 207)
+        method, status, metrics = sink.records[0]
+        self.assertEqual((method, status), ('PROPFIND', 207))
+        self.assertEqual(set(metrics.phases), set(['access', 'enumerate', 'properties', 'serialize']))
+        self.assertEqual(received[0]['metrics'], metrics)
+        self.assertIs(received[0]['response'], resp)
+        for name in ('access', 'enumerate', 'properties', 'serialize', 'total'):
+            self.assertIn('%s;dur=' % name, resp['Server-Timing'])
+        self.assertIn('db;desc="0 queries"', resp['Server-Timing'])
+
+    def test_dispatch_instrumented_streaming(self):
+        v, request, sink = self.get_instrumented_view(xml_streaming=True)
+        resp = v.dispatch(request, '/collection/')
+        self.assertNotIn('Server-Timing', resp)
+        self.assertEqual(sink.records, [])
+        b''.join(resp.streaming_content)
+        self.assertEqual(len(sink.records), 1)
+        self.assertIn('serialize', sink.records[0][2].phases)
+
+    def test_dispatch_instrumented_error(self):
+        v, request, sink = self.get_instrumented_view()
+        v.__dict__['resource'] = self.missing_sub_object
+        request.method = 'GET'
+        wrappers = [list(getattr(c, 'execute_wrappers', [])) for c in connections.all()]
+        self.assertRaises(Http404, v.dispatch, request, '/collection/missing_sub_object')
+        self.assertEqual([list(getattr(c, 'execute_wrappers', [])) for c in connections.all()], wrappers)
+        self.assertIsNotNone(v.metrics.total)
+        self.assertEqual(sink.records, [])
+
+    def test_dispatch_not_instrumented(self):
+        v, request, sink = self.get_instrumented_view(instrument=False, server_timing=True)
+        resp = v.dispatch(request, '/collection/')
+        self.assertIs(v.metrics, NULL_METRICS)
+        self.assertNotIn('Server-Timing', resp)
+        self.assertEqual(sink.records, [])
+
+    def test_put_instrumented(self):
+        request = Mock(spec=HttpRequest, META={'PATH_INFO': '/collection/sub_object', 'CONTENT_LENGTH': '42'}, method='PUT')
+        v = DavView(request=request, acl_class=FullAcl, instrument=True)
+        v.__dict__['resource'] = self.sub_object
+        with patch.object(self.sub_object, 'write', return_value=None) as write:
+            v.dispatch(request, '/collection/sub_object')
+        write.assert_called_once_with(request)
+        self.assertEqual(v.metrics.bytes_written, 42)
+        self.assertIn('body', v.metrics.phases)
+
+    def test_put_instrumented_chunked(self):
+        request = Mock(spec=HttpRequest, META={'PATH_INFO': '/collection/sub_object'}, method='PUT')
+        v = DavView(request=request, acl_class=FullAcl, instrument=True)
+        v.__dict__['resource'] = self.sub_object
+        with patch.object(self.sub_object, 'write', return_value=UploadStream(BytesIO(b'0123456789'))) as write:
+            write.return_value.read()
+            v.dispatch(request, '/collection/sub_object')
+        self.assertEqual(v.metrics.bytes_written, 10)
+
+    @patch('djangodav.instrumentation.default_timer', Mock(side_effect=[0, 1, 3, 6]))
+    def test_metrics_nested_phases(self):
+        metrics = RequestMetrics()
+        with metrics.phase('serialize'):
+            with metrics.phase('properties'):
+                pass
+        self.assertEqual(metrics.phases, {'serialize': 4, 'properties': 2})
+
+
+class TestDBDavView(TestCase):
+    def setUp(self):
+        a = CollectionModel.objects.create(name='a')
+        CollectionModel.objects.create(name='b', parent=a)
+        ObjectModel.objects.create(name='a.txt', parent=a, md5='0' * 32)
+        self.view = DavView.as_view(resource_class=MyDBDavResource, lock_class=DummyLock, acl_class=FullAcl)
+        self.factory = RequestFactory()
+
+    def request(self, method, path, **kwargs):
+        return self.view(self.factory.generic(method, '/dav' + path, **kwargs), path=path)
+
+    def test_propfind_collection_etag(self):
+        resp = self.request('PROPFIND', '/a/', data=etree.tostring(D.propfind(D.prop(D.getetag()))),
+                            content_type='text/xml', HTTP_DEPTH='1')
+        self.assertEqual(resp.status_code, 207)
+        tree = etree.fromstring(b''.join(resp) if resp.streaming else resp.content)
+        etags = dict(
+            (response.findtext('{DAV:}href'), response.findtext('{DAV:}propstat/{DAV:}prop/{DAV:}getetag'))
+            for response in tree.findall('{DAV:}response')
+        )
+        self.assertEqual(etags, {'/dav/a/': None, '/dav/a/b/': None, '/dav/a/a.txt': '0' * 32})
+
+    def test_get_collection_if_none_match(self):
+        resp = self.request('GET', '/a/', HTTP_IF_NONE_MATCH='"%s"' % ('0' * 32))
+        self.assertEqual(resp.status_code, 200)
+        resp = self.request('GET', '/a/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(resp.status_code, 304)
+        self.assertNotIn('ETag', resp)
+
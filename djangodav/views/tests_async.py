@@ -0,0 +1,188 @@
+# Portions (c) 2014, Alexander Klimenko <alex@erix.ru>
+# All rights reserved.
+#
+# Copyright (c) 2011, SmartFile <btimby@smartfile.com>
+# All rights reserved.
+#
+# This file is part of DjangoDav.
+#
+# DjangoDav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DjangoDav is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import threading
+from unittest import skipIf
+
+from django import VERSION as django_version
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from lxml import etree
+
+from djangodav.acls import FullAcl
+from djangodav.base.resources import MetaEtagMixIn
+from djangodav.fs.resources import DummyFSDAVResource
+from djangodav.locks import DummyLock
+from djangodav.utils import D, WEBDAV_NSMAP
+from samples.db.models import CollectionModel
+from samples.db.resources import MyDBDavResource
+
+# AsyncDavView needs Django >= 3.1, its module doesn't even compile on Python 2
+if django_version >= (3, 1):
+    import asyncio
+    from asgiref.sync import async_to_sync
+    from djangodav.views.async_views import AsyncDavView
+
+
+def run_on_loop(func, *args):
+    """Call func from a callback of a running event loop, as the ASGI handler of Django < 4.2
+    iterates streaming bodies."""
+    loop = asyncio.new_event_loop()
+    future = loop.create_future()
+
+    def callback():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+    loop.call_soon(callback)
+    try:
+        return loop.run_until_complete(future)
+    finally:
+        loop.close()
+
+
+def collect_async(items):
+    loop = asyncio.new_event_loop()
+    result = []
+    try:
+        while True:
+            result.append(loop.run_until_complete(items.__anext__()))
+    except StopAsyncIteration:
+        return result
+    finally:
+        loop.close()
+
+
+@skipIf(django_version < (3, 1), 'AsyncDavView needs Django >= 3.1')
+class TestAsyncDavView(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dir'))
+        with open(os.path.join(self.root, 'dir', 'file.txt'), 'wb') as f:
+            f.write(b'0123456789')
+
+        class FSDavResource(MetaEtagMixIn, DummyFSDAVResource):
+            root = self.root
+
+        self.view = AsyncDavView.as_view(resource_class=FSDavResource, lock_class=DummyLock, acl_class=FullAcl)
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def request(self, method, path, view=None, **kwargs):
+        request = self.factory.generic(method, '/dav' + path, **kwargs)
+        return async_to_sync(view or self.view)(request, path=path)
+
+    def test_as_view(self):
+        self.assertTrue(asyncio.iscoroutinefunction(self.view))
+
+    def test_get(self):
+        resp = self.request('GET', '/dir/file.txt')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b''.join(resp.streaming_content), b'0123456789')
+        self.assertEqual(self.request('HEAD', '/dir/file.txt').status_code, 200)
+
+    @skipIf(django_version >= (4, 2), 'Django >= 4.2 iterates streaming bodies asynchronously')
+    def test_get_on_loop(self):
+        threads = set()
+
+        class TrackingFile(object):
+            def __init__(self, f):
+                self.f = f
+
+            def read(self, *args):
+                threads.add(threading.current_thread())
+                return self.f.read(*args)
+
+            def close(self):
+                self.f.close()
+
+        resource_class = self.view.view_initkwargs['resource_class']
+        view = AsyncDavView.as_view(resource_class=type('TrackingFSDavResource', (resource_class,), {
+            'open_read': lambda resource: TrackingFile(resource_class.open_read(resource))
+        }), lock_class=DummyLock, acl_class=FullAcl)
+        resp = self.request('GET', '/dir/file.txt', view)
+        self.assertEqual(run_on_loop(b''.join, resp), b'0123456789')
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_get_missing(self):
+        with self.assertRaises(Http404):
+            self.request('GET', '/dir/missing.txt')
+
+    def test_put(self):
+        resp = self.request('PUT', '/dir/new.txt', data=b'abc', content_type='application/octet-stream')
+        self.assertEqual(resp.status_code, 201)
+        with open(os.path.join(self.root, 'dir', 'new.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+
+    def test_propfind(self):
+        resp = self.request('PROPFIND', '/dir/', data=etree.tostring(D.propfind(D.prop(D.displayname()))),
+                            content_type='text/xml', HTTP_DEPTH='1')
+        self.assertEqual(resp.status_code, 207)
+        tree = etree.fromstring(resp.content)
+        self.assertEqual(sorted(tree.xpath('//D:displayname/text()', namespaces=WEBDAV_NSMAP)), ['dir', 'file.txt'])
+
+    def test_io_executor(self):
+        self.assertEqual(AsyncDavView(io_workers=3).get_io_executor()._max_workers, 3)
+        child = type('ChildAsyncDavView', (AsyncDavView,), {'io_workers': 5})
+        self.assertEqual(child().get_io_executor()._max_workers, 5)
+        self.assertIsNot(child().get_io_executor(), AsyncDavView(io_workers=5).get_io_executor())
+
+    def test_iter_io_close(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b'a'
+                yield b'b'
+            finally:
+                closed.append(threading.current_thread())
+        items = AsyncDavView().iter_io(chunks())
+        self.assertEqual(next(items), b'a')
+        items.close()
+        self.assertEqual(len(closed), 1)
+        self.assertNotEqual(closed[0], threading.current_thread())
+
+    def test_aiter_io(self):
+        self.assertEqual(collect_async(AsyncDavView().aiter_io(iter([b'a', b'b']))), [b'a', b'b'])
+
+
+@skipIf(django_version < (3, 1), 'AsyncDavView needs Django >= 3.1')
+class TestAsyncDBDavView(TransactionTestCase):
+    # Committed rows, the I/O threads use their own connections
+
+    @skipIf(django_version >= (4, 2), 'Django >= 4.2 iterates streaming bodies asynchronously')
+    def test_propfind_stream_on_loop(self):
+        a = CollectionModel.objects.create(name='a')
+        CollectionModel.objects.create(name='b', parent=a)
+        view = AsyncDavView.as_view(resource_class=MyDBDavResource, lock_class=DummyLock, acl_class=FullAcl,
+                                    xml_streaming=True)
+        request = RequestFactory().generic('PROPFIND', '/dav/a/', etree.tostring(D.propfind(D.prop(D.displayname()))),
+                                           content_type='text/xml', HTTP_DEPTH='1')
+        resp = async_to_sync(view)(request, path='/a/')
+        self.assertTrue(resp.streaming)
+        tree = etree.fromstring(run_on_loop(b''.join, resp))
+        self.assertEqual(sorted(tree.xpath('//D:displayname/text()', namespaces=WEBDAV_NSMAP)), ['a', 'b'])
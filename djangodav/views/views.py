@@ -1,16 +1,30 @@
 import urllib, re
 import sys
+import calendar
+import threading
+import weakref
+from copy import deepcopy
+from itertools import islice
+from io import BytesIO
+from uuid import uuid4
 try:
     import urlparse
 except ImportError:
     from urllib import parse as urlparse
 from sys import version_info as python_version
+try:
+    from http.client import responses
+except ImportError:
+    from httplib import responses
+    # httplib has no WebDAV status reasons
+    responses = dict(responses)
+    responses.update({207: 'Multi-Status', 423: 'Locked', 424: 'Failed Dependency', 507: 'Insufficient Storage'})
 from lxml import etree
 
 from django.utils.encoding import force_text
 from django.utils.timezone import now
 from django.http import HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseBadRequest, \
-    HttpResponseNotModified, HttpResponseRedirect, Http404
+    HttpResponseNotModified, HttpResponseRedirect, Http404, FileResponse
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.http import parse_etags
@@ -20,17 +34,104 @@ from django.views.generic import View
 
 from djangodav.responses import ResponseException, HttpResponsePreconditionFailed, HttpResponseCreated, HttpResponseNoContent, \
     HttpResponseConflict, HttpResponseMediatypeNotSupported, HttpResponseBadGateway, \
-    HttpResponseMultiStatus, HttpResponseLocked, HttpResponse
-from djangodav.utils import WEBDAV_NSMAP, D, url_join, get_property_tag_list, rfc1123_date
+    HttpResponseMultiStatus, HttpResponseLocked, HttpResponse, StreamingHttpResponseMultiStatus, \
+    HttpResponseRequestedRangeNotSatisfiable, FileResponsePartialContent, StreamingHttpResponsePartialContent
+from djangodav.utils import WEBDAV_NSMAP, D, url_join, build_property_tag_list, rfc1123_date, parse_time, \
+    parse_range_header, coalesce_ranges, parse_lock_token
+from djangodav.multistatus import get_multistatus_writer
+from djangodav.instrumentation import NULL_METRICS, RequestMetrics
+from djangodav.signals import request_measured
 from djangodav import VERSION as djangodav_version
 from django import VERSION as django_version, get_version
 
 PATTERN_IF_DELIMITER = re.compile(r'(<([^>]+)>)|(\(([^\)]+)\))')
+PATTERN_IF_CONDITION = re.compile(r'(Not\s*)?(?:<([^>]*)>|\[([^\]]*)\])', re.IGNORECASE)
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+_if_header_cache = {}
+IF_HEADER_CACHE_SIZE = 256
+
+_executors = weakref.WeakKeyDictionary()
+_executor_lock = threading.Lock()
+
+
+def get_executor(view_class, name, workers):
+    """Returns the thread pool of the given name and size for the view class, created on first use
+    and shared by all its views with that many workers. Pools go with their class."""
+    pools = _executors.get(view_class, {})
+    executor = pools.get((name, workers))
+    if executor is None:
+        with _executor_lock:
+            pools = _executors.setdefault(view_class, {})
+            executor = pools.get((name, workers))
+            if executor is None:
+                executor = pools[name, workers] = ThreadPoolExecutor(workers)
+    return executor
+
+
+def parse_if_header(value):
+    """Parses an If header (RFC 4918 section 10.4) into a tuple of (url, conditions) lists, where url
+    is None for untagged lists and conditions is a tuple of (negated, is_etag, value). Raises
+    ValueError for a malformed header. Results are cached, clients repeat the same header a lot."""
+    try:
+        return _if_header_cache[value]
+    except KeyError:
+        pass
+    lists, url, tagged, pos = [], None, False, 0
+    for match in PATTERN_IF_DELIMITER.finditer(value):
+        if value[pos:match.start()].strip():
+            raise ValueError('Malformed If header')
+        pos = match.end()
+        if match.group(2) is not None:
+            if tagged:
+                raise ValueError('Resource tag without lists in If header')
+            url, tagged = match.group(2), True
+            continue
+        conditions, cpos = [], 0
+        content = match.group(4)
+        for cond in PATTERN_IF_CONDITION.finditer(content):
+            if content[cpos:cond.start()].strip():
+                raise ValueError('Malformed If header list')
+            cpos = cond.end()
+            is_etag = cond.group(3) is not None
+            conditions.append((bool(cond.group(1)), is_etag, cond.group(3) if is_etag else cond.group(2)))
+        if not conditions or content[cpos:].strip():
+            raise ValueError('Malformed If header list')
+        lists.append((url, tuple(conditions)))
+        tagged = False
+    if value[pos:].strip() or tagged or not lists:
+        raise ValueError('Malformed If header')
+    if len(_if_header_cache) >= IF_HEADER_CACHE_SIZE:
+        _if_header_cache.clear()
+    lists = _if_header_cache[value] = tuple(lists)
+    return lists
+
+
+def unquote_etag(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"')
+
+
+def get_etag(res):
+    """Returns the unquoted entity tag of the resource, or None when it has none, like collections
+    of database resources."""
+    etag = getattr(res, 'getetag', None)
+    if etag is None:
+        return None
+    return unquote_etag(etag)
+
 
 class DavView(View):
     resource_class = None
     lock_class = None
     acl_class = None
+    property_store_class = None  # Dead properties are accepted but not kept without one
     template_name = 'djangodav/index.html'
     http_method_names = ['options', 'put', 'mkcol', 'head', 'get', 'delete', 'propfind', 'proppatch', 'copy', 'move', 'lock', 'unlock']
     server_header = 'DjangoDav/%s Django/%s Python/%s' % (
@@ -40,12 +141,45 @@ class DavView(View):
     )
     xml_pretty_print = False
     xml_encoding = 'utf-8'
+    xml_streaming = False
+    xml_stream_chunk_size = 64 * 1024
+    read_chunk_size = 64 * 1024
+    max_ranges = 64  # Range headers asking for more parts, once coalesced, get the whole entity
+    lock_default_timeout = 600
+    lock_max_timeout = 24 * 3600
+    propfind_batch_size = 100
+    xml_fast_multistatus = True  # Serialize PROPFIND with djangodav.multistatus.MultistatusWriter
+    instrument = False  # Collect djangodav.instrumentation.RequestMetrics for every request
+    server_timing = False  # Report the collected metrics in a Server-Timing header
+    metrics_sinks = ()  # djangodav.instrumentation.BaseMetricsSink instances receiving the metrics
+    metrics = NULL_METRICS
+    # Threads gathering PROPFIND properties of a batch in parallel, for storages where each resource
+    # costs a round trip, like stat calls on NFS. The pool is shared by the requests of the view class.
+    propfind_workers = 0
 
     def no_access(self):
         return HttpResponseForbidden()
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, path, *args, **kwargs):
+        try:
+            self.prepare_request(request, path, kwargs)
+            handler = self.get_handler(request)
+            try:
+                resp = handler(request, self.path, *args, **kwargs)
+            except ResponseException as e:
+                resp = e.response
+            return self.finalize_response(request, resp)
+        except BaseException:
+            # Http404 or a parse error, turned into a response outside of the view
+            self.metrics.finish()
+            raise
+
+    def prepare_request(self, request, path, kwargs):
+        """Set path, base_url and the parsed xml body, passed to the handler in kwargs."""
+        if self.instrument:
+            self.metrics = RequestMetrics()
+            self.metrics.start()
         if path:
             self.path = path
             self.base_url = request.META['PATH_INFO'][:-len(self.path)]
@@ -59,19 +193,18 @@ class DavView(View):
             and "/xml" in meta('CONTENT_TYPE', '')
             and meta('CONTENT_LENGTH', 0) != ''
             and int(meta('CONTENT_LENGTH', 0)) > 0):
-            self.xbody = kwargs['xbody'] = etree.XPathDocumentEvaluator(
-                etree.parse(request, etree.XMLParser(ns_clean=True)),
-                namespaces=WEBDAV_NSMAP
-            )
+            with self.metrics.phase('body'):
+                self.xbody = kwargs['xbody'] = etree.XPathDocumentEvaluator(
+                    etree.parse(request, etree.XMLParser(ns_clean=True)),
+                    namespaces=WEBDAV_NSMAP
+                )
 
+    def get_handler(self, request):
         if request.method.upper() in self._allowed_methods():
-            handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
-        else:
-            handler = self.http_method_not_allowed
-        try:
-            resp = handler(request, self.path, *args, **kwargs)
-        except ResponseException as e:
-            resp = e.response
+            return getattr(self, request.method.lower(), self.http_method_not_allowed)
+        return self.http_method_not_allowed
+
+    def finalize_response(self, request, resp):
         if not 'Allow' in resp:
             methods = self._allowed_methods()
             if methods:
@@ -80,8 +213,30 @@ class DavView(View):
             resp['Date'] = rfc1123_date(now())
         if self.server_header:
             resp['Server'] = self.server_header
+        if self.metrics.enabled:
+            self.finish_metrics(request, resp)
         return resp
 
+    def finish_metrics(self, request, response):
+        """Reports the metrics of the request. The body of a streaming response, other than a file
+        which the server may send on its own, is produced after dispatch returns, so its time counts
+        as the serialize phase and the metrics are reported once it is exhausted."""
+        metrics = self.metrics
+        if response.streaming and getattr(response, 'file_to_stream', None) is None:
+            response.streaming_content = metrics.iter_stream(
+                response.streaming_content, 'serialize', lambda: self.emit_metrics(request, response)
+            )
+        else:
+            self.emit_metrics(request, response)
+        if self.server_timing:
+            response['Server-Timing'] = metrics.server_timing()
+
+    def emit_metrics(self, request, response):
+        self.metrics.finish()
+        request_measured.send(sender=self.__class__, view=self, request=request, response=response, metrics=self.metrics)
+        for sink in self.metrics_sinks:
+            sink.emit(self, request, response, self.metrics)
+
     def options(self, request, path, *args, **kwargs):
         if not self.has_access(self.resource, 'read'):
             return self.no_access()
@@ -110,14 +265,20 @@ class DavView(View):
         return self.acl_class(read=True, full=False)
 
     def has_access(self, resource, method):
-        return getattr(self.get_access(resource), method)
+        with self.metrics.phase('access'):
+            return getattr(self.get_access(resource), method)
 
     def get_resource_kwargs(self, **kwargs):
         return kwargs
 
     @cached_property
     def resource(self):
-        return self.get_resource(path=self.path)
+        with self.metrics.phase('resolve'):
+            resource = self.get_resource(path=self.path)
+            if self.metrics.enabled:
+                # Resources look themselves up lazily, do it here to have it timed
+                resource.exists
+        return resource
 
     def get_resource(self, **kwargs):
         return self.resource_class(**self.get_resource_kwargs(**kwargs))
@@ -132,48 +293,137 @@ class DavView(View):
             depth = int(depth)
         return depth
 
-    def evaluate_conditions(self, res):
+    def evaluate_conditions(self, request, res):
+        """Evaluates the If header and the HTTP conditional headers against the resource. Raises
+        412, or 304 for GET and HEAD, when a condition fails. GET and HEAD look at If-None-Match
+        only for resources with cheap_etag, otherwise they revalidate with If-Modified-Since."""
+        self.evaluate_if_header(request)
+        meta = request.META.get
         if not res.exists:
+            if meta('HTTP_IF_MATCH'):
+                raise ResponseException(HttpResponsePreconditionFailed())
             return
-        etag = res.get_etag()
-        mtime = res.get_mtime_stamp()
-        cond_if_match = self.request.META.get('HTTP_IF_MATCH', None)
+        mtime = calendar.timegm(res.get_modified().utctimetuple())
+        cond_if_match = meta('HTTP_IF_MATCH', None)
         if cond_if_match:
-            etags = parse_etags(cond_if_match)
-            if '*' in etags or etag in etags:
+            etags = [unquote_etag(etag) for etag in parse_etags(cond_if_match)]
+            if '*' not in etags and get_etag(res) not in etags:
                 raise ResponseException(HttpResponsePreconditionFailed())
-        cond_if_modified_since = self.request.META.get('HTTP_IF_MODIFIED_SINCE', False)
-        if cond_if_modified_since:
-            # Parse and evaluate, but don't raise anything just yet...
-            # This might be ignored based on If-None-Match evaluation.
-            cond_if_modified_since = parse_time(cond_if_modified_since)
-            if cond_if_modified_since and cond_if_modified_since > mtime:
-                cond_if_modified_since = True
-            else:
-                cond_if_modified_since = False
-        cond_if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH', None)
-        if cond_if_none_match:
-            etags = parse_etags(cond_if_none_match)
-            if '*' in etags or etag in etags:
-                if self.request.method in ('GET', 'HEAD'):
-                    raise ResponseException(HttpResponseNotModified())
-                raise ResponseException(HttpResponsePreconditionFailed())
-            # Ignore If-Modified-Since header...
-            cond_if_modified_since = False
-        cond_if_unmodified_since = self.request.META.get('HTTP_IF_UNMODIFIED_SINCE', None)
+        cond_if_unmodified_since = meta('HTTP_IF_UNMODIFIED_SINCE', None)
         if cond_if_unmodified_since:
             cond_if_unmodified_since = parse_time(cond_if_unmodified_since)
-            if cond_if_unmodified_since and cond_if_unmodified_since <= mtime:
+            if cond_if_unmodified_since and cond_if_unmodified_since < mtime:
+                raise ResponseException(HttpResponsePreconditionFailed())
+        safe = request.method in ('GET', 'HEAD')
+        cond_if_none_match = meta('HTTP_IF_NONE_MATCH', None)
+        if cond_if_none_match and (res.cheap_etag or not safe):
+            etags = [unquote_etag(etag) for etag in parse_etags(cond_if_none_match)]
+            if '*' in etags or get_etag(res) in etags:
+                if safe:
+                    raise ResponseException(self.build_not_modified_response(res))
                 raise ResponseException(HttpResponsePreconditionFailed())
-        if cond_if_modified_since:
-            # This previously evaluated True and is not being ignored...
-            raise ResponseException(HttpResponseNotModified())
-        # TODO: complete If header handling...
-        cond_if = self.request.META.get('HTTP_IF', None)
-        if cond_if:
-            if not cond_if.startswith('<'):
-                cond_if = '<*>' + cond_if
-            #for (tmpurl, url, tmpcontent, content) in PATTERN_IF_DELIMITER.findall(cond_if):
+            # If-Modified-Since is ignored when If-None-Match is given
+            return
+        cond_if_modified_since = meta('HTTP_IF_MODIFIED_SINCE', None)
+        if cond_if_modified_since and safe:
+            cond_if_modified_since = parse_time(cond_if_modified_since)
+            if cond_if_modified_since and cond_if_modified_since >= mtime:
+                raise ResponseException(self.build_not_modified_response(res))
+
+    def build_not_modified_response(self, res):
+        response = HttpResponseNotModified()
+        if res.cheap_etag and get_etag(res) is not None:
+            response['ETag'] = res.getetag
+        response['Last-Modified'] = res.getlastmodified
+        return response
+
+    def get_if_resource(self, request, url):
+        """Returns the resource a tagged list of the If header refers to, or None when the url is
+        outside of this view."""
+        if url is None:
+            return self.resource
+        path = urlparse.unquote(urlparse.urlparse(url).path)
+        if not path.startswith(self.base_url):
+            return None
+        path = path[len(self.base_url):]
+        if path.strip('/') == self.path.strip('/'):
+            return self.resource
+        return self.get_resource(path=path)
+
+    def evaluate_if_header(self, request):
+        """Evaluates the If header. Lock tokens of all resources the header refers to are fetched
+        with one lock_class.get_many call, entity tags once per resource. Lock token conditions are
+        skipped when lock_class keeps no locks. Raises 412 when no list matches."""
+        header = request.META.get('HTTP_IF')
+        if not header:
+            return
+        try:
+            lists = parse_if_header(header)
+        except ValueError as e:
+            raise ResponseException(HttpResponseBadRequest(force_text(e)))
+        resources, urls = {}, []
+        for url, conditions in lists:
+            if url not in resources:
+                resources[url] = self.get_if_resource(request, url)
+                if resources[url] is not None:
+                    urls.append(url)  # In header order
+        tokens = {}
+        stateful = self.lock_class.stateful
+        if stateful and any(not is_etag for url, conditions in lists for negated, is_etag, value in conditions):
+            for url, locks in zip(urls, self.lock_class.get_many([resources[url] for url in urls])):
+                tokens[url] = set(lock.token for lock in locks)
+        etags = {}
+        for url, conditions in lists:
+            resource = resources[url]
+            if resource is None:
+                continue
+            for negated, is_etag, value in conditions:
+                if is_etag:
+                    if url not in etags:
+                        etags[url] = get_etag(resource) if resource.exists else None
+                    matched = etags[url] == unquote_etag(value)
+                elif not stateful:
+                    continue
+                else:
+                    matched = parse_lock_token(value) in tokens[url]
+                if matched == negated:
+                    break
+            else:
+                return
+        raise ResponseException(HttpResponsePreconditionFailed('If header conditions failed'))
+
+    def get_submitted_tokens(self, request):
+        """Returns the lock tokens submitted in the If header."""
+        header = request.META.get('HTTP_IF')
+        if not header:
+            return set()
+        try:
+            lists = parse_if_header(header)
+        except ValueError as e:
+            raise ResponseException(HttpResponseBadRequest(force_text(e)))
+        return set(
+            parse_lock_token(value) for url, conditions in lists
+            for negated, is_etag, value in conditions if not negated and not is_etag
+        )
+
+    def check_locks(self, request, resources, subtree=()):
+        """Raises 423 when a lock applies to one of the resources, or to one of the subtree resources
+        and their descendants, and no lock token of its path is submitted in the If header. Nothing
+        is checked without lock_class or when it keeps no locks."""
+        if self.lock_class is None or not self.lock_class.stateful:
+            return
+        locks = []
+        if resources:
+            for found in self.lock_class.get_many(resources):
+                locks += found
+        for resource in subtree:
+            locks += self.lock_class(resource).get_subtree() or []
+        if not locks:
+            return
+        tokens = self.get_submitted_tokens(request)
+        held = set(lock.path for lock in locks if lock.token in tokens)
+        if any(lock.path not in held for lock in locks):
+            raise ResponseException(HttpResponseLocked('Locked'))
 
     def get(self, request, path, head=False, *args, **kwargs):
         if not self.resource.exists:
@@ -187,17 +437,98 @@ class DavView(View):
             response['Content-Length'] = 0
         if not self.has_access(self.resource, 'read'):
             return self.no_access()
+        if request is not None:
+            self.evaluate_conditions(request, self.resource)
         if self.resource.is_object:
-            response['Content-Type'] = self.resource.content_type
+            ranges = None
+            if not head and request is not None:
+                ranges = self.get_ranges(request)
+            if ranges:
+                with self.metrics.phase('body'):
+                    response = self.build_range_response(ranges)
+                if self.metrics.enabled:
+                    self.metrics.bytes_read += sum(end - start + 1 for start, end in ranges)
+            else:
+                if not head:
+                    # FileResponse lets the WSGI server use wsgi.file_wrapper (and sendfile) when available
+                    with self.metrics.phase('body'):
+                        response = FileResponse(self.resource.open_read())
+                    response.block_size = self.read_chunk_size
+                    response['Content-Length'] = self.resource.getcontentlength
+                    if self.metrics.enabled:
+                        self.metrics.bytes_read += self.resource.getcontentlength
+                response['Content-Type'] = self.resource.content_type
             response['ETag'] = self.resource.getetag
-            if not head:
-                response['Content-Length'] = self.resource.getcontentlength
-                response.content = self.resource.read()
+            response['Accept-Ranges'] = 'bytes'
         elif not head:
             response = render(request, self.template_name, dict(resource=self.resource, base_url=self.base_url))
         response['Last-Modified'] = self.resource.getlastmodified
         return response
 
+    def get_ranges(self, request):
+        """Return the list of (start, end) byte ranges requested by the Range header, or None when
+        the whole entity has to be sent. Raises 416 when none of the ranges can be satisfied."""
+        header = request.META.get('HTTP_RANGE')
+        if not header:
+            return None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range:
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                if if_range.strip('"') != self.resource.getetag:
+                    return None
+            else:
+                modified = parse_time(if_range)
+                if modified is None or modified != parse_time(self.resource.getlastmodified):
+                    return None
+        size = self.resource.getcontentlength
+        ranges = parse_range_header(header, size)
+        if ranges == []:
+            response = HttpResponseRequestedRangeNotSatisfiable()
+            response['Content-Range'] = 'bytes */%d' % size
+            raise ResponseException(response)
+        if ranges:
+            ranges = coalesce_ranges(ranges)
+            if len(ranges) > self.max_ranges:
+                return None
+        return ranges
+
+    def build_range_response(self, ranges):
+        """Return a 206 response streaming the ranges from resource.open_range."""
+        size = self.resource.getcontentlength
+        content_type = self.resource.content_type or 'application/octet-stream'
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response = FileResponsePartialContent(self.resource.open_range(start, end))
+            response.block_size = self.read_chunk_size
+            response['Content-Type'] = content_type
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+            return response
+        boundary = uuid4().hex
+        heads = [('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, content_type, start, end, size
+        )).encode('ascii') for start, end in ranges]
+        tail = ('--%s--\r\n' % boundary).encode('ascii')
+        response = StreamingHttpResponsePartialContent(self.iter_range_parts(ranges, heads, tail))
+        response['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        response['Content-Length'] = sum(
+            len(head) + end - start + 3 for head, (start, end) in zip(heads, ranges)
+        ) + len(tail)
+        return response
+
+    def iter_range_parts(self, ranges, heads, tail):
+        """Yield the multipart/byteranges body, opening each range only when it is reached."""
+        for head, (start, end) in zip(heads, ranges):
+            yield head
+            f = self.resource.open_range(start, end)
+            try:
+                for chunk in iter(lambda: f.read(self.read_chunk_size), b''):
+                    yield chunk
+            finally:
+                f.close()
+            yield b'\r\n'
+        yield tail
+
     def head(self, request, path, *args, **kwargs):
         return self.get(request, path, head=True, *args, **kwargs)
 
@@ -211,8 +542,17 @@ class DavView(View):
             return self.no_access()
         if self.resource.exists and not self.has_access(self.resource, 'write'):
             return self.no_access()
+        self.evaluate_conditions(request, self.resource)
         created = not self.resource.exists
-        self.resource.write(request)
+        self.check_locks(request, [self.resource, parent] if created else [self.resource])
+        with self.metrics.phase('body'):
+            upload = self.resource.write(request)
+        if self.metrics.enabled:
+            size = getattr(upload, 'size', None)
+            if size is None:  # Chunked uploads have no Content-Length
+                size = int(request.META.get('CONTENT_LENGTH') or 0)
+            self.metrics.bytes_written += size
+        self.resource.invalidate()
         if created:
             self.__dict__['resource'] = self.get_resource(path=self.resource.get_path())
             return HttpResponseCreated()
@@ -224,8 +564,13 @@ class DavView(View):
             raise Http404("Resource doesn't exists")
         if not self.has_access(self.resource, 'delete'):
             return self.no_access()
+        self.evaluate_conditions(request, self.resource)
+        self.check_locks(request, [self.resource.get_parent()], [self.resource])
         self.lock_class(self.resource).del_locks()
         self.resource.delete()
+        store = self.get_property_store(self.resource)
+        if store is not None:
+            store.delete()
         response = HttpResponseNoContent()
         self.__dict__['resource'] = self.get_resource(path=self.resource.get_path())
         return response
@@ -240,7 +585,9 @@ class DavView(View):
             return HttpResponseMediatypeNotSupported()
         if not self.has_access(self.resource, 'write'):
             return self.no_access()
+        self.check_locks(request, [self.resource, self.resource.get_parent()])
         self.resource.create_collection()
+        self.resource.invalidate()
         self.__dict__['resource'] = self.get_resource(path=self.resource.get_path())
         return HttpResponseCreated()
 
@@ -264,10 +611,14 @@ class DavView(View):
             return HttpResponseBadGateway('Source and destination must have the same scheme and host.')
         # adjust path for our base url:
         dst = self.get_resource(path=dparts.path[len(self.base_url):])
+        source = self.resource.path
+        if dst.path == source or (self.resource.is_collection and dst.path[:len(source)] == source):
+            return HttpResponseForbidden('Destination is the source or inside it.')
         if not dst.get_parent().exists:
             return HttpResponseConflict()
         if not self.has_access(self.resource, 'write'):
             return self.no_access()
+        self.evaluate_conditions(request, self.resource)
         overwrite = request.META.get('HTTP_OVERWRITE', 'T')
         if overwrite not in ('T', 'F'):
             return HttpResponseBadRequest('Overwrite header must be T or F.')
@@ -275,13 +626,33 @@ class DavView(View):
         if not overwrite and dst.exists:
             return HttpResponsePreconditionFailed('Destination exists and overwrite False.')
         dst_exists = dst.exists
+        # Moving changes the source tree and its parent, both change the destination tree or parent
+        resources, subtree = [], []
+        if method == 'move':
+            resources.append(self.resource.get_parent())
+            subtree.append(self.resource)
+        if dst_exists:
+            subtree.append(dst)
+        else:
+            resources += [dst, dst.get_parent()]
+        self.check_locks(request, resources, subtree)
         if dst_exists:
             self.lock_class(self.resource).del_locks()
             self.lock_class(dst).del_locks()
             dst.delete()
         errors = getattr(self.resource, method)(dst, *args, **kwargs)
+        self.resource.invalidate()
+        dst.invalidate()
+        store = self.get_property_store(self.resource)
+        if store is not None:
+            getattr(store, method)(dst)
         if errors:
-            return self.build_xml_response(response_class=HttpResponseMultiStatus) # WAT?
+            return self.build_xml_response(D.multistatus(*[
+                D.response(
+                    D.href(url_join(self.base_url, resource.get_escaped_path())),
+                    D.status('HTTP/1.1 %d %s' % (status, responses.get(status, 'Unknown Status Code'))),
+                ) for resource, status in errors
+            ]), HttpResponseMultiStatus)
         if dst_exists:
             return HttpResponseNoContent()
         return HttpResponseCreated()
@@ -297,23 +668,61 @@ class DavView(View):
             return self.no_access()
         return self.relocate(request, path, 'move')
 
+    def get_lock_timeout(self):
+        """Return the lock timeout in seconds requested with the Timeout header, limited by
+        lock_max_timeout."""
+        header = self.request.META.get('HTTP_TIMEOUT')
+        if not header:
+            return self.lock_default_timeout
+        for value in header.split(','):
+            value = value.strip()
+            if value.lower() == 'infinite':
+                return self.lock_max_timeout
+            if value.startswith('Second-'):
+                try:
+                    return min(int(value[len('Second-'):]), self.lock_max_timeout)
+                except ValueError:
+                    pass
+        raise ResponseException(HttpResponseBadRequest('Wrong timeout'))
+
+    def build_lock_response(self, locktype, lockscope, depth, timeout, token, owner=None):
+        body = D.prop(D.lockdiscovery(D.activelock(*([
+            D.locktype(locktype),
+            D.lockscope(lockscope),
+            D.depth('infinity' if depth == -1 else force_text(depth)),
+            D.timeout("Second-%s" % timeout),
+            D.locktoken(D.href('opaquelocktoken:%s' % token))]
+            + ([owner] if owner is not None else [])
+        ))))
+        response = self.build_xml_response(body)
+        response['Lock-Token'] = '<opaquelocktoken:%s>' % token
+        return response
+
+    def refresh_lock(self, request, timeout):
+        match = re.search(r'<(opaquelocktoken:[^>]+)>', request.META.get('HTTP_IF', ''))
+        if not match:
+            return HttpResponseBadRequest('Lockinfo required')
+        lock = self.lock_class(self.resource).refresh(match.group(1), timeout)
+        if not lock:
+            return HttpResponsePreconditionFailed('Lock not found')
+        return self.build_lock_response(
+            D(lock.type), D(lock.scope), lock.depth, lock.timeout, lock.token,
+            D.owner(lock.owner) if lock.owner else None
+        )
+
     def lock(self, request, path, xbody=None, *args, **kwargs):
-        # TODO Lock refreshing
         if not self.has_access(self.resource, 'write'):
             return self.no_access()
 
-        if not xbody:
-            return HttpResponseBadRequest('Lockinfo required')
-
-        try:
-            depth = int(request.META.get('HTTP_DEPTH', '0'))
-        except ValueError:
+        depth = request.META.get('HTTP_DEPTH', 'infinity').lower()
+        if depth not in ('0', 'infinity'):
             return HttpResponseBadRequest('Wrong depth')
+        depth = 0 if depth == '0' else -1
 
-        try:
-            timeout = int(request.META.get('HTTP_LOCK_TIMEOUT', 'Seconds-600')[len('Seconds-'):])
-        except ValueError:
-            return HttpResponseBadRequest('Wrong timeout')
+        timeout = self.get_lock_timeout()
+
+        if not xbody:
+            return self.refresh_lock(request, timeout)
 
         owner = None
         try:
@@ -344,16 +753,7 @@ class DavView(View):
         if not token:
             return HttpResponseLocked('Already locked')
 
-        body = D.activelock(*([
-            D.locktype(locktype_obj),
-            D.lockscope(lockscope_obj),
-            D.depth(force_text(depth)),
-            D.timeout("Second-%s" % timeout),
-            D.locktoken(D.href('opaquelocktoken:%s' % token))]
-            + ([owner_obj] if owner_obj is not None else [])
-        ))
-
-        return self.build_xml_response(body)
+        return self.build_lock_response(locktype_obj, lockscope_obj, depth, timeout, token, owner_obj)
 
     def unlock(self, request, path, xbody=None, *args, **kwargss):
         if not self.has_access(self.resource, 'write'):
@@ -378,7 +778,7 @@ class DavView(View):
 
         get_all_props, get_prop, get_prop_names = True, False, False
         if xbody:
-            get_prop = [p.xpath('local-name()') for p in xbody('/D:propfind/D:prop/*')]
+            get_prop = [p.tag for p in xbody('/D:propfind/D:prop/*')]
             get_all_props = xbody('/D:propfind/D:allprop')
             get_prop_names = xbody('/D:propfind/D:propname')
             if int(bool(get_prop)) + int(bool(get_all_props)) + int(bool(get_prop_names)) != 1:
@@ -387,35 +787,107 @@ class DavView(View):
         children = self.resource.get_descendants(depth=self.get_depth())
 
         if get_prop_names:
-            responses = [
-                D.response(
-                    D.href(url_join(self.base_url, child.get_escaped_path())),
-                    D.propstat(
-                        D.prop(*[
-                            D(name) for name in child.ALL_PROPS
-                        ]),
-                        D.status('HTTP/1.1 200 OK'),
-                    ),
-                )
-                for child in children
-            ]
+            names = None
+            rows = self.iter_properties(children, [], None)
         else:
-            responses = [
-                D.response(
-                    D.href(url_join(self.base_url, child.get_escaped_path())),
-                    D.propstat(
-                        D.prop(
-                            *get_property_tag_list(child, *(get_prop if get_prop else child.ALL_PROPS))
-                        ),
-                        D.status('HTTP/1.1 200 OK'),
-                    ),
+            if get_prop:
+                names = [tag[len('{DAV:}'):] for tag in get_prop if tag.startswith('{DAV:}')]
+                dead_names = [tag for tag in get_prop if not tag.startswith('{DAV:}')]
+            else:
+                names, dead_names = self.resource.ALL_PROPS, None
+            rows = self.iter_properties(children, names, dead_names)
+
+        if self.use_multistatus_writer():
+            chunks = self.iter_multistatus(rows, names)
+            if self.xml_streaming:
+                return StreamingHttpResponseMultiStatus(
+                    self.iter_buffered(chunks), content_type='text/xml; charset="%s"' % self.xml_encoding
                 )
-                for child in children
-            ]
-
-        body = D.multistatus(*responses)
+            with self.metrics.phase('serialize'):
+                content = b''.join(chunks)
+            return HttpResponseMultiStatus(content, content_type='text/xml; charset="%s"' % self.xml_encoding)
+
+        responses = (self.build_propfind_response(child, props, dead_props, names) for child, props, dead_props in rows)
+        if self.xml_streaming:
+            return self.build_xml_stream_response(D.multistatus().tag, responses, StreamingHttpResponseMultiStatus)
+        with self.metrics.phase('serialize'):
+            body = D.multistatus(*responses)
         return self.build_xml_response(body, HttpResponseMultiStatus)
 
+    def build_propfind_response(self, child, props, dead_props, names=None):
+        """Build the response element of a resource, names None gives the propname response."""
+        if names is None:
+            prop = [D(name) for name in child.ALL_PROPS] + [etree.Element(name) for name in dead_props]
+        else:
+            prop = build_property_tag_list(props, names) + [etree.fromstring(value) for value in dead_props.values()]
+        return D.response(
+            D.href(url_join(self.base_url, child.get_escaped_path())),
+            D.propstat(
+                D.prop(*prop),
+                D.status('HTTP/1.1 200 OK'),
+            ),
+        )
+
+    def use_multistatus_writer(self):
+        """The writer produces the output of lxml without pretty printing for utf-8 only."""
+        return self.xml_fast_multistatus and not self.xml_pretty_print and self.xml_encoding.lower() == 'utf-8'
+
+    def iter_multistatus(self, rows, names=None):
+        writer = get_multistatus_writer(self.xml_encoding)
+        yield writer.header
+        for child, props, dead_props in rows:
+            if dead_props:
+                yield writer.element(self.build_propfind_response(child, props, dead_props, names))
+            elif names is None:
+                yield writer.propname_response(url_join(self.base_url, child.get_escaped_path()), child.ALL_PROPS)
+            else:
+                yield writer.response(url_join(self.base_url, child.get_escaped_path()), props, names)
+        yield writer.footer
+
+    def iter_buffered(self, chunks):
+        """Join chunks into pieces of about xml_stream_chunk_size bytes."""
+        buf, size = [], 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.xml_stream_chunk_size:
+                yield b''.join(buf)
+                buf, size = [], 0
+        yield b''.join(buf)
+
+    def iter_properties(self, resources, names, dead_names=()):
+        """Yield (resource, properties, dead properties) triples, fetching the properties of
+        propfind_batch_size resources at a time with get_properties_bulk, or one by one on
+        propfind_workers threads, and the dead ones with property_store_class.get_many. dead_names
+        None asks for all dead properties."""
+        resources = iter(resources)
+        while True:
+            with self.metrics.phase('enumerate'):
+                batch = list(islice(resources, self.propfind_batch_size))
+            if not batch:
+                return
+            with self.metrics.phase('properties'):
+                if self.propfind_workers and ThreadPoolExecutor is not None and len(batch) > 1:
+                    props = list(self.get_propfind_executor().map(
+                        lambda resource: resource.get_properties_bulk([resource], names)[0], batch
+                    ))
+                else:
+                    props = batch[0].get_properties_bulk(batch, names)
+                if self.property_store_class is None or (dead_names is not None and not dead_names):
+                    dead_props = [{} for resource in batch]
+                else:
+                    dead_props = self.property_store_class.get_many(batch, dead_names)
+            for item in zip(batch, props, dead_props):
+                yield item
+
+    def get_propfind_executor(self):
+        return get_executor(self.__class__, 'propfind', self.propfind_workers)
+
+    def get_property_store(self, resource):
+        if self.property_store_class is None:
+            return None
+        return self.property_store_class(resource)
+
     def proppatch(self, request, path, xbody, *args, **kwargs):
         if not self.resource.exists:
             raise Http404("Resource doesn't exists")
@@ -424,26 +896,48 @@ class DavView(View):
         depth = self.get_depth(default="0")
         if depth != 0:
             return HttpResponseBadRequest('Invalid depth header value %s' % depth)
-        props = xbody('/D:propertyupdate/D:set/D:prop/*')
+        self.evaluate_conditions(request, self.resource)
+        self.check_locks(request, [self.resource])
+        # Instructions are applied in document order, a later one wins for the same property
+        set_props, remove_names, protected = {}, set(), []
+        for el in xbody('/D:propertyupdate/D:set/D:prop/* | /D:propertyupdate/D:remove/D:prop/*'):
+            if el.tag.startswith('{DAV:}'):
+                protected.append(el.tag)
+            elif el.getparent().getparent().tag == '{DAV:}set':
+                # A copy leaves out namespace declarations of the request document it doesn't use
+                set_props[el.tag] = etree.tostring(deepcopy(el), encoding='unicode', with_tail=False)
+                remove_names.discard(el.tag)
+            else:
+                set_props.pop(el.tag, None)
+                remove_names.add(el.tag)
+        names = list(set_props) + sorted(remove_names)
+        if protected:
+            propstats = [
+                D.propstat(D.prop(*[etree.Element(name) for name in protected]), D.status('HTTP/1.1 403 Forbidden'))
+            ]
+            if names:
+                propstats.append(D.propstat(
+                    D.prop(*[etree.Element(name) for name in names]), D.status('HTTP/1.1 424 Failed Dependency')
+                ))
+        else:
+            store = self.get_property_store(self.resource)
+            if store is not None:
+                store.update(set_props, remove_names)
+            propstats = [D.propstat(D.prop(*[etree.Element(name) for name in names]), D.status('HTTP/1.1 200 OK'))]
         body = D.multistatus(
-            D.response(
-                D.href(url_join(self.base_url, self.resource.get_escaped_path())),
-                *[D.propstat(
-                    D.status('HTTP/1.1 200 OK'),
-                    D.prop(el.tag)
-                ) for el in props]
-            )
+            D.response(D.href(url_join(self.base_url, self.resource.get_escaped_path())), *propstats)
         )
         return self.build_xml_response(body, HttpResponseMultiStatus)
 
     def build_xml_response(self, tree=None, response_class=HttpResponse, **kwargs):
         if tree is not None:
-            content = etree.tostring(
-                tree,
-                xml_declaration=True,
-                pretty_print=self.xml_pretty_print,
-                encoding=self.xml_encoding
-            )
+            with self.metrics.phase('serialize'):
+                content = etree.tostring(
+                    tree,
+                    xml_declaration=True,
+                    pretty_print=self.xml_pretty_print,
+                    encoding=self.xml_encoding
+                )
         else:
             content = b''
         return response_class(
@@ -451,3 +945,26 @@ class DavView(View):
             content_type='text/xml; charset="%s"' % self.xml_encoding,
             **kwargs
         )
+
+    def build_xml_stream_response(self, tag, elements, response_class=StreamingHttpResponseMultiStatus, **kwargs):
+        """Return a streaming response whose body is the root element ``tag`` wrapping ``elements``.
+        Elements are serialized one by one as the iterable yields them, so the whole document is never
+        held in memory."""
+        return response_class(
+            self.iter_xml(tag, elements),
+            content_type='text/xml; charset="%s"' % self.xml_encoding,
+            **kwargs
+        )
+
+    def iter_xml(self, tag, elements):
+        buf = BytesIO()
+        with etree.xmlfile(buf, encoding=self.xml_encoding, buffered=False) as xf:
+            xf.write_declaration()
+            with xf.element(tag, nsmap=WEBDAV_NSMAP):
+                for element in elements:
+                    xf.write(element, pretty_print=self.xml_pretty_print)
+                    if buf.tell() >= self.xml_stream_chunk_size:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+        yield buf.getvalue()
@@ -30,6 +30,7 @@ DEFAULT_SETTINGS = dict(
         'djangodav',
         'django.contrib.auth',
         'django.contrib.contenttypes',
+        'samples.db',
         # 'djangodav.tests',
     ),
     DATABASES = dict(
@@ -48,3 +48,23 @@ class ObjectModel(BaseDavModel):
 
     class Meta:
         unique_together = (('parent', 'name'),)
+
+
+class PathCollectionModel(BaseDavModel):
+    parent = models.ForeignKey('self', blank=True, null=True, on_delete=models.CASCADE)
+    path = models.CharField(max_length=1024, unique=True)
+    size = 0
+
+    class Meta:
+        unique_together = (('parent', 'name'),)
+
+
+class PathObjectModel(BaseDavModel):
+    parent = models.ForeignKey(PathCollectionModel, blank=True, null=True, on_delete=models.CASCADE)
+    path = models.CharField(max_length=1024, unique=True)
+    size = models.IntegerField(default=0)
+    content = models.TextField(default=u"")
+    md5 = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = (('parent', 'name'),)
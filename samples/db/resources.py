@@ -19,43 +19,56 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with DjangoDav.  If not, see <http://www.gnu.org/licenses/>.
 from base64 import b64encode, b64decode
-from hashlib import md5
 
 from django.utils.timezone import now
-from djangodav.db.resources import NameLookupDBDavMixIn, BaseDBDavResource
-from samples.db.models import CollectionModel, ObjectModel
+from djangodav.db.resources import NameLookupDBDavMixIn, PathLookupDBDavMixIn, BaseDBDavResource
+from djangodav.utils import UploadStream
+from samples.db.models import CollectionModel, ObjectModel, PathCollectionModel, PathObjectModel
 
 
 class MyDBDavResource(NameLookupDBDavMixIn, BaseDBDavResource):
     collection_model = CollectionModel
     object_model = ObjectModel
+    etag_attribute = 'md5'
+    cheap_etag = True
+
+    def get_new_object_kwargs(self):
+        return dict(name=self.displayname, parent=self.get_parent().obj)
 
     def write(self, content):
-        size = len(content)
-        hashsum = md5(content).hexdigest()
-        content = b64encode(content)
+        # Chunks are multiple of 3 bytes long, so their base64 encodings can be concatenated
+        upload = UploadStream(content, 3 * 1024 * 16)
+        content = b''.join(b64encode(chunk) for chunk in upload).decode('ascii')
         if not self.exists:
             self.object_model.objects.create(
-                name=self.displayname,
-                parent=self.get_parent().obj,
-                md5=hashsum,
-                size=size,
-                content=content
+                md5=upload.md5,
+                size=upload.size,
+                content=content,
+                **self.get_new_object_kwargs()
             )
-            return
-        self.obj.size = size
+            self.invalidate_path_cache(descendants=False)
+            return upload
+        self.obj.size = upload.size
         self.obj.modified = now()
         self.obj.content = content
-        self.md5 = hashsum
+        self.obj.md5 = upload.md5
         self.obj.save(update_fields=['content', 'size', 'modified', 'md5'])
+        self.invalidate_path_cache(descendants=False)
+        return upload
 
     def read(self):
         return b64decode(self.obj.content)
 
-    @property
-    def getetag(self):
-        return self.obj.md5
-
     @property
     def getcontentlength(self):
         return self.obj.size
+
+
+class MyPathDBDavResource(PathLookupDBDavMixIn, MyDBDavResource):
+    collection_model = PathCollectionModel
+    object_model = PathObjectModel
+
+    def get_new_object_kwargs(self):
+        kwargs = super(MyPathDBDavResource, self).get_new_object_kwargs()
+        kwargs[self.path_attribute] = self.get_path_value()
+        return kwargs